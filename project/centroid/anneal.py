@@ -46,10 +46,24 @@ class Annealer(object):
     user_exit = False
     save_state_on_exit = False
 
+    # early stopping criteria, each one is off when None
+    patience = None  # steps without a new best energy
+    target_energy = None  # stop once the best energy is at or below this
+    max_seconds = None  # wall-clock budget for anneal()
+    min_acceptance = None  # stop when the acceptance rate over the last acceptance_window steps falls below this
+    acceptance_window = 100
+    return_stop_info = False  # anneal() also returns {'stop_reason', 'steps'}
+
+    # move/undo protocol: move() returns (dE, undo_token) (dE may be None) and rejected moves are reverted in place with undo_move(undo_token),
+    # instead of copying the whole state before every move and copying it back on rejection
+    undo_moves = False
+
     # placeholders
     best_state = None
     best_energy = None
     start = None
+    stop_reason = None
+    stop_step = None
 
     def __init__(self, initial_state=None, load_state=None):
         if initial_state is not None:
@@ -80,6 +94,16 @@ class Annealer(object):
         """Create a state change"""
         pass
 
+    def undo_move(self, undo_token):
+        """Revert the move that returned undo_token (only used with undo_moves)"""
+        raise NotImplementedError
+
+    def do_move(self):
+        """Calls move(), returns (dE, undo_token) whether or not undo_moves is set"""
+        if self.undo_moves:
+            return self.move()
+        return self.move(), None
+
     @abc.abstractmethod
     def energy(self):
         """Calculate state's energy"""
@@ -117,6 +141,12 @@ class Annealer(object):
                                'the self.copy_strategy "%s"' %
                                self.copy_strategy)
 
+    def set_best(self, E):
+        """Records the current state (with energy E) as the best state. Subclasses extend this
+        to keep whatever else goes with the best state"""
+        self.best_state = self.copy_state(self.state)
+        self.best_energy = E
+
     def update(self, *args, **kwargs):
         """Wrapper for internal update.
 
@@ -169,6 +199,19 @@ class Annealer(object):
                   file=sys.stderr, end="")
             sys.stderr.flush()
 
+    def stop_criterion(self, steps_since_best, acceptance):
+        """Returns the reason to stop annealing early, or None to keep going.
+        acceptance is None except at the end of each acceptance window."""
+        if self.target_energy is not None and self.best_energy <= self.target_energy:
+            return 'target_energy'
+        if self.patience is not None and steps_since_best >= self.patience:
+            return 'patience'
+        if self.max_seconds is not None and time.time() - self.start >= self.max_seconds:
+            return 'max_seconds'
+        if self.min_acceptance is not None and acceptance is not None and acceptance < self.min_acceptance:
+            return 'min_acceptance'
+        return None
+
     def anneal(self):
         """Minimizes the energy of a system by simulated annealing.
 
@@ -177,6 +220,10 @@ class Annealer(object):
 
         Returns
         (state, energy): the best state and energy found.
+        (state, energy, stop_info) if return_stop_info is set, where
+        stop_info['stop_reason'] is one of 'steps', 'user_exit',
+        'zero_energy', 'target_energy', 'patience', 'max_seconds' or
+        'min_acceptance', and stop_info['steps'] is the number of steps run.
         """
         step = 0
         self.start = time.time()
@@ -190,54 +237,76 @@ class Annealer(object):
         # Note initial state
         self.T = self.Tmax
         E = self.energy()
-        prevState = self.copy_state(self.state)
+        prevState = None if self.undo_moves else self.copy_state(self.state)
         prevEnergy = E
-        self.best_state = self.copy_state(self.state)
-        self.best_energy = E
+        self.set_best(E)
         trials = accepts = improves = 0
         if self.updates > 0:
             updateWavelength = self.steps / self.updates
             self.update(step, self.T, E, None, None)
+        self.stop_reason = None
+        best_step = 0
+        window_trials = window_accepts = 0
 
         # Attempt moves to new states
         while step < self.steps and not self.user_exit:
             if E == 0:
               print("Energy reached 0 at step", step)
+              self.stop_reason = 'zero_energy'
               break
+            acceptance = None
+            if window_trials >= self.acceptance_window:
+                acceptance = window_accepts / window_trials
+                window_trials = window_accepts = 0
+            self.stop_reason = self.stop_criterion(step - best_step, acceptance)
+            if self.stop_reason is not None:
+                break
             step += 1
             self.T = self.Tmax * math.exp(Tfactor * step / self.steps)
-            dE = self.move()
+            dE, undo_token = self.do_move()
             if dE is None:
                 E = self.energy()
                 dE = E - prevEnergy
             else:
-                E += dE
+                E = E + dE  # not +=, E may be a tensor aliased by prevEnergy/best_energy
             trials += 1
+            window_trials += 1
             if dE > 0.0 and math.exp(-dE / self.T) < random.random():
                 # Restore previous state
-                self.state = self.copy_state(prevState)
+                if self.undo_moves:
+                    self.undo_move(undo_token)
+                else:
+                    self.state = self.copy_state(prevState)
                 E = prevEnergy
             else:
                 # Accept new state and compare to best state
                 accepts += 1
+                window_accepts += 1
                 if dE < 0.0:
                     improves += 1
-                prevState = self.copy_state(self.state)
+                if not self.undo_moves:
+                    prevState = self.copy_state(self.state)
                 prevEnergy = E
                 if E < self.best_energy:
-                    self.best_state = self.copy_state(self.state)
-                    self.best_energy = E
+                    self.set_best(E)
+                    best_step = step
             if self.updates > 1:
                 if (step // updateWavelength) > ((step - 1) // updateWavelength):
                     self.update(
                         step, self.T, E, accepts / trials, improves / trials)
                     trials = accepts = improves = 0
 
+        if self.stop_reason is None:
+            self.stop_reason = 'user_exit' if self.user_exit else 'steps'
+        self.stop_step = step
+
         self.state = self.copy_state(self.best_state)
         if self.save_state_on_exit:
             self.save_state()
 
         # Return best state and energy
+        if self.return_stop_info:
+            return self.best_state, self.best_energy, {'stop_reason': self.stop_reason, 'steps': self.stop_step}
         return self.best_state, self.best_energy
 
     def auto(self, minutes, steps=2000):
@@ -251,24 +320,28 @@ class Annealer(object):
             """Anneals a system at constant temperature and returns the state,
             energy, rate of acceptance, and rate of improvement."""
             E = self.energy()
-            prevState = self.copy_state(self.state)
+            prevState = None if self.undo_moves else self.copy_state(self.state)
             prevEnergy = E
             accepts, improves = 0, 0
             for _ in range(steps):
-                dE = self.move()
+                dE, undo_token = self.do_move()
                 if dE is None:
                     E = self.energy()
                     dE = E - prevEnergy
                 else:
                     E = prevEnergy + dE
                 if dE > 0.0 and math.exp(-dE / T) < random.random():
-                    self.state = self.copy_state(prevState)
+                    if self.undo_moves:
+                        self.undo_move(undo_token)
+                    else:
+                        self.state = self.copy_state(prevState)
                     E = prevEnergy
                 else:
                     accepts += 1
                     if dE < 0.0:
                         improves += 1
-                    prevState = self.copy_state(self.state)
+                    if not self.undo_moves:
+                        prevState = self.copy_state(self.state)
                     prevEnergy = E
             return E, float(accepts) / steps, float(improves) / steps
 
@@ -282,7 +355,7 @@ class Annealer(object):
         self.update(step, T, E, None, None)
         while T == 0.0:
             step += 1
-            dE = self.move()
+            dE, _ = self.do_move()
             if dE is None:
                 dE = self.energy() - E
             T = abs(dE)
@@ -0,0 +1,132 @@
+import numpy as np
+import scipy.sparse as sp
+
+'''
+Compact binary adjacency matrix for the padded STGs.
+The padded adjacency matrices are 0/1 and very sparse, so instead of a dense float64 n x n matrix (8 bytes per potential edge) we pack each row
+into uint64 words, i.e. 1 bit per potential edge. For 0/1 matrices the squared Frobenius distance is just the number of entries that differ,
+so dist^2 = popcount(A_g XOR A_G), which we can compute a whole word (64 entries) at a time
+Bit j of row i is bit (j % 64) of word j // 64 (little endian bit order, which is what np.packbits/np.unpackbits use with bitorder='little')
+'''
+
+if hasattr(np, 'bitwise_count'): # numpy >= 2.0
+	def popcount(words):
+		return np.bitwise_count(words)
+else:
+	_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+	def popcount(words):
+		return _POPCOUNT_TABLE[words.view(np.uint8)]
+
+def num_words(n):
+	return (n + 63) // 64
+
+# bool (n_rows, n) -> uint64 (n_rows, num_words(n))
+def pack_rows(bits):
+	n_rows, n = bits.shape
+	packed = np.zeros((n_rows, num_words(n) * 8), dtype=np.uint8)
+	packed[:, :(n + 7) // 8] = np.packbits(bits, axis=1, bitorder='little')
+	return packed.view(np.uint64)
+
+# uint64 (n_rows, num_words(n)) -> bool (n_rows, n)
+def unpack_rows(words, n):
+	return np.unpackbits(words.view(np.uint8), axis=1, count=n, bitorder='little').astype(bool)
+
+class BitAdjacency(object):
+	def __init__(self, words, n):
+		self.words = np.ascontiguousarray(words, dtype=np.uint64)
+		self.n = n
+		assert self.words.shape == (n, num_words(n))
+
+	@classmethod
+	def zeros(cls, n):
+		return cls(np.zeros((n, num_words(n)), dtype=np.uint64), n)
+
+	@classmethod
+	def from_dense(cls, A):
+		A = np.asarray(A)
+		return cls(pack_rows(A != 0), A.shape[0])
+
+	# build straight from the edge list, without ever making the dense matrix
+	@classmethod
+	def from_edges(cls, sources, sinks, n):
+		sources = np.asarray(sources, dtype=np.int64)
+		sinks = np.asarray(sinks, dtype=np.int64)
+		words = np.zeros((n, num_words(n)), dtype=np.uint64)
+		bits = np.left_shift(np.uint64(1), (sinks % 64).astype(np.uint64))
+		np.bitwise_or.at(words, (sources, sinks // 64), bits)
+		return cls(words, n)
+
+	@property
+	def shape(self):
+		return (self.n, self.n)
+
+	@property
+	def nbytes(self):
+		return self.words.nbytes
+
+	def copy(self):
+		return BitAdjacency(self.words.copy(), self.n)
+
+	def __eq__(self, other):
+		return isinstance(other, BitAdjacency) and self.n == other.n and np.array_equal(self.words, other.words)
+
+	def __getitem__(self, index):
+		i, j = index
+		return int((self.words[i, j // 64] >> np.uint64(j % 64)) & np.uint64(1))
+
+	def flip(self, i, j):
+		self.words[i, j // 64] ^= np.uint64(1) << np.uint64(j % 64)
+
+	def nnz(self):
+		return int(popcount(self.words).sum(dtype=np.int64))
+
+	def to_dense(self, dtype=np.float64):
+		return unpack_rows(self.words, self.n).astype(dtype)
+
+	def to_csr(self, dtype=np.float64):
+		sources, sinks = self.nonzero()
+		return sp.csr_matrix((np.ones(len(sources), dtype=dtype), (sources, sinks)), shape=self.shape)
+
+	def nonzero(self):
+		return np.nonzero(unpack_rows(self.words, self.n))
+
+	# number of differing entries, i.e. the squared Frobenius distance between the 2 (0/1) matrices
+	def hamming(self, other):
+		return int(popcount(self.words ^ other.words).sum(dtype=np.int64))
+
+	# principal submatrix gather A[indices][:, indices]. with a permutation vector p this is the alignment A_G[p][:, p] (see align_numpy)
+	# rows are just a gather of whole words, cols need to be gathered bit by bit so we unpack the selected rows, chunk_bytes worth of bools at a time
+	# (so a full permutation never unpacks the whole n x n matrix at once)
+	def take(self, indices, chunk_bytes=1 << 22):
+		indices = np.asarray(indices, dtype=np.int64)
+		words = np.empty((len(indices), num_words(len(indices))), dtype=np.uint64)
+		chunk_rows = max(1, chunk_bytes // max(self.n, 1))
+		for start in range(0, len(indices), chunk_rows):
+			rows = unpack_rows(self.words[indices[start:start + chunk_rows]], self.n)
+			words[start:start + chunk_rows] = pack_rows(rows[:, indices])
+		return BitAdjacency(words, len(indices))
+
+	def permuted(self, p):
+		return self.take(p)
+
+	def diagonal(self):
+		idx = np.arange(self.n)
+		return ((self.words[idx, idx // 64] >> (idx % 64).astype(np.uint64)) & np.uint64(1)).astype(bool)
+
+	# nodes with at least 1 incoming or outgoing edge, i.e. np.any(A != 0, axis=0) | np.any(A != 0, axis=1) for the dense matrix
+	def nonempty_node_mask(self):
+		has_out = np.any(self.words != 0, axis=1)
+		has_in = unpack_rows(np.bitwise_or.reduce(self.words, axis=0, keepdims=True), self.n)[0]
+		return has_out | has_in
+
+	def row_count(self, i):
+		return int(popcount(self.words[i]).sum(dtype=np.int64))
+
+	def col_count(self, j):
+		return int(((self.words[:, j // 64] >> np.uint64(j % 64)) & np.uint64(1)).sum())
+
+def dist_bits(A_g, A_G):
+	return np.sqrt(A_g.hamming(A_G))
+
+def loss_bits(A_g, list_alignedA_G):
+	return np.mean([dist_bits(A_g, A_G) for A_G in list_alignedA_G])
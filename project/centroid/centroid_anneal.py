@@ -8,11 +8,13 @@ import abc
 import copy
 import datetime
 import math
+import os
 import pickle
 import random
 import signal
 import sys
 import time
+import warnings
 
 
 def round_figures(x, n):
@@ -46,13 +48,39 @@ class CustomCentroidAnnealer(object):
     user_exit = False
     save_state_on_exit = False
 
+    # early stopping criteria, each one is off when None
+    patience = None  # steps without a new best energy
+    target_energy = None  # stop once the best energy is at or below this
+    max_seconds = None  # wall-clock budget for anneal()
+    min_acceptance = None  # stop when the acceptance rate over the last acceptance_window steps falls below this
+    acceptance_window = 100
+    return_stop_info = False  # anneal() also returns {'stop_reason', 'steps'}
+
+    # move/undo protocol: move() returns (dE, undo_token) (dE may be None) and rejected moves are reverted in place with undo_move(undo_token),
+    # instead of copying the whole state before every move and copying it back on rejection
+    undo_moves = False
+
+    # move() can make the Metropolis decision itself (i.e. CentroidAnnealer's speculative mode) by setting move_decision to 'accept' or 'reject',
+    # otherwise it's None and the anneal loop makes it
+    move_decision = None
+
+    # checkpointing: with checkpoint_path set, anneal() writes everything it needs to pick up where it left off to checkpoint_path every checkpoint_every steps
+    # (and when it stops), and if checkpoint_path already exists when anneal() starts, it resumes from it, i.e. a preempted job can just be rerun
+    checkpoint_path = None
+    checkpoint_every = 50
+
     # placeholders
     best_state = None
     best_energy = None
     start = None
+    stop_reason = None
+    stop_step = None
+    resume_from = None
 
     def __init__(self, initial_state=None, load_state=None):
         self.prev_move_accepted = False
+        self.rejected_moves_since_last_accept = []
+        self.last_accepted_move = None
         if initial_state is not None:
             self.state = self.copy_state(initial_state)
         elif load_state:
@@ -76,11 +104,89 @@ class CustomCentroidAnnealer(object):
         with open(fname, 'rb') as fh:
             self.state = pickle.load(fh)
 
+    def checkpoint_fingerprint(self):
+        """Identifies the run a checkpoint belongs to: anneal() only resumes from a checkpoint
+        with the same fingerprint. Subclasses add what identifies their problem (i.e. CentroidAnnealer's corpus)"""
+        return {'schedule': (self.Tmax, self.Tmin, self.steps)}
+
+    def get_checkpoint(self):
+        """Returns the annealer's state for a checkpoint. Subclasses with more state
+        (i.e. caches that energy() and move() rely on) extend this and set_checkpoint"""
+        return {
+            'fingerprint': self.checkpoint_fingerprint(),
+            'state': self.state,
+            'best_state': self.best_state,
+            'best_energy': self.best_energy,
+            'prev_move_accepted': self.prev_move_accepted,
+            'rejected_moves_since_last_accept': self.rejected_moves_since_last_accept,
+            'last_accepted_move': self.last_accepted_move,
+            'schedule': (self.Tmax, self.Tmin, self.steps),
+            'random_state': random.getstate(),
+        }
+
+    def set_checkpoint(self, checkpoint):
+        """Restores the annealer's state from get_checkpoint()"""
+        self.state = checkpoint['state']
+        self.best_state = checkpoint['best_state']
+        self.best_energy = checkpoint['best_energy']
+        self.prev_move_accepted = checkpoint['prev_move_accepted']
+        self.rejected_moves_since_last_accept = checkpoint['rejected_moves_since_last_accept']
+        self.last_accepted_move = checkpoint['last_accepted_move']
+        self.Tmax, self.Tmin, self.steps = checkpoint['schedule']
+        random.setstate(checkpoint['random_state'])
+
+    def set_best(self, E):
+        """Records the current state (with energy E) as the best state. Subclasses extend this
+        to keep whatever else goes with the best state (i.e. CentroidAnnealer's alignments)"""
+        self.best_state = self.copy_state(self.state)
+        self.best_energy = E
+
+    def dump_checkpoint(self, checkpoint, fh):
+        pickle.dump(checkpoint, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read_checkpoint(self, fh):
+        return pickle.load(fh)
+
+    def save_checkpoint(self, fname, loop_state):
+        """Atomically writes a checkpoint, i.e. to a temp file that then replaces fname,
+        so a job killed mid-write never leaves a truncated checkpoint behind"""
+        checkpoint = self.get_checkpoint()
+        checkpoint['loop_state'] = loop_state
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'wb') as fh:
+            self.dump_checkpoint(checkpoint, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_fname, fname)
+
+    def load_checkpoint(self, fname, check_fingerprint=False):
+        """Restores a checkpoint, the next anneal() continues from it. With check_fingerprint,
+        a checkpoint of a different run (see checkpoint_fingerprint) is left alone, and this returns False"""
+        with open(fname, 'rb') as fh:
+            checkpoint = self.read_checkpoint(fh)
+        if check_fingerprint and checkpoint.get('fingerprint') != self.checkpoint_fingerprint():
+            warnings.warn("{} is a checkpoint of a different run (corpus or annealing params), "
+                          "starting from scratch instead (it gets overwritten)".format(fname))
+            return False
+        self.set_checkpoint(checkpoint)
+        self.resume_from = checkpoint['loop_state']
+        return True
+
     @abc.abstractmethod
     def move(self):
         """Create a state change"""
         pass
 
+    def undo_move(self, undo_token):
+        """Revert the move that returned undo_token (only used with undo_moves)"""
+        raise NotImplementedError
+
+    def do_move(self):
+        """Calls move(), returns (dE, undo_token) whether or not undo_moves is set"""
+        if self.undo_moves:
+            return self.move()
+        return self.move(), None
+
     @abc.abstractmethod
     def energy(self):
         """Calculate state's energy"""
@@ -162,6 +268,19 @@ class CustomCentroidAnnealer(object):
                    time_string(elapsed), time_string(remain)), file=sys.stderr, end="\r")
             sys.stderr.flush()
 
+    def stop_criterion(self, steps_since_best, acceptance):
+        """Returns the reason to stop annealing early, or None to keep going.
+        acceptance is None except at the end of each acceptance window."""
+        if self.target_energy is not None and self.best_energy <= self.target_energy:
+            return 'target_energy'
+        if self.patience is not None and steps_since_best >= self.patience:
+            return 'patience'
+        if self.max_seconds is not None and time.time() - self.start >= self.max_seconds:
+            return 'max_seconds'
+        if self.min_acceptance is not None and acceptance is not None and acceptance < self.min_acceptance:
+            return 'min_acceptance'
+        return None
+
     def anneal(self):
         """Minimizes the energy of a system by simulated annealing.
 
@@ -170,9 +289,15 @@ class CustomCentroidAnnealer(object):
 
         Returns
         (state, energy): the best state and energy found.
+        (state, energy, stop_info) if return_stop_info is set, where
+        stop_info['stop_reason'] is one of 'steps', 'user_exit',
+        'zero_energy', 'target_energy', 'patience', 'max_seconds' or
+        'min_acceptance', and stop_info['steps'] is the number of steps run.
         """
         step = 0
         self.start = time.time()
+        if self.resume_from is None and self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            self.load_checkpoint(self.checkpoint_path, check_fingerprint=True)
 
         # Precompute factor for exponential cooling from Tmax to Tmin
         if self.Tmin <= 0.0:
@@ -180,35 +305,62 @@ class CustomCentroidAnnealer(object):
                 "temperature greater than zero.')
         Tfactor = -math.log(self.Tmax / self.Tmin)
 
-        # Note initial state
-        self.T = self.Tmax
-        E = self.energy()
-        prevState = self.copy_state(self.state)
+        if self.resume_from is not None:
+            # Pick up where the checkpoint left off
+            loop_state = self.resume_from
+            self.resume_from = None
+            step, best_step, E = loop_state['step'], loop_state['best_step'], loop_state['energy']
+            window_trials, window_accepts = loop_state['window_trials'], loop_state['window_accepts']
+            self.start -= loop_state['elapsed']
+            self.T = self.Tmax * math.exp(Tfactor * step / self.steps)
+        else:
+            # Note initial state
+            self.T = self.Tmax
+            E = self.energy()
+            self.set_best(E)
+            best_step = 0
+            window_trials = window_accepts = 0
+        prevState = None if self.undo_moves else self.copy_state(self.state)
         prevEnergy = E
-        self.best_state = self.copy_state(self.state)
-        self.best_energy = E
         trials, accepts, improves = 0, 0, 0
         if self.updates > 0:
             updateWavelength = self.steps / self.updates
-            self.update(step, self.T, E, None, None)
+            if step == 0:
+                self.update(step, self.T, E, None, None)
+        self.stop_reason = None
+
+        def checkpoint():
+            self.save_checkpoint(self.checkpoint_path, {'step': step, 'best_step': best_step, 'energy': E, 'window_trials': window_trials,
+                                                        'window_accepts': window_accepts, 'elapsed': time.time() - self.start})
 
         # Attempt moves to new states
         while step < self.steps and not self.user_exit:
+            acceptance = None
+            if window_trials >= self.acceptance_window:
+                acceptance = window_accepts / window_trials
+                window_trials = window_accepts = 0
+            self.stop_reason = self.stop_criterion(step - best_step, acceptance)
+            if self.stop_reason is not None:
+                break
             step += 1
             self.T = self.Tmax * math.exp(Tfactor * step / self.steps)
-            dE = self.move()
+            dE, undo_token = self.do_move()
             if dE is None:
                 E = self.energy()
                 dE = E - prevEnergy
             else:
                 E += dE
             trials += 1
-            if dE > 0.0 and math.exp(-dE / self.T) < random.random():
+            window_trials += 1
+            if self.move_decision == 'reject' or (self.move_decision is None and dE > 0.0 and math.exp(-dE / self.T) < random.random()):
                 print("REJECTED\n")
                 # Restore previous state
                 self.prev_move_accepted = False
                 self.rejected_moves_since_last_accept.append(self.prev_move)
-                self.state = self.copy_state(prevState)
+                if self.undo_moves:
+                    self.undo_move(undo_token)
+                else:
+                    self.state = self.copy_state(prevState)
                 E = prevEnergy
             else:
                 print("ACCEPTED\n")
@@ -217,24 +369,36 @@ class CustomCentroidAnnealer(object):
                 self.last_accepted_move = self.prev_move
                 self.rejected_moves_since_last_accept = []
                 accepts += 1
+                window_accepts += 1
                 if dE < 0.0:
                     improves += 1
-                prevState = self.copy_state(self.state)
+                if not self.undo_moves:
+                    prevState = self.copy_state(self.state)
                 prevEnergy = E
                 if E < self.best_energy:
-                    self.best_state = self.copy_state(self.state)
-                    self.best_energy = E
+                    self.set_best(E)
+                    best_step = step
             if self.updates > 1:
                 if (step // updateWavelength) > ((step - 1) // updateWavelength):
                     self.update(
                         step, self.T, E, accepts / trials, improves / trials)
                     trials, accepts, improves = 0, 0, 0
+            if self.checkpoint_path is not None and step % self.checkpoint_every == 0:
+                checkpoint()
+
+        if self.stop_reason is None:
+            self.stop_reason = 'user_exit' if self.user_exit else 'steps'
+        self.stop_step = step
+        if self.checkpoint_path is not None:
+            checkpoint()
 
         self.state = self.copy_state(self.best_state)
         if self.save_state_on_exit:
             self.save_state()
 
         # Return best state and energy
+        if self.return_stop_info:
+            return self.best_state, self.best_energy, {'stop_reason': self.stop_reason, 'steps': self.stop_step}
         return self.best_state, self.best_energy
 
     def auto(self, minutes, steps=2000):
@@ -248,21 +412,25 @@ class CustomCentroidAnnealer(object):
             """Anneals a system at constant temperature and returns the state,
             energy, rate of acceptance, and rate of improvement."""
             E = self.energy()
-            prevState = self.copy_state(self.state)
+            prevState = None if self.undo_moves else self.copy_state(self.state)
             prevEnergy = E
             accepts, improves = 0, 0
             for _ in range(steps):
-                self.move()
+                _, undo_token = self.do_move()
                 E = self.energy()
                 dE = E - prevEnergy
                 if dE > 0.0 and math.exp(-dE / T) < random.random():
-                    self.state = self.copy_state(prevState)
+                    if self.undo_moves:
+                        self.undo_move(undo_token)
+                    else:
+                        self.state = self.copy_state(prevState)
                     E = prevEnergy
                 else:
                     accepts += 1
                     if dE < 0.0:
                         improves += 1
-                    prevState = self.copy_state(self.state)
+                    if not self.undo_moves:
+                        prevState = self.copy_state(self.state)
                     prevEnergy = E
             return E, float(accepts) / steps, float(improves) / steps
 
@@ -276,7 +444,7 @@ class CustomCentroidAnnealer(object):
         self.update(step, T, E, None, None)
         while T == 0.0:
             step += 1
-            self.move()
+            self.do_move()
             T = abs(self.energy() - E)
 
         # Search for Tmax - a temperature that gives 98% acceptance
@@ -0,0 +1,161 @@
+import math
+import random
+import torch
+
+'''
+Parallel tempering (replica exchange) for the annealers in anneal.py and centroid_anneal.py (i.e. GraphAlignmentAnnealer and CentroidAnnealer).
+Instead of one chain on an exponential cooling schedule, we run n_replicas copies of the annealer at FIXED temperatures on a geometric ladder from Tmin to Tmax,
+each in its own process. Every exchange_every steps, neighboring temperatures try to swap replicas (Metropolis criterion on the energy difference),
+so good states found at high temperature can move down to be refined at low temperature, and stuck low temperature states can escape.
+We swap the temperatures between the replica processes rather than the states themselves, which is equivalent and means no state ever has to be sent between processes
+(except for the best state of each replica at the end, with its alignments for CentroidAnnealer).
+The annealers are used unchanged through their move()/energy() (and undo_move()) methods, so they're built in each worker by make_annealer(*make_args),
+which has to be picklable (i.e. the annealer class itself, or a module level function)
+'''
+
+# runs n_steps Metropolis steps of annealer at fixed temperature T, starting from energy E, the same way the annealers' anneal() loops do
+def metropolis_steps(annealer, T, n_steps, E):
+    annealer.T = T # CentroidAnnealer.energy() scales the nested alignment with the temperature
+    prevState = None if annealer.undo_moves else annealer.copy_state(annealer.state)
+    prevEnergy = E
+    accepts = 0
+    is_centroid_annealer = hasattr(annealer, 'rejected_moves_since_last_accept') # CustomCentroidAnnealer's move() relies on this bookkeeping from its anneal() loop
+    for _ in range(n_steps):
+        dE, undo_token = annealer.do_move()
+        if dE is None:
+            E = annealer.energy()
+            dE = E - prevEnergy
+        else:
+            E = E + dE
+        decision = getattr(annealer, 'move_decision', None) # see CustomCentroidAnnealer
+        if decision == 'reject' or (decision is None and dE > 0.0 and math.exp(-dE / T) < random.random()):
+            if annealer.undo_moves:
+                annealer.undo_move(undo_token)
+            else:
+                annealer.state = annealer.copy_state(prevState)
+            E = prevEnergy
+            if is_centroid_annealer:
+                annealer.prev_move_accepted = False
+                annealer.rejected_moves_since_last_accept.append(annealer.prev_move)
+        else:
+            accepts += 1
+            if is_centroid_annealer:
+                annealer.prev_move_accepted = True
+                annealer.last_accepted_move = annealer.prev_move
+                annealer.rejected_moves_since_last_accept = []
+            if not annealer.undo_moves:
+                prevState = annealer.copy_state(annealer.state)
+            prevEnergy = E
+            if E < annealer.best_energy:
+                annealer.set_best(E)
+    return E, accepts
+
+def _replica_worker(conn, make_annealer, make_args, Tmax, Tmin, seed, torch_threads):
+    torch.set_num_threads(torch_threads)
+    random.seed(seed)
+    torch.manual_seed(seed)
+    annealer = make_annealer(*make_args)
+    annealer.Tmax = Tmax # the whole ladder, i.e. for CentroidAnnealer's temperature ratio
+    annealer.Tmin = Tmin
+    annealer.T = Tmax
+    E = annealer.energy()
+    annealer.set_best(E)
+    conn.send(float(E))
+    while True:
+        command, args = conn.recv()
+        if command == 'run':
+            T, n_steps = args
+            E, accepts = metropolis_steps(annealer, T, n_steps, E)
+            conn.send((float(E), accepts))
+        elif command == 'best':
+            conn.send((annealer.best_state, float(annealer.best_energy), getattr(annealer, 'best_alignments', None)))
+        elif command == 'stop':
+            conn.close()
+            return
+
+class ParallelTempering(object):
+    # defaults
+    Tmax = 2.0
+    Tmin = 0.01
+    steps = 2000 # per replica
+    exchange_every = 50
+
+    def __init__(self, make_annealer, make_args=(), n_replicas=4, torch_threads=1, seed=None):
+        if n_replicas < 2:
+            raise ValueError("Parallel tempering needs at least 2 replicas")
+        self.make_annealer = make_annealer
+        self.make_args = make_args
+        self.n_replicas = n_replicas
+        self.torch_threads = torch_threads
+        self.seed = random.randrange(2 ** 31) if seed is None else seed
+
+    def temperatures(self):
+        # geometric ladder, lowest temperature first
+        return [self.Tmin * (self.Tmax / self.Tmin) ** (i / (self.n_replicas - 1)) for i in range(self.n_replicas)]
+
+    def anneal(self):
+        """Returns (best_state, best_energy, info), where info has the final energy of each temperature,
+        the acceptance rate of the moves at each temperature and of the exchanges between each pair of neighboring temperatures,
+        and the alignments of the best state (best_alignments, for CentroidAnnealer; None otherwise)"""
+        temperatures = self.temperatures()
+        ctx = torch.multiprocessing.get_context('spawn') # same as simanneal_centroid.AlignmentPool
+        conns, processes = [], []
+        for r in range(self.n_replicas):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_replica_worker, args=(child_conn, self.make_annealer, self.make_args, self.Tmax, self.Tmin, self.seed + r, self.torch_threads), daemon=True)
+            process.start()
+            conns.append(parent_conn)
+            processes.append(process)
+
+        try:
+            energies = [conn.recv() for conn in conns]
+            replica_at = list(range(self.n_replicas)) # replica_at[t] is the replica currently at temperature t
+            move_accepts = [0] * self.n_replicas
+            exchange_attempts = [0] * (self.n_replicas - 1)
+            exchange_accepts = [0] * (self.n_replicas - 1)
+            rng = random.Random(self.seed)
+
+            step = 0
+            round_idx = 0
+            while step < self.steps:
+                n_steps = min(self.exchange_every, self.steps - step)
+                for t, r in enumerate(replica_at):
+                    conns[r].send(('run', (temperatures[t], n_steps)))
+                for t, r in enumerate(replica_at):
+                    energies[r], accepts = conns[r].recv()
+                    move_accepts[t] += accepts
+                step += n_steps
+
+                # try to swap neighboring temperatures (t, t+1), alternating between the even and the odd pairs each round
+                for t in range(round_idx % 2, self.n_replicas - 1, 2):
+                    r_low, r_high = replica_at[t], replica_at[t + 1]
+                    delta = (1 / temperatures[t] - 1 / temperatures[t + 1]) * (energies[r_low] - energies[r_high])
+                    exchange_attempts[t] += 1
+                    if delta >= 0 or rng.random() < math.exp(delta):
+                        replica_at[t], replica_at[t + 1] = r_high, r_low
+                        exchange_accepts[t] += 1
+                round_idx += 1
+
+            best_state, best_energy, best_alignments = None, math.inf, None
+            for conn in conns:
+                conn.send(('best', None))
+            for conn in conns:
+                state, energy, alignments = conn.recv()
+                if energy < best_energy:
+                    best_state, best_energy, best_alignments = state, energy, alignments
+            for conn in conns:
+                conn.send(('stop', None))
+        finally:
+            for process in processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+
+        info = {
+            'temperatures': temperatures,
+            'energies': [energies[r] for r in replica_at],
+            'move_acceptance': [accepts / self.steps for accepts in move_accepts],
+            'exchange_acceptance': [accepts / max(attempts, 1) for accepts, attempts in zip(exchange_accepts, exchange_attempts)],
+            'best_alignments': best_alignments,
+        }
+        return best_state, best_energy, info
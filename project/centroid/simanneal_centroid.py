@@ -1,6 +1,8 @@
+import hashlib
 import networkx as nx
 import numpy as np
 import random
+import math
 import re 
 from anneal import Annealer
 from centroid_anneal import CustomCentroidAnnealer
@@ -8,7 +10,10 @@ import sys, os
 import json 
 import multiprocessing
 import pickle
+import warnings
 import scipy.sparse as sp
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
 from collections import defaultdict
 # import cupy as cp
 # import cupyx as cpx
@@ -17,6 +22,7 @@ import torch
 
 # import simanneal_centroid_tests as tests
 import simanneal_centroid_helpers as helpers
+from bit_adjacency import BitAdjacency, dist_bits, loss_bits
 
 # DIRECTORY = '/home/ilshapiro/project'
 DIRECTORY = '/Users/ilanashapiro/Documents/constraints_project/project'
@@ -30,147 +36,450 @@ Simulated Annealing (SA) Combinatorial Optimization Approach
 3. Modify centroid and repeat until loss converges. Loss is sum of dist from centroid to seach graph in corpus
 '''
 
+'''
+Alignments are permutation vectors p (int32), where p[a] is the index of the node in G that gets aligned to node a of the centroid.
+This is the permutation matrix P with P[p[a], a] = 1, so P^T * A_G * P is just A_G with its rows and cols gathered by p, i.e. A_G[p][:, p].
+We only build the dense n x n permutation matrix when it's explicitly requested (i.e. for export)
+'''
 # chooose numpy, cupy, or Torch version depending on the architecture we're running this on
-def align_numpy(P, A_G): # this is actually scipy for better performance but it's compatible with numpy
-	P_sparse = sp.csr_matrix(P) # Conovert to sparse format
-	A_G_sparse = sp.csr_matrix(A_G)
-	return P_sparse.T @ A_G_sparse @ P_sparse # Perform efficient sparse matrix multiplication
+def align_numpy(p, A_G):
+	if isinstance(A_G, BitAdjacency):
+		return A_G.permuted(p)
+	return A_G[np.ix_(p, p)]
+
+def align_cupy(p, A_G):
+	return A_G[p][:, p]
+
+def align_torch(p, A_G):
+	return A_G.index_select(0, p).index_select(1, p) # index_select takes the int32 permutation directly
+
+# content hash of a list of 0/1 adjacency matrices (torch), i.e. to tell whether 2 runs are on the same corpus
+def adjacency_hash(matrices):
+	h = hashlib.sha256()
+	for A in matrices:
+		h.update(repr(tuple(A.shape)).encode())
+		h.update(A.to(torch.bool).cpu().numpy().tobytes())
+	return h.hexdigest()
+
+def identity_alignment_torch(n, device=None):
+	return torch.arange(n, dtype=torch.int32, device=device)
+
+# if p aligns A_G to A_g (A_G[p][:, p] ~ A_g), then its inverse aligns A_g to A_G, with the same dist
+def invert_alignment_torch(p):
+	return torch.argsort(p).to(p.dtype)
+
+def alignment_to_permutation_matrix_numpy(p):
+	P = np.zeros((len(p), len(p)))
+	P[p, np.arange(len(p))] = 1
+	return P
+
+def alignment_to_permutation_matrix_torch(p):
+	P = torch.zeros((len(p), len(p)), dtype=torch.float64, device=p.device)
+	P[p.long(), torch.arange(len(p), device=p.device)] = 1
+	return P
+
+def permutation_matrix_to_alignment_numpy(P):
+	return np.argmax(P, axis=0).astype(np.int32)
 
-def align_cupy(P, A_G):
-	P_sparse = cpsp.csr_matrix(P) # Convert CuPy arrays to sparse matrices
-	A_G_sparse = cpsp.csr_matrix(A_G)
-	result = P_sparse.T @ A_G_sparse @ P_sparse
-	return result.toarray() # Convert to dense
+def permutation_matrix_to_alignment_torch(P):
+	return torch.argmax(P, dim=0).to(torch.int32)
 
-def align_torch(P, A_G):
-	P_sparse = P.to_sparse()
-	A_G_sparse = A_G.to_sparse()
-	result = torch.sparse.mm(torch.sparse.mm(P_sparse.t(), A_G_sparse), P_sparse)
-	return result.to_dense()
+# saved alignment files are permutation vectors, or n x n permutation matrices if they were saved before we switched to vectors
+def as_alignment_torch(alignment, device=None):
+	alignment = np.asarray(alignment)
+	if alignment.ndim == 2:
+		alignment = permutation_matrix_to_alignment_numpy(alignment)
+	return torch.tensor(alignment, dtype=torch.int32, device=device)
 
+# re-embeds alignment p (in the node space of idx_node_mapping) into a larger node space node_idx_mapping (by node ID), i.e. when we add graphs to the corpus
+# so that align(embedded p, embedded A_G) is the embedded align(p, A_G). the new nodes are aligned to themselves
+def embed_alignment_numpy(p, idx_node_mapping, node_idx_mapping):
+	embedded_idx = np.array([node_idx_mapping[idx_node_mapping[i]] for i in range(len(p))], dtype=np.int64)
+	embedded_p = np.arange(len(node_idx_mapping))
+	embedded_p[embedded_idx] = embedded_idx[np.asarray(p)]
+	return embedded_p.astype(np.int32)
 
 '''
 Equation 1 in the paper
 '''
 # dist between g and G given alignment a
 # i.e. reorder nodes of G according to alignment (i.e. permutation matrix) a
+# the annealers work on dense torch matrices, so BitAdjacency matrices (see helpers.pad_adj_matrices(..., matrix_format='bits')) get unpacked once on the way in
+# (the bits save memory on the padded corpus outside the annealers, e.g. for the hierarchical/cached experiments and dist_bits, not inside them:
+# the swap deltas and the count matrix need arithmetic on whole rows/cols, which is what the dense matrices are for)
+def as_adjacency_torch(A, device=None):
+	if isinstance(A, BitAdjacency):
+		return torch.from_numpy(A.to_dense()).to(device)
+	return A
+
 # ||A_g - a^t * A_G * a|| where ||.|| is the norm (using Frobenius norm)
 # chooose numpy, cupy, or Torch version depending on the architecture we're running this on
 def dist_numpy(A_g, A_G):
+	if isinstance(A_g, BitAdjacency): # for 0/1 matrices the squared Frobenius norm is the number of differing entries, i.e. popcount of the XOR
+		return dist_bits(A_g, A_G)
 	return np.linalg.norm(A_g - A_G, 'fro')
 
 def dist_cupy(A_g, A_G):
 	return cp.linalg.norm(A_g - A_G, 'fro')
 
 def dist_torch(A_g, A_G):
+	if isinstance(A_g, BitAdjacency):
+		return torch.tensor(dist_bits(A_g, A_G), dtype=torch.float64)
 	return torch.norm(A_g - A_G, p='fro')
 
+# change in the SQUARED dist ||A_g - M||^2 if we swap rows a, b and cols a, b of the aligned matrix M
+# (which is what swapping entries a, b of the alignment p does to A_G[p][:, p])
+# only rows/cols a and b of M change, so this is O(n) instead of recomputing the whole O(n^2) norm
+def swap_sq_dist_delta_torch(A_g, M, a, b):
+	# outside the 2x2 block {a,b} x {a,b}, the swap just exchanges rows a and b (cols a and b), and summing (A - M')^2 - (A - M)^2
+	# over those 2 rows (cols) simplifies to 2 * <A_a - A_b, M_a - M_b>
+	row_term = 2 * torch.dot(A_g[a] - A_g[b], M[a] - M[b])
+	col_term = 2 * torch.dot(A_g[:, a] - A_g[:, b], M[:, a] - M[:, b])
+
+	# the dot products above also ran over the 2x2 block, where the swap permutes both rows AND cols, so do those 4 entries explicitly
+	# (each entry got half of its row pair's (col pair's) 2 * (A_x - A_x') * (M_x - M_x') term in row_term (col_term))
+	# all in tensor ops, so the whole delta is a single sync with the device (the .item() at the end) instead of one per entry
+	block = [a, b]
+	A_block = A_g[block][:, block]
+	M_block = M[block][:, block]
+	block_term = -torch.sum((A_block - A_block.flip(0)) * (M_block - M_block.flip(0))) \
+		- torch.sum((A_block - A_block.flip(1)) * (M_block - M_block.flip(1))) \
+		+ torch.sum((A_block - M_block.flip(0).flip(1)) ** 2) - torch.sum((A_block - M_block) ** 2)
+	return (row_term + col_term + block_term).item()
+
+# apply the swap of rows/cols a and b to M in place
+def swap_rows_and_cols_torch(M, a, b):
+	row_a = M[a].clone()
+	M[a] = M[b]
+	M[b] = row_a
+	col_a = M[:, a].clone()
+	M[:, a] = M[:, b]
+	M[:, b] = col_a
+
+# same as swap_sq_dist_delta_torch, on numpy arrays (i.e. numpy views of CPU tensors). the delta is a handful of tiny ops, and at the sizes of our graphs
+# torch's overhead per op is most of their cost, which made the delta slower than just recomputing the whole norm. numpy's is a lot smaller
+def swap_sq_dist_delta_numpy(A_g, M, a, b):
+	row_term = 2 * np.dot(A_g[a] - A_g[b], M[a] - M[b])
+	col_term = 2 * np.dot(A_g[:, a] - A_g[:, b], M[:, a] - M[:, b])
+	A_aa, A_ab, A_ba, A_bb = A_g[a, a], A_g[a, b], A_g[b, a], A_g[b, b]
+	M_aa, M_ab, M_ba, M_bb = M[a, a], M[a, b], M[b, a], M[b, b]
+	# the flips of the 2x2 block in swap_sq_dist_delta_torch, entry by entry (each pair shows up twice, once from each of its entries)
+	block_term = -2 * ((A_aa - A_ba) * (M_aa - M_ba) + (A_ab - A_bb) * (M_ab - M_bb)) \
+		- 2 * ((A_aa - A_ab) * (M_aa - M_ab) + (A_ba - A_bb) * (M_ba - M_bb)) \
+		+ (A_aa - M_bb) ** 2 + (A_ab - M_ba) ** 2 + (A_ba - M_ab) ** 2 + (A_bb - M_aa) ** 2 \
+		- (A_aa - M_aa) ** 2 - (A_ab - M_ab) ** 2 - (A_ba - M_ba) ** 2 - (A_bb - M_bb) ** 2
+	return float(row_term + col_term + block_term)
+
+def swap_rows_and_cols_numpy(M, a, b):
+	M[[a, b]] = M[[b, a]]
+	M[:, [a, b]] = M[:, [b, a]]
+
+'''
+Node partitions for the Graph Alignment Annealer: alignments only permute nodes within the same partition
+'''
+# return: (partition name, sub-level (if any))
+# partition name is the layer for instance nodes
+def get_node_partition_info(node_id, node_metadata_dict):
+	def get_layer_id(node_id):
+		for layer_id in ['S', 'P', 'K', 'C', 'M']:
+			if node_id.startswith(layer_id):
+				return layer_id
+		raise Exception("Invalid node", node_id)
+	
+	if node_id.startswith('Pr'): # prototype nodes: one partition per prototype feature
+		# EVEN THOUGH IT'S POSOSIBLE FOR THE BEST ALIGNMENT TO MIX ACROSS FEATURE SETS OF THE SAME LEVEL, FOR LARGER GRAPHS THIS IS HIGHLY UNLIKELY
+		# EXPERIMENTAL RESULTS SHOW GREATER ACCURACY BY PARTITIONING PROTOS BY FEATURE SETS, INSTEAD OF MERGED SOURCE LAYER SETS, DUE TO THIS UNLIKELIHOOD AND THE INCREASED 
+		# ANNEALING EFFICIENCY ACHIEVED BY THE SMALLER PARTITIONS
+		feature = node_metadata_dict[node_id]['feature_name']
+		feature = feature if 'filler' not in feature else get_layer_id(node_id)
+		return ('proto_' + feature, None)
+		# VERSION WITH MERGED FEATURES INTO SOURCE LAYER PARTITIONS
+		# 	source_layer_kind = node_metadata_dict[node_id]['source_layer_kind']
+		# 	return ('proto_' + source_layer_kind, None)
+	else: # instance nodes: one partition per layer kind e.g. P or S or C etc (fillers of that layer are included)
+		layer_id = get_layer_id(node_id)
+		hierarchical_layers = ['S']
+		if layer_id in hierarchical_layers:
+			sublevel = re.search(r'L(\d+)', node_id).group(1)
+			return ("inst_" + layer_id, sublevel)
+		return ("inst_" + layer_id, None)
+
+def get_node_partitions(idx_node_mapping, node_metadata_dict):
+	"""Partition idx_node_mapping into labeled sets."""
+	partitions = {}
+	for index, node_id in idx_node_mapping.items():
+		partition_name, layer = get_node_partition_info(node_id, node_metadata_dict)
+		hierarchical_layers = ['inst_S']
+
+		if partition_name not in partitions:
+				partitions[partition_name] = {} if partition_name in hierarchical_layers else []
+
+		if partition_name == 'inst_S': # segmentation possibly has a sub-hierarchy
+			if layer not in partitions[partition_name]:
+				partitions[partition_name][layer] = []
+			partitions[partition_name][layer].append(index)
+		else:
+			partitions[partition_name].append(index)
+	
+	return partitions
+
+# flattened (CSR-style) version of get_node_partitions so moves can be drawn with pure array indexing, e.g. for a whole batch of chains at once
+# partition_members[partition_ptr[k]:partition_ptr[k+1]] are the node indices in partition k (each S sub-level is its own partition),
+# partition_ids[i] is the partition of node i, and partition_pos[i] is the position of node i among its partition's members
+def get_partition_tables(node_partitions, n):
+	flat_partitions = []
+	for partition in node_partitions.values():
+		flat_partitions.extend(partition.values() if isinstance(partition, dict) else [partition])
+	
+	partition_ids = np.zeros(n, dtype=np.int64)
+	partition_pos = np.zeros(n, dtype=np.int64)
+	partition_ptr = np.zeros(len(flat_partitions) + 1, dtype=np.int64)
+	partition_members = np.zeros(n, dtype=np.int64)
+	for k, members in enumerate(flat_partitions):
+		start = partition_ptr[k]
+		partition_ptr[k + 1] = start + len(members)
+		partition_members[start:start + len(members)] = members
+		partition_ids[members] = k
+		partition_pos[members] = np.arange(len(members))
+	return partition_ids, partition_ptr, partition_members, partition_pos
+
+def make_partition_tables(idx_node_mapping, node_metadata_dict):
+	return get_partition_tables(get_node_partitions(idx_node_mapping, node_metadata_dict), len(idx_node_mapping))
+
+# draws one swap (i, j) within a partition, i.e. the scalar version of sample_partition_swaps_torch below (for GraphAlignmentAnnealer.move)
+# i is uniform over all nodes, and j is uniform over the other nodes in i's partition (or over all other nodes if i's partition is a singleton)
+def sample_partition_swap(partition_tables):
+	partition_ids, partition_ptr, partition_members, partition_pos = partition_tables
+	n = len(partition_ids)
+	i = random.randrange(n)
+	k = partition_ids[i]
+	start = partition_ptr[k]
+	size = partition_ptr[k + 1] - start
+	if size > 1:
+		r = random.randrange(size - 1)
+		if r >= partition_pos[i]: # skip over i itself
+			r += 1
+		return i, partition_members[start + r]
+	# Fallback to random selection if i is alone in its partition
+	return i, (i + 1 + random.randrange(n - 1)) % n
+
+# draws n_samples swaps (i, j) within partitions, with the same distribution as GraphAlignmentAnnealer.move:
+# i is uniform over all nodes, and j is uniform over the other nodes in i's partition (or over all other nodes if i's partition is a singleton)
+def sample_partition_swaps_torch(partition_tables, n_samples, device=None):
+	partition_ids, partition_ptr, partition_members, partition_pos = partition_tables
+	n = len(partition_ids)
+	i = torch.randint(n, (n_samples,), device=device)
+	start = partition_ptr[partition_ids[i]]
+	size = partition_ptr[partition_ids[i] + 1] - start
+
+	# uniform over the size - 1 other members, in float64 (in float32, rand * (size - 1) can round up to size - 1 itself on large partitions) and clamped, just in case
+	n_others = (size - 1).clamp(min=1)
+	r = torch.minimum((torch.rand(n_samples, device=device, dtype=torch.float64) * n_others).long(), n_others - 1)
+	r = r + (r >= partition_pos[i]).long() # skip over i itself
+	j = partition_members[(start + r).clamp(max=n - 1)]
+
+	j_fallback = (i + 1 + torch.randint(n - 1, (n_samples,), device=device)) % n
+	j = torch.where(size > 1, j, j_fallback)
+	return i, j
+
+'''
+Assignment based seeding for the Graph Alignment Annealer. Identity over the sorted union of node IDs is an arbitrary starting point for instance nodes, whose IDs
+embed per-piece indices, so instead we match the nodes of each partition by solving a linear assignment problem on cheap node signatures:
+out/in degree to each partition, normalized position within the node's level (by the N index in the node ID, among the nodes of that partition that are actually in the graph),
+and the set of prototype parents. The signatures are compared with the L1 (cityblock) distance
+'''
+def as_adjacency_numpy(A):
+	if isinstance(A, BitAdjacency):
+		return A.to_dense()
+	if isinstance(A, torch.Tensor):
+		return A.cpu().numpy()
+	return np.asarray(A)
+
+def get_node_positions(idx_node_mapping):
+	positions = np.zeros(len(idx_node_mapping))
+	for index, node_id in idx_node_mapping.items():
+		match = re.search(r'N(\d+(\.\d+)?)$', node_id) # matches ints and also decimal numbers (i.e. fillers)
+		if match:
+			positions[index] = float(match.group(1))
+	return positions
+
+def get_node_signatures(A, partition_tables, node_positions, proto_indices, position_weight=1.0):
+	partition_ids, partition_ptr, partition_members, _ = partition_tables
+	n = A.shape[0]
+	A = (A != 0).astype(np.float64)
+	partition_onehot = np.zeros((n, len(partition_ptr) - 1))
+	partition_onehot[np.arange(n), partition_ids] = 1
+	out_degrees = A @ partition_onehot
+	in_degrees = A.T @ partition_onehot
+
+	nonempty = np.any(A != 0, axis=0) | np.any(A != 0, axis=1) # dummy nodes (not in this graph) have no position
+	level_positions = np.zeros(n)
+	for k in range(len(partition_ptr) - 1):
+		members = partition_members[partition_ptr[k]:partition_ptr[k + 1]]
+		present = members[nonempty[members]]
+		if len(present) > 1:
+			present = present[np.argsort(node_positions[present], kind='stable')]
+			level_positions[present] = np.arange(len(present)) / (len(present) - 1)
+
+	proto_parents = A[proto_indices].T
+	return np.hstack([out_degrees, in_degrees, position_weight * level_positions[:, None], proto_parents])
+
+# returns an alignment (permutation vector) of A_G to A_g, see align_torch. Like the alignment annealer, this only permutes nodes within the same partition
+def assignment_seed_alignment(A_g, A_G, idx_node_mapping, node_metadata_dict, device=None, partition_tables=None, position_weight=1.0):
+	if partition_tables is None:
+		partition_tables = make_partition_tables(idx_node_mapping, node_metadata_dict)
+	A_g, A_G = as_adjacency_numpy(A_g), as_adjacency_numpy(A_G)
+	node_positions = get_node_positions(idx_node_mapping)
+	proto_indices = np.array(sorted(index for index, node_id in idx_node_mapping.items() if node_id.startswith('Pr')), dtype=np.int64)
+	signatures_g = get_node_signatures(A_g, partition_tables, node_positions, proto_indices, position_weight)
+	signatures_G = get_node_signatures(A_G, partition_tables, node_positions, proto_indices, position_weight)
+
+	_, partition_ptr, partition_members, _ = partition_tables
+	p = np.arange(A_g.shape[0])
+	for k in range(len(partition_ptr) - 1):
+		members = partition_members[partition_ptr[k]:partition_ptr[k + 1]]
+		if len(members) < 2:
+			continue
+		cost = cdist(signatures_g[members], signatures_G[members], metric='cityblock')
+		rows, cols = linear_sum_assignment(cost)
+		p[members[rows]] = members[cols] # centroid node members[row] gets aligned to node members[col] of G
+
+	# the signatures are only a heuristic, so keep the identity if it's actually closer
+	if np.sum((A_g - A_G[np.ix_(p, p)]) ** 2) > np.sum((A_g - A_G) ** 2):
+		p = np.arange(A_g.shape[0])
+	return torch.from_numpy(p.astype(np.int32)).to(device)
+
 '''
 This class contains the code for the simulated annealing procedure to compute the graph edit distance, from Section 4.2 of the paper
 The output is the optimal alignment between 2 graphs, which allows us to directly compute the structural distance (which is square root edit distance under optimal alignment)
 '''
 class GraphAlignmentAnnealer(Annealer):
-	def __init__(self, initial_alignment, A_g, A_G, centroid_idx_node_mapping, node_metadata_dict, device=None):
+	undo_moves = True # move() returns an undo token, so rejected swaps are swapped back in place instead of copying the alignment every step
+	# in delta energy mode, every resync_every moves (and on any move to squared dist 0) move() leaves dE to a full energy() recompute, which resyncs
+	# the incrementally updated squared dist with the aligned matrix, and the annealer's accumulated E with it (so E is exactly 0 for its early exit at 0)
+	resync_every = 100
+
+	def __init__(self, initial_alignment, A_g, A_G, centroid_idx_node_mapping, node_metadata_dict, device=None, delta_energy=True, partition_tables=None):
 		super(GraphAlignmentAnnealer, self).__init__(initial_alignment)
-		self.A_g = A_g
-		self.A_G = A_G
+		self.A_g = as_adjacency_torch(A_g, device)
+		self.A_G = as_adjacency_torch(A_G, device)
 		self.centroid_idx_node_mapping = centroid_idx_node_mapping
 		self.node_metadata_dict = node_metadata_dict
-		self.node_partitions = self.get_node_partitions()
 		self.device = device
+
+		# the partition of every node is worked out once here (or once per corpus by the caller, and passed in), so move() is just array indexing
+		if partition_tables is None:
+			partition_tables = make_partition_tables(centroid_idx_node_mapping, node_metadata_dict)
+		self.partition_tables = tuple(table.tolist() for table in partition_tables) # lists, since scalar indexing of lists is faster than of numpy arrays
+
+		# delta energy mode: we keep the current aligned matrix A_G[p][:, p] and its squared dist to A_g, and move() scores each swap
+		# by only looking at the 2 rows/cols it changes, returning dE directly to the annealer so energy() isn't called at every step
+		self.delta_energy = delta_energy
+		self.aligned_A_G = None
+		self.sq_dist = None
+		self.moves_since_resync = 0
+		# on the CPU, the deltas and the swaps of the aligned matrix go through numpy views of A_g and aligned_A_G (same memory), see swap_sq_dist_delta_numpy
+		self.numpy_swaps = self.A_g.device.type == 'cpu'
+		self.A_g_view = self.A_g.numpy() if self.numpy_swaps else self.A_g
+		self.aligned_A_G_view = None
 		
 	# this prevents us from printing out alignment annealing updates since this gets confusing when also doing centroid annealing
 	def default_update(self, step, T, E, acceptance, improvement):
 		return 
 	
-	# return: (partition name, sub-level (if any))
-	# partition name is the layer for instance nodes
 	def get_node_partition_info(self, node_id):
-		def get_layer_id(node_id):
-			for layer_id in ['S', 'P', 'K', 'C', 'M']:
-				if node_id.startswith(layer_id):
-					return layer_id
-			raise Exception("Invalid node", node_id)
-		
-		if node_id.startswith('Pr'): # prototype nodes: one partition per prototype feature
-			# EVEN THOUGH IT'S POSOSIBLE FOR THE BEST ALIGNMENT TO MIX ACROSS FEATURE SETS OF THE SAME LEVEL, FOR LARGER GRAPHS THIS IS HIGHLY UNLIKELY
-			# EXPERIMENTAL RESULTS SHOW GREATER ACCURACY BY PARTITIONING PROTOS BY FEATURE SETS, INSTEAD OF MERGED SOURCE LAYER SETS, DUE TO THIS UNLIKELIHOOD AND THE INCREASED 
-			# ANNEALING EFFICIENCY ACHIEVED BY THE SMALLER PARTITIONS
-			feature = self.node_metadata_dict[node_id]['feature_name']
-			feature = feature if 'filler' not in feature else get_layer_id(node_id)
-			return ('proto_' + feature, None)
-			# VERSION WITH MERGED FEATURES INTO SOURCE LAYER PARTITIONS
-			# 	source_layer_kind = self.node_metadata_dict[node_id]['source_layer_kind']
-			# 	return ('proto_' + source_layer_kind, None)
-		else: # instance nodes: one partition per layer kind e.g. P or S or C etc (fillers of that layer are included)
-			layer_id = get_layer_id(node_id)
-			hierarchical_layers = ['S']
-			if layer_id in hierarchical_layers:
-				sublevel = re.search(r'L(\d+)', node_id).group(1)
-				return ("inst_" + layer_id, sublevel)
-			return ("inst_" + layer_id, None)
+		return get_node_partition_info(node_id, self.node_metadata_dict)
 	
 	def get_node_partitions(self):
-		"""Partition centroid_idx_node_mapping into labeled sets."""
-		partitions = {}
-		for index, node_id in self.centroid_idx_node_mapping.items():
-			partition_name, layer = self.get_node_partition_info(node_id)
-			hierarchical_layers = ['inst_S']
-
-			if partition_name not in partitions:
-					partitions[partition_name] = {} if partition_name in hierarchical_layers else []
-	
-			if partition_name == 'inst_S': # segmentation possibly has a sub-hierarchy
-				if layer not in partitions[partition_name]:
-					partitions[partition_name][layer] = []
-				partitions[partition_name][layer].append(index)
-			else:
-				partitions[partition_name].append(index)
-		
-		return partitions
+		return get_node_partitions(self.centroid_idx_node_mapping, self.node_metadata_dict)
 
 	def move(self):
-		"""Swaps two rows in the n x n permutation matrix by permuting within valid sets (protype node class or individual level)"""
-		n = len(self.state)
-		i = random.randint(0, n - 1)
-		i_partition_name, i_sublevel = self.get_node_partition_info(self.centroid_idx_node_mapping[i])
-		j_options = None 
-		hierarchical_layers = ['inst_S']
+		"""Swaps two entries of the permutation vector by permuting within valid sets (protype node class or individual level)"""
+		i, j = sample_partition_swap(self.partition_tables)
+
+		if not self.delta_energy:
+			self.state[[i, j]] = self.state[[j, i]]  # Swap entries i and j
+			return None, (i, j, None)
+		
+		if self.aligned_A_G is None:
+			self.energy()
+
+		self.moves_since_resync += 1
+		if self.moves_since_resync >= self.resync_every:
+			self.state[[i, j]] = self.state[[j, i]]  # Swap entries i and j, the annealer's energy() call then realigns from scratch
+			return None, (i, j, self.sq_dist)
+
+		# swapping entries i and j of p swaps rows/cols i and j of A_G[p][:, p]
+		if self.numpy_swaps:
+			new_sq_dist = self.sq_dist + swap_sq_dist_delta_numpy(self.A_g_view, self.aligned_A_G_view, i, j)
+		else:
+			new_sq_dist = self.sq_dist + swap_sq_dist_delta_torch(self.A_g, self.aligned_A_G, i, j)
+		self.state[[i, j]] = self.state[[j, i]]  # Swap entries i and j
+		if new_sq_dist <= 0:
+			return None, (i, j, self.sq_dist)
+		dE = math.sqrt(new_sq_dist) - math.sqrt(self.sq_dist)
 
-		# Identify partition and find a random j within the same partition
-		if i_partition_name in hierarchical_layers and i_sublevel in self.node_partitions[i_partition_name]:
-			j_options = self.node_partitions[i_partition_name][i_sublevel]
-		elif i_partition_name:
-			j_options = self.node_partitions[i_partition_name]
-
-		# Ensure i is not equal to j
-		if j_options and len(j_options) > 1: # if a partition has only 1 element we have infinite loop
-			j = random.choice(j_options)
-			while j == i: 
-				j = random.choice(j_options)
+		self.swap_aligned_rows_and_cols(i, j)
+		undo_token = (i, j, self.sq_dist)
+		self.sq_dist = new_sq_dist
+		return dE, undo_token
+	
+	def swap_aligned_rows_and_cols(self, i, j):
+		if self.numpy_swaps:
+			swap_rows_and_cols_numpy(self.aligned_A_G_view, i, j)
 		else:
-			# Fallback to random selection if no suitable j is found
-			j = random.randint(0, n - 1)
-			while j == i:
-				j = random.randint(0, n - 1)
-		self.state[[i, j], :] = self.state[[j, i], :]  # Swap rows i and j
-
-	def energy(self): # i.e. cost, self.state represents the permutation/alignment matrix P
-		e = dist_torch(self.A_g, align_torch(self.state, self.A_G))
+			swap_rows_and_cols_torch(self.aligned_A_G, i, j)
+
+	# a swap is its own inverse, so we undo a rejected swap by doing it again (in the cached aligned matrix too)
+	def undo_move(self, undo_token):
+		i, j, prev_sq_dist = undo_token
+		self.state[[i, j]] = self.state[[j, i]]
+		if self.delta_energy:
+			self.swap_aligned_rows_and_cols(i, j)
+			self.sq_dist = prev_sq_dist
+
+	def energy(self): # i.e. cost, self.state represents the permutation/alignment vector p
+		aligned_A_G = align_torch(self.state, self.A_G)
+		e = dist_torch(self.A_g, aligned_A_G)
+		if self.delta_energy: # full recompute, so this (re)seeds the cache that move() then updates incrementally
+			self.aligned_A_G = aligned_A_G
+			self.aligned_A_G_view = aligned_A_G.numpy() if self.numpy_swaps else aligned_A_G
+			self.sq_dist = torch.sum((self.A_g - aligned_A_G) ** 2).item()
+			self.moves_since_resync = 0
 		# print("ENERGY", e)
 		return e
 
 '''
 For running the nested Graph Alignment Annealer at each step of the Centroid Annealing
 '''
-def get_alignments_to_centroid(A_g, listA_G, idx_node_mapping, node_metadata_dict, device=None, Tmax=2, Tmin=0.01, steps=2000):
+# assignment_seed starts each alignment from assignment_seed_alignment instead of the identity
+# partition_tables (optional) is make_partition_tables(idx_node_mapping, node_metadata_dict), for callers that already have them
+def get_alignments_to_centroid(A_g, listA_G, idx_node_mapping, node_metadata_dict, device=None, Tmax=2, Tmin=0.01, steps=2000, n_chains=None, pool=None, assignment_seed=False, partition_tables=None):
+	A_g = as_adjacency_torch(A_g, device)
+	listA_G = [as_adjacency_torch(A_G, device) for A_G in listA_G]
+
+	if pool is not None: # fan the (independent) per-graph alignments out over the worker processes, see AlignmentPool below
+		return pool.get_alignments_to_centroid(A_g, listA_G, device=device, Tmax=Tmax, Tmin=Tmin, steps=steps, n_chains=n_chains, assignment_seed=assignment_seed)
+
+	if partition_tables is None:
+		partition_tables = make_partition_tables(idx_node_mapping, node_metadata_dict) # same for every graph in the corpus
+	if assignment_seed:
+		initial_alignments = [assignment_seed_alignment(A_g, A_G, idx_node_mapping, node_metadata_dict, device=device, partition_tables=partition_tables) for A_G in listA_G]
+	else: # initial state is identity means we're doing the alignment with whatever A_G currently is
+		initial_alignments = [identity_alignment_torch(A_G.shape[0], device=device) for A_G in listA_G]
+
+	if n_chains is not None: # anneal all the graphs (with n_chains restarts each) together in the batched engine
+		batched_aligner = BatchedGraphAlignmentAnnealer(A_g, listA_G, idx_node_mapping, node_metadata_dict, n_chains=n_chains, initial_alignments=initial_alignments, device=device, partition_tables=partition_tables)
+		batched_aligner.Tmax = Tmax
+		batched_aligner.Tmin = Tmin
+		batched_aligner.steps = steps
+		alignments, losses, _ = batched_aligner.anneal()
+		return list(alignments), torch.mean(losses).item()
+
 	alignments = []
 	losses = []
 	for i, A_G in enumerate(listA_G): # for each graph in the corpus, find its best alignment with current centroid
-		# initial_state = cp.eye(cp.shape(A_G)[0]) # initial state is identity means we're doing the alignment with whatever A_G currently is
-		initial_state = torch.eye(A_G.shape[0], dtype=torch.float64, device=device)
-
-		graph_aligner = GraphAlignmentAnnealer(initial_state, A_g, A_G, idx_node_mapping, node_metadata_dict, device=device)
+		graph_aligner = GraphAlignmentAnnealer(initial_alignments[i], A_g, A_G, idx_node_mapping, node_metadata_dict, device=device, partition_tables=partition_tables)
 		graph_aligner.Tmax = Tmax
 		graph_aligner.Tmin = Tmin
 		graph_aligner.steps = steps
@@ -182,6 +491,216 @@ def get_alignments_to_centroid(A_g, listA_G, idx_node_mapping, node_metadata_dic
 
 	return alignments, np.mean(losses)
 
+'''
+Process pool for the nested alignments. The alignment of the centroid to each graph in the corpus is independent of the others, so
+get_alignments_to_centroid can run them in parallel, one graph per task, and gather the results back in corpus order.
+The pool is made once per corpus: idx_node_mapping and node_metadata_dict are sent to each worker a single time when it starts (which is also
+when each worker builds the partition tables), and the corpus/centroid tensors are moved to shared memory so the workers read them without a copy
+(they're read-only in the worker).
+For the centroid annealer, the corpus itself is sent to the workers once too (set_corpus, i.e. the graphs as the annealer got them, in shared memory),
+and then at each step align_corpus only sends the centroid and each graph's current alignment (a permutation vector), instead of the aligned graphs.
+torch_threads is the number of intra-op threads per worker, so n_workers * torch_threads should be at most the number of cores.
+We use spawn since fork isn't safe after torch has started its thread pool (and is required for CUDA)
+'''
+_worker_idx_node_mapping = None
+_worker_node_metadata_dict = None
+_worker_partition_tables = None
+_worker_barrier = None
+_worker_listA_G = None
+
+def _init_alignment_worker(idx_node_mapping, node_metadata_dict, torch_threads, barrier):
+	global _worker_idx_node_mapping, _worker_node_metadata_dict, _worker_partition_tables, _worker_barrier
+	_worker_idx_node_mapping = idx_node_mapping
+	_worker_node_metadata_dict = node_metadata_dict
+	_worker_partition_tables = make_partition_tables(idx_node_mapping, node_metadata_dict)
+	_worker_barrier = barrier
+	torch.set_num_threads(torch_threads)
+
+def _align_to_centroid_worker(A_g, A_G, device, Tmax, Tmin, steps, n_chains, assignment_seed):
+	alignments, loss = get_alignments_to_centroid(A_g, [A_G], _worker_idx_node_mapping, _worker_node_metadata_dict, device=device, Tmax=Tmax, Tmin=Tmin, steps=steps, n_chains=n_chains, assignment_seed=assignment_seed, partition_tables=_worker_partition_tables)
+	return alignments[0], loss
+
+# every worker has to take exactly one of these tasks, so each one waits for all the others before returning
+def _set_corpus_worker(listA_G):
+	global _worker_listA_G
+	_worker_listA_G = listA_G
+	_worker_barrier.wait()
+
+# aligns A_g to corpus graph k, as aligned by alignment
+def _align_to_corpus_worker(A_g, k, alignment, device, Tmax, Tmin, steps, n_chains):
+	A_G = align_torch(alignment.to(_worker_listA_G[k].device), _worker_listA_G[k])
+	return _align_to_centroid_worker(A_g, A_G, device, Tmax, Tmin, steps, n_chains, False)
+
+class AlignmentPool(object):
+	def __init__(self, idx_node_mapping, node_metadata_dict, n_workers=None, torch_threads=1):
+		if n_workers is None:
+			n_workers = max(1, multiprocessing.cpu_count() // torch_threads)
+		self.n_workers = n_workers
+		self.torch_threads = torch_threads
+		self.corpus = None
+		ctx = torch.multiprocessing.get_context('spawn')
+		self.pool = ctx.Pool(processes=n_workers, initializer=_init_alignment_worker, initargs=(idx_node_mapping, node_metadata_dict, torch_threads, ctx.Barrier(n_workers)))
+
+	def get_alignments_to_centroid(self, A_g, listA_G, device=None, Tmax=2, Tmin=0.01, steps=2000, n_chains=None, assignment_seed=False):
+		# share_memory_ is a no-op for tensors that are already shared (and for CUDA tensors, which go through CUDA IPC instead)
+		A_g.share_memory_()
+		for A_G in listA_G:
+			A_G.share_memory_()
+		results = self.pool.starmap(_align_to_centroid_worker, [(A_g, A_G, device, Tmax, Tmin, steps, n_chains, assignment_seed) for A_G in listA_G])
+		alignments = [alignment.to(device) if device is not None else alignment for alignment, _ in results]
+		losses = [loss for _, loss in results]
+		return alignments, np.mean(losses)
+
+	# same thing for a list of (A_g, A_G) pairs, i.e. the graphs aligned to several different centroids at once. returns the (alignment, loss) of each pair
+	def align_pairs(self, pairs, device=None, Tmax=2, Tmin=0.01, steps=2000, n_chains=None, assignment_seed=False):
+		for A_g, A_G in pairs:
+			A_g.share_memory_()
+			A_G.share_memory_()
+		results = self.pool.starmap(_align_to_centroid_worker, [(A_g, A_G, device, Tmax, Tmin, steps, n_chains, assignment_seed) for A_g, A_G in pairs])
+		return [(alignment.to(device) if device is not None else alignment, loss) for alignment, loss in results]
+
+	# sends listA_G to every worker, once, for align_corpus. the tensors are moved to shared memory, so they mustn't be changed in place after this
+	def set_corpus(self, listA_G):
+		if self.corpus is not None and len(self.corpus) == len(listA_G) and all(A_G is corpus_A_G for A_G, corpus_A_G in zip(listA_G, self.corpus)):
+			return
+		self.corpus = list(listA_G)
+		for A_G in self.corpus:
+			A_G.share_memory_()
+		self.pool.map(_set_corpus_worker, [self.corpus] * self.n_workers, chunksize=1)
+
+	# align_pairs for (A_g, k, alignment) triples, i.e. A_g aligned to align_torch(alignment, corpus[k]) for the corpus from set_corpus
+	# only A_g and the alignment vectors go to the workers. returns the (alignment, loss) of each triple, the alignment being on top of the given one
+	def align_corpus(self, triples, device=None, Tmax=2, Tmin=0.01, steps=2000, n_chains=None):
+		for A_g, _, _ in triples:
+			A_g.share_memory_()
+		results = self.pool.starmap(_align_to_corpus_worker, [(A_g, k, alignment, device, Tmax, Tmin, steps, n_chains) for A_g, k, alignment in triples])
+		return [(alignment.to(device) if device is not None else alignment, loss) for alignment, loss in results]
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+'''
+Batched version of the Graph Alignment Annealer: anneals the alignment of the centroid to each graph in listA_G, with n_chains independent
+restarts per graph, all at once. Every chain shares the same temperature schedule, so each step is a fixed number of batched tensor ops
+over all the chains (using the same O(n) swap delta as GraphAlignmentAnnealer), instead of one Python annealing step per chain
+'''
+class BatchedGraphAlignmentAnnealer(object):
+	# defaults, same as get_alignments_to_centroid
+	Tmax = 2
+	Tmin = 0.01
+	steps = 2000
+
+	def __init__(self, A_g, listA_G, centroid_idx_node_mapping, node_metadata_dict, n_chains=1, initial_alignments=None, device=None, partition_tables=None):
+		self.A_g = as_adjacency_torch(A_g, device)
+		self.listA_G = [as_adjacency_torch(A_G, device) for A_G in listA_G]
+		self.n_chains = n_chains
+		self.device = device
+		self.n = A_g.shape[0]
+		self.n_pairs = len(listA_G)
+		if partition_tables is None:
+			partition_tables = make_partition_tables(centroid_idx_node_mapping, node_metadata_dict)
+		self.partition_tables = tuple(torch.from_numpy(table).to(device) for table in partition_tables)
+
+		# chain c anneals the alignment to graph pair_idx[c]; all chains for the same graph start from its initial alignment (default identity)
+		self.pair_idx = torch.arange(self.n_pairs, device=device).repeat_interleave(n_chains)
+		if initial_alignments is None:
+			initial_alignments = [identity_alignment_torch(self.n, device=device)] * self.n_pairs
+		self.state = torch.stack(initial_alignments)[self.pair_idx].to(torch.int32) # (n_pairs * n_chains) x n permutation vectors
+
+	def energy(self): # squared dists of all the chains, and (re)computes the aligned matrices, i.e. align_torch batched over the chains
+		p = self.state.long()
+		self.aligned_A_G = torch.stack(self.listA_G)[self.pair_idx[:, None, None], p[:, :, None], p[:, None, :]]
+		self.sq_dist = torch.sum((self.A_g - self.aligned_A_G) ** 2, dim=(1, 2))
+		return self.sq_dist
+
+	# batched swap_sq_dist_delta_torch: the change in squared dist of chain c if we swap rows/cols i[c] and j[c] of its aligned matrix
+	def swap_sq_dist_deltas(self, i, j):
+		chains = torch.arange(len(i), device=self.device)
+		M = self.aligned_A_G
+		row_term = 2 * torch.sum((self.A_g[i] - self.A_g[j]) * (M[chains, i] - M[chains, j]), dim=1)
+		col_term = 2 * torch.sum((self.A_g[:, i].T - self.A_g[:, j].T) * (M[chains, :, i] - M[chains, :, j]), dim=1)
+
+		ij = torch.stack([i, j], dim=1)
+		A_block = self.A_g[ij[:, :, None], ij[:, None, :]]
+		M_block = M[chains[:, None, None], ij[:, :, None], ij[:, None, :]]
+		block_term = -torch.sum((A_block - A_block.flip(1)) * (M_block - M_block.flip(1)), dim=(1, 2)) \
+			- torch.sum((A_block - A_block.flip(2)) * (M_block - M_block.flip(2)), dim=(1, 2)) \
+			+ torch.sum((A_block - M_block.flip(1).flip(2)) ** 2, dim=(1, 2)) - torch.sum((A_block - M_block) ** 2, dim=(1, 2))
+		return row_term + col_term + block_term
+	
+	# batched swap_rows_and_cols_torch (and the swap in the permutation vector) for the given chains
+	def swap(self, chains, i, j):
+		p_i = self.state[chains, i].clone()
+		self.state[chains, i] = self.state[chains, j]
+		self.state[chains, j] = p_i
+		row_i = self.aligned_A_G[chains, i].clone()
+		self.aligned_A_G[chains, i] = self.aligned_A_G[chains, j]
+		self.aligned_A_G[chains, j] = row_i
+		col_i = self.aligned_A_G[chains, :, i].clone()
+		self.aligned_A_G[chains, :, i] = self.aligned_A_G[chains, :, j]
+		self.aligned_A_G[chains, :, j] = col_i
+
+	def anneal(self):
+		"""Minimizes the energy of all the chains by simulated annealing with the exponential schedule from Annealer.anneal
+
+		Returns
+		(alignments, energies, chain_stats): the best alignment and energy for each graph in listA_G over all its chains,
+		and per-chain stats (each an n_pairs x n_chains tensor)
+		"""
+		if self.Tmin <= 0.0:
+			raise Exception('Exponential cooling requires a minimum temperature greater than zero.')
+		Tfactor = -math.log(self.Tmax / self.Tmin)
+		n_total_chains = len(self.state)
+
+		sq_dist = self.energy().clone()
+		initial_sq_dist = sq_dist.clone()
+		best_sq_dist = sq_dist.clone()
+		best_state = self.state.clone()
+		accepts = torch.zeros(n_total_chains, device=self.device)
+		improves = torch.zeros(n_total_chains, device=self.device)
+
+		step = 0 # i.e. with steps = 0
+		for step in range(1, self.steps + 1):
+			if not torch.any(sq_dist > 0): # same as the early exit at energy 0 in Annealer.anneal, but we need every chain to get there
+				break
+			T = self.Tmax * math.exp(Tfactor * step / self.steps)
+			i, j = sample_partition_swaps_torch(self.partition_tables, n_total_chains, device=self.device)
+			new_sq_dist = sq_dist + self.swap_sq_dist_deltas(i, j)
+			dE = torch.sqrt(new_sq_dist.clamp(min=0)) - torch.sqrt(sq_dist)
+
+			# Metropolis criterion for each chain, and chains that are already at energy 0 stay there
+			accept = ((dE <= 0) | (torch.exp(-dE / T) >= torch.rand(n_total_chains, device=self.device))) & (sq_dist > 0)
+			accepted_chains = torch.nonzero(accept).flatten()
+			self.swap(accepted_chains, i[accepted_chains], j[accepted_chains])
+			sq_dist = torch.where(accept, new_sq_dist, sq_dist)
+			accepts += accept
+			improves += accept & (dE < 0)
+
+			improved = sq_dist < best_sq_dist
+			best_sq_dist = torch.where(improved, sq_dist, best_sq_dist)
+			best_state[improved] = self.state[improved]
+		
+		self.state = best_state
+		best_energy = torch.sqrt(best_sq_dist).view(self.n_pairs, self.n_chains)
+		best_chain = torch.argmin(best_energy, dim=1)
+		alignments = best_state.view(self.n_pairs, self.n_chains, self.n)[torch.arange(self.n_pairs, device=self.device), best_chain]
+		energies = best_energy[torch.arange(self.n_pairs, device=self.device), best_chain]
+
+		chain_stats = {
+			'initial_energy': torch.sqrt(initial_sq_dist).view(self.n_pairs, self.n_chains),
+			'best_energy': best_energy,
+			'acceptance': (accepts / max(step, 1)).view(self.n_pairs, self.n_chains),
+			'improvement': (improves / max(step, 1)).view(self.n_pairs, self.n_chains),
+		}
+		return alignments, energies, chain_stats
+
 '''
 The loss function for the centroid annealer (Equation 4a in paper) 
 '''
@@ -193,6 +712,8 @@ The loss function for the centroid annealer (Equation 4a in paper)
 # A large energy positive difference means very low acceptance probability (i.e. we don't want to accept a very bad state)
 # vs small positive energy difference has higher acceptance probability
 def loss_numpy(A_g, list_alignedA_G):
+	if isinstance(A_g, BitAdjacency):
+		return loss_bits(A_g, list_alignedA_G)
 	distances = np.array([dist_numpy(A_g, A_G) for A_G in list_alignedA_G])
 	return np.mean(distances) 
 
@@ -201,23 +722,92 @@ def loss_cupy(A_g, list_alignedA_G):
 	return cp.mean(distances) 
 
 def loss_torch(A_g, list_alignedA_G, device):
+	if isinstance(A_g, BitAdjacency):
+		return torch.tensor(loss_bits(A_g, list_alignedA_G), dtype=torch.float64, device=device)
 	distances = torch.tensor([dist_torch(A_g, A_G) for A_G in list_alignedA_G], device=device)
 	return torch.mean(distances)
 
+'''
+Vectorized version of the global constraints from Table 1 in the paper (see CentroidAnnealer.is_globlly_invalid_move), for all n x n node pairs at once.
+Whether flipping (s, t) is globally invalid only depends on the pair of nodes, EXCEPT for self-loops, where it also depends on the current state
+(we can always remove a self-loop but never add one), so the returned mask has the diagonal set to valid where the pair rules allow it and the
+caller needs to also check the centroid's diagonal
+'''
+def get_valid_flip_mask(idx_node_mapping, node_metadata_dict, device=None):
+	n = len(idx_node_mapping)
+	node_ids = [idx_node_mapping[i] for i in range(n)]
+	is_proto = np.array([node_id.startswith('Pr') for node_id in node_ids])
+
+	# proto -> inst is only valid if the instance nodes have the prototype's feature
+	features = sorted({node_metadata_dict[node_id]['feature_name'] for node_id in node_ids if node_id.startswith('Pr')})
+	feature_idx = {feature: k for k, feature in enumerate(features)}
+	proto_features = np.zeros((n, len(features)), dtype=bool)
+	inst_features = np.zeros((n, len(features)), dtype=bool)
+	for i, node_id in enumerate(node_ids):
+		if is_proto[i]:
+			proto_features[i, feature_idx[node_metadata_dict[node_id]['feature_name']]] = True
+		else:
+			for feature in node_metadata_dict[node_id]['features_dict'].keys():
+				if feature in feature_idx:
+					inst_features[i, feature_idx[feature]] = True
+	has_feature = (proto_features.astype(np.int64) @ inst_features.T.astype(np.int64)) > 0
+
+	# inst -> inst is only valid from the same level or from one level higher (i.e. 1 rank lower), see is_globlly_invalid_move
+	primary_rank = np.array([node_metadata_dict[node_id]['layer_rank'][0] for node_id in node_ids])
+	secondary_rank = np.array([node_metadata_dict[node_id]['layer_rank'][1] for node_id in node_ids])
+	rank_difference = np.where(primary_rank[:, None] == primary_rank[None, :], secondary_rank[:, None] - secondary_rank[None, :], primary_rank[:, None] - primary_rank[None, :])
+	adjacent_rank = (rank_difference == 0) | (rank_difference == -1)
+
+	source_proto, sink_proto = is_proto[:, None], is_proto[None, :]
+	valid = np.where(source_proto, ~sink_proto & has_feature, ~sink_proto & adjacent_rank)
+	return torch.from_numpy(valid).to(device)
+
 '''
 This class contains the code for the bi-level simulated annealing (SA) procedure from Section 5.1 of the paper
 '''
 class CentroidAnnealer(CustomCentroidAnnealer):
-	def __init__(self, initial_centroid, listA_G, centroid_idx_node_mapping, node_metadata_dict, device=None):
-		super(CentroidAnnealer, self).__init__(initial_centroid) # i.e. set initial self.state = initial_centroid
-		self.listA_G = listA_G
+	undo_moves = True # move() returns the flipped coord as its undo token, so a rejected flip is just flipped back instead of copying the centroid every step
+	candidate_batch_size = 100 # number of top scoring coords move() looks at first
+	alignment_batch_size = None # mini-batch mode: max number of graphs to re-align per step (None re-aligns every graph that needs it)
+	full_refresh_period = 50 # in mini-batch mode, re-align all the graphs that need it every this many steps
+	speculative_batch_size = None # speculative mode: number of top candidates move() evaluates at once (see speculative_move), only with an alignment_pool
+
+	# graph_weights (optional) weights each graph's dist in the loss, i.e. for centroids of centroids weighted by cluster size. they should be integers (i.e. counts)
+	# so that the move scores stay integers (see move)
+	# aligned_to_initial_centroid means listA_G is already aligned to initial_centroid (i.e. from a previous run), so only the graphs the first move makes stale get re-aligned
+	def __init__(self, initial_centroid, listA_G, centroid_idx_node_mapping, node_metadata_dict, device=None, alignment_pool=None, graph_weights=None, aligned_to_initial_centroid=False):
+		super(CentroidAnnealer, self).__init__(as_adjacency_torch(initial_centroid, device)) # i.e. set initial self.state = initial_centroid
+		self.listA_G = [as_adjacency_torch(A_G, device) for A_G in listA_G] # copy, since we update the aligned graphs in place
+		self.corpus_hash = adjacency_hash([self.state] + self.listA_G) # the problem we were given, before any alignment, for checkpoint_fingerprint
 		self.centroid_idx_node_mapping = centroid_idx_node_mapping
 		self.node_metadata_dict = node_metadata_dict
 		self.step = 0
-		self.k_rejected_moves_since_last_accept = []
+		self.rejected_moves_since_last_accept = []
 		self.last_accepted_move = None
 		self.prev_move = None
 		self.device = device
+		self.alignment_pool = alignment_pool # optional AlignmentPool, to run the nested alignments of the corpus in parallel
+		self.initial_listA_G = list(self.listA_G) # self.alignments are relative to these, which is also the corpus the pool's workers get (once)
+		if alignment_pool is not None:
+			alignment_pool.set_corpus(self.initial_listA_G)
+		# warm start state for the nested alignments: self.listA_G is always kept aligned to aligned_centroid (the centroid at the last energy() call),
+		# and self.alignments[k] is the composite alignment of the original listA_G[k] to it, i.e. self.listA_G[k] == align_torch(self.alignments[k], listA_G[k])
+		self.aligned_centroid = None
+		self.sq_dists = [None] * len(self.listA_G) # squared dist of each graph (under its current alignment) to the centroid
+		self.alignments = [identity_alignment_torch(A_G.shape[0], device=device) for A_G in listA_G]
+		self.best_alignments = None # self.alignments when best_state was found (see set_best)
+		if aligned_to_initial_centroid: # listA_G is already (optimally) aligned to initial_centroid, so we don't need to re-align it at the first step
+			self.aligned_centroid = self.state.clone()
+			self.sq_dists = [torch.sum((self.state - A_G) ** 2).item() for A_G in self.listA_G]
+		self.stale_alignments = set() # graphs whose alignment may no longer be optimal for the current centroid
+		self.graph_weights = [1] * len(self.listA_G) if graph_weights is None else list(graph_weights)
+		self.total_weight = sum(self.graph_weights)
+		self.energy_calls = 0
+		self.pending_evaluation = None # speculative mode: the evaluation of the proposed centroid, for energy() to install
+		self.accepted_energy = None
+		self.last_energy = None
+		self.valid_flip_mask = get_valid_flip_mask(centroid_idx_node_mapping, node_metadata_dict, device=self.state.device) # pairs that pass the Table 1 constraints
+		self.init_score_matrix()
 
 	# this prevents us from printing out annealing updates 
 	# def default_update(self, step, T, E, acceptance, improvement):
@@ -275,111 +865,325 @@ class CentroidAnnealer(CustomCentroidAnnealer):
 		
 		return False
 	
+	'''
+	Score matrix for the move: score[s, t] = sum_k |g[s, t] - A_k[s, t]| over the aligned corpus, i.e. how many graphs disagree with the centroid at (s, t)
+	For 0/1 matrices this is K - count[s, t] where the centroid has the edge and count[s, t] where it doesn't, with count = sum_k A_k
+	(with graph weights w_k, it's the total weight that disagrees: sum_k w_k - count[s, t] or count[s, t], with count = sum_k w_k * A_k)
+	We keep both up to date incrementally instead of rebuilding them over the whole corpus at every step: a flip of the centroid only changes score[s, t],
+	and re-aligning graph k only changes count (and score) in the rows/cols that its alignment actually moved
+	'''
+	def get_scores(self, state, counts):
+		return torch.where(state != 0, self.total_weight - counts, counts)
+
+	def init_score_matrix(self):
+		self.count_matrix = sum(weight * A_G for weight, A_G in zip(self.graph_weights, self.listA_G))
+		self.score_matrix = self.get_scores(self.state, self.count_matrix)
+		self.scored_state = self.state # the base annealer can replace self.state (i.e. with best_state at the end of anneal()), then we need to rescore
+
+	def update_count_matrix(self, old_A_G, new_A_G, alignment, weight=1):
+		n = len(alignment)
+		moved = alignment != torch.arange(n, device=alignment.device)
+		if not bool(moved.any()):
+			return
+		moved = moved.to(self.count_matrix.device)
+		rows = torch.nonzero(moved).flatten()
+		self.count_matrix[rows] += weight * (new_A_G[rows] - old_A_G[rows])
+		self.score_matrix[rows] = self.get_scores(self.state[rows], self.count_matrix[rows])
+		# cols, for the rows we didn't just update
+		other_rows = torch.nonzero(~moved).flatten()[:, None]
+		self.count_matrix[other_rows, rows] += weight * (new_A_G[other_rows, rows] - old_A_G[other_rows, rows])
+		self.score_matrix[other_rows, rows] = self.get_scores(self.state[other_rows, rows], self.count_matrix[other_rows, rows])
+
+	'''
+	Checkpointing (see CustomCentroidAnnealer.checkpoint_path): on top of the base annealer's state, we keep the aligned corpus and its alignments,
+	the alignment caches and the torch RNG, so a resumed run continues exactly like the uninterrupted one would have
+	The count and score matrices are just sums over the aligned corpus, so we rebuild them instead of saving them, and the centroids and the aligned corpus are 0/1 so we save them as bool (1/8 the size)
+	The fingerprint (see CustomCentroidAnnealer.checkpoint_fingerprint) also has n, K, a hash of the initial centroid and the corpus, and the move params, so a leftover checkpoint
+	from another corpus (or other params) is never resumed
+	'''
+	def checkpoint_fingerprint(self):
+		fingerprint = super(CentroidAnnealer, self).checkpoint_fingerprint()
+		fingerprint.update({
+			'n': self.state.shape[0],
+			'K': len(self.listA_G),
+			'corpus_hash': self.corpus_hash,
+			'graph_weights': tuple(self.graph_weights),
+			'params': (self.candidate_batch_size, self.alignment_batch_size, self.full_refresh_period, self.speculative_batch_size),
+		})
+		return fingerprint
+
+	def get_checkpoint(self):
+		checkpoint = super(CentroidAnnealer, self).get_checkpoint()
+		checkpoint.update({
+			'state': self.state.to(torch.bool),
+			'best_state': self.best_state.to(torch.bool) if self.best_state is not None else None,
+			'listA_G': [A_G.to(torch.bool) for A_G in self.listA_G],
+			'alignments': self.alignments,
+			'best_alignments': self.best_alignments,
+			'aligned_centroid': self.aligned_centroid.to(torch.bool) if self.aligned_centroid is not None else None,
+			'sq_dists': self.sq_dists,
+			'stale_alignments': self.stale_alignments,
+			'energy_calls': self.energy_calls,
+			'step': self.step,
+			'prev_move': self.prev_move,
+			'accepted_energy': self.accepted_energy,
+			'last_energy': self.last_energy,
+			'torch_rng_state': torch.get_rng_state(),
+			'cuda_rng_states': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+		})
+		return checkpoint
+
+	def set_checkpoint(self, checkpoint):
+		dtype = self.state.dtype
+		super(CentroidAnnealer, self).set_checkpoint(checkpoint)
+		self.state = self.state.to(dtype)
+		self.best_state = self.best_state.to(dtype) if self.best_state is not None else None
+		self.listA_G = [A_G.to(self.state.dtype) for A_G in checkpoint['listA_G']]
+		self.alignments = checkpoint['alignments']
+		self.best_alignments = checkpoint['best_alignments']
+		self.aligned_centroid = checkpoint['aligned_centroid'].to(self.state.dtype) if checkpoint['aligned_centroid'] is not None else None
+		self.sq_dists = checkpoint['sq_dists']
+		self.stale_alignments = checkpoint['stale_alignments']
+		self.energy_calls = checkpoint['energy_calls']
+		self.step = checkpoint['step']
+		self.prev_move = checkpoint['prev_move']
+		self.accepted_energy = checkpoint['accepted_energy']
+		self.last_energy = checkpoint['last_energy']
+		self.pending_evaluation = None
+		torch.set_rng_state(checkpoint['torch_rng_state'].cpu())
+		if checkpoint['cuda_rng_states'] is not None and torch.cuda.is_available():
+			torch.cuda.set_rng_state_all([rng_state.cpu() for rng_state in checkpoint['cuda_rng_states']])
+		self.init_score_matrix()
+
+	# self.alignments follow the last centroid energy() evaluated, which after a rejected move or at the end of anneal() isn't best_state anymore,
+	# so we keep a copy of the ones that go with best_state (the alignment tensors get replaced, never updated in place, so a shallow copy is enough)
+	def set_best(self, E):
+		super(CentroidAnnealer, self).set_best(E)
+		self.best_alignments = list(self.alignments)
+
+	def dump_checkpoint(self, checkpoint, fh):
+		torch.save(checkpoint, fh)
+
+	def read_checkpoint(self, fh):
+		return torch.load(fh, map_location=self.device, weights_only=False) # map_location, so a job can resume on a different device
+
+	def flip(self, source_idx, sink_idx):
+		self.state[source_idx, sink_idx] = 1 - self.state[source_idx, sink_idx]
+		self.score_matrix[source_idx, sink_idx] = self.total_weight - self.score_matrix[source_idx, sink_idx]
+
 	'''
 	This function contains the logic for the move at each step of the simulated annealing, as explicated in detail in Section 5.1 (particularly, in Algorithm 2) in the paper
 	We make 1 change to the centroid (i.e. self.state) at each step of the move
 	'''
 	def move(self):
-		diff_matrices = torch.abs(torch.stack([self.state - A_G for A_G in self.listA_G]))
-		score_matrix = torch.sum(diff_matrices, dim=0)
-
-		# Flatten the score matrix. this is UNSORTED
-		flat_scores = score_matrix.flatten()
-		
-		# flat_indices_sorted_by_score = cp.argsort(flat_scores)[::-1]
-		flat_indices_sorted_by_score = torch.argsort(flat_scores, descending=True)
-
-		valid_move_found = False
-		batch_size = 100
-		next_batch_start_index = 0 # index in flat_indices_sorted_by_score
-		current_score = None
-		# go through flat_indices_sorted_by_score in batches (batch num is num of unique scores)
-		# since flat_indices_sorted_by_score is VERY VERY LARGE and takes way too long to go through all of it
-		# while not valid_move_found and next_batch_start_index < len(flat_indices_sorted_by_score):
-		while not valid_move_found and next_batch_start_index < len(flat_indices_sorted_by_score):
-			print("next_batch_start_index", next_batch_start_index, "len(flat_indices_sorted_by_score)", len(flat_indices_sorted_by_score))
-			batch_start_idx, batch_end_idx = next_batch_start_index, min(next_batch_start_index + batch_size, len(flat_indices_sorted_by_score))
-			next_batch_start_index = batch_end_idx
-
-			batch = flat_indices_sorted_by_score[batch_start_idx:batch_end_idx]
-			batch = batch.cpu().numpy() # convert from tensor to CPU numpy so we can iterate through it
-
-			# dict to group score matrix indices in the current batch by score
-			score_index_mapping = defaultdict(list)
-			for flat_index in batch:
-				score = flat_scores[flat_index]
-				score = score.item() # when score is a tensor we need to extract the value
-				# print("FLAT INDEX", flat_index, "NEW  SCORE", score, "CURR SCORE", current_score, "NUM SCORES", len(score_index_mapping), "SCORES EQUAL", score == current_score)
-				if score != current_score:
-					current_score = score
-				score_index_mapping[score].append(flat_index)
-			# print("BATCH SCORES", score_index_mapping.items())
-
-			unique_scores_descending = sorted(score_index_mapping.keys(), reverse=True) # highest -> lowest score
-			# randomly shuffle the indices for each score partition, so we're trying a more variable set of moves that equally/most contribute to the loss
-			# this helps the annear be less stuck and explore a wider variety of equally possible moves
-			batch_flat_indices_sorted_by_score_and_shuffled = [] 
-			for score in unique_scores_descending:
-				indices = score_index_mapping[score]
-				random.shuffle(indices) # Shuffle indices in the current score partition
-				batch_flat_indices_sorted_by_score_and_shuffled.extend(indices)
-
-			index_within_batch = 0
-			while not valid_move_found and index_within_batch < len(batch_flat_indices_sorted_by_score_and_shuffled):
-				flat_index = batch_flat_indices_sorted_by_score_and_shuffled[index_within_batch]
-	
-				# NOTE: uncomment the version (cp, torch, np) that matches the architecture we're running this on
-				# coord = cp.unravel_index(flat_index, score_matrix.shape)
-				# coord = torch.unravel_index(flat_index, score_matrix.shape)
-				coord = np.unravel_index(flat_index, score_matrix.shape) # it's ok if score_matrix.shape is of type torch.shape bc this is still a tuple of ints
-				# print("SCORE", flat_scores[flat_index])
-				source_idx, sink_idx = coord
-				source_idx, sink_idx = source_idx.item(), sink_idx.item() # for when source_idx, sink_idx are tensors, we need to unpack
-				
-				move_not_globally_invalid = not self.is_globlly_invalid_move(source_idx, sink_idx, self.centroid_idx_node_mapping)
-				have_not_already_tried_move = coord not in self.k_rejected_moves_since_last_accept
-				is_not_undoing_last_accept = coord != self.last_accepted_move
-				
-				if is_not_undoing_last_accept and have_not_already_tried_move and move_not_globally_invalid:
-					valid_move_found = True
-				else:
-					index_within_batch += 1
-			# print("BATCH ATTEMPT INDEX", index_within_batch)
-
-		if valid_move_found:
-			print("Flat index", flat_index)
+		self.move_decision = None
+		if self.speculative_batch_size is not None:
+			if self.alignment_pool is not None:
+				return self.speculative_move()
+			warnings.warn("speculative_batch_size is set without an alignment_pool, so its candidates would be aligned one after the other: using the normal move() instead")
+		candidates = self.get_candidate_moves(1)
+		if len(candidates) > 0:
+			coord = candidates[0]
+			source_idx, sink_idx = coord
 			print("Coord", coord, "State at coord", self.state[source_idx, sink_idx])
-			print("Most recent k=5 rejected moves since last accept", self.k_rejected_moves_since_last_accept)
+			print("Rejected moves since last accept", self.rejected_moves_since_last_accept)
 			print("Last accepted move", self.last_accepted_move)
-			self.state[source_idx, sink_idx] = 1 - self.state[source_idx, sink_idx] 
+			self.flip(source_idx, sink_idx)
 			self.prev_move = coord
 			self.step += 1
+			return None, coord
 		else:
 			print("No valid move found.")
+			return None, None
+
+	# the (up to) n_moves best valid coords to flip, best first, that we haven't already tried since the last accept and that don't undo the last accept
+	def get_candidate_moves(self, n_moves):
+		if self.state is not self.scored_state:
+			self.score_matrix = self.get_scores(self.state, self.count_matrix)
+			self.scored_state = self.state
+		n = self.state.shape[0]
+
+		# we want the (valid) coord with the highest score, and we randomly shuffle coords with the same score, so we're trying a more variable set of moves
+		# that equally/most contribute to the loss. this helps the annealer be less stuck and explore a wider variety of equally possible moves
+		# the scores are integers, so adding noise in [0, 0.5) shuffles the coords within each score without changing the order between scores
+		keys = self.score_matrix + 0.5 * torch.rand(self.score_matrix.shape, dtype=self.score_matrix.dtype, device=self.score_matrix.device)
+		# mask out the globally invalid flips, so we never even look at them. on the diagonal we can remove self-loops (state 1) but never add them
+		valid = self.valid_flip_mask.clone()
+		valid.diagonal().logical_and_(torch.diagonal(self.state) != 0)
+		keys = torch.where(valid, keys, torch.full_like(keys, -math.inf)).flatten()
+		n_valid = int(valid.sum())
+
+		# most of the top scoring coords are valid, so we only take the top candidate_batch_size coords and take more (doubling) only if we don't have enough
+		moves = []
+		n_checked = 0
+		n_candidates = min(max(self.candidate_batch_size, n_moves), n_valid)
+		while len(moves) < n_moves and n_checked < n_valid:
+			candidates = torch.topk(keys, n_candidates).indices.cpu().tolist() # sorted by key, highest first
+			for flat_index in candidates[n_checked:]:
+				coord = divmod(flat_index, n)
+				have_not_already_tried_move = coord not in self.rejected_moves_since_last_accept
+				is_not_undoing_last_accept = coord != self.last_accepted_move
+				if is_not_undoing_last_accept and have_not_already_tried_move:
+					moves.append(coord)
+					if len(moves) == n_moves:
+						break
+			n_checked = n_candidates
+			n_candidates = min(2 * n_candidates, n_valid)
+		return moves
 
 	'''
-	This is the energy of the Centroid Annealer (Equation 5 in paper)
-	We use the Graph Alignment Annealer to find the optimal alignments between current centroid and each STG in corpus (this is the nested simulated annealing step)
-	Once we have the optimal alignments, we can compute the loss
+	Speculative mode (speculative_batch_size is set): most proposals get rejected, and the annealer would try them one at a time, re-aligning the corpus for each one.
+	Instead we take the top speculative_batch_size candidates at once and evaluate all their energies together (with alignment_pool, all their nested alignments
+	run concurrently, each warm started from the current aligned corpus), then run the Metropolis test on them in order, the same as if they'd been proposed one by one,
+	and propose the first accepted one. The candidates before it go straight to the rejected moves, without costing a step each.
+	If none is accepted, we propose the last one as rejected. Either way we've already made the decision, so we tell the anneal loop with move_decision,
+	and energy() just installs the alignments we already computed for the proposed centroid.
+	Without alignment_pool the candidates' alignments would run one after the other, i.e. speculative_batch_size times the work of a step, so move() doesn't use this then
 	'''
-	def energy(self): # i.e. cost, self.state represents the current centroid g
+	def speculative_move(self):
+		if self.prev_move_accepted or self.accepted_energy is None:
+			self.accepted_energy = self.last_energy # i.e. the anneal loop's prevEnergy, the energy of the current state
+		candidates = self.get_candidate_moves(self.speculative_batch_size)
+		if len(candidates) == 0:
+			print("No valid move found.")
+			return None, None
+
+		centroids = []
+		for source_idx, sink_idx in candidates:
+			centroid = self.state.clone()
+			centroid[source_idx, sink_idx] = 1 - centroid[source_idx, sink_idx]
+			centroids.append(centroid)
+		evaluations = self.evaluate_centroids(centroids)
+
+		for i, (coord, evaluation) in enumerate(zip(candidates, evaluations)):
+			dE = evaluation['loss'] - self.accepted_energy
+			accepted = dE <= 0.0 or math.exp(-dE / self.T) >= random.random()
+			if accepted or i == len(candidates) - 1:
+				break
+			self.rejected_moves_since_last_accept.append(coord)
+		print("Speculative candidates", candidates, "proposing", coord, "accepted" if accepted else "rejected")
+
+		self.move_decision = 'accept' if accepted else 'reject'
+		self.pending_evaluation = evaluation
+		self.flip(*coord)
+		self.prev_move = coord
+		self.step += 1
+		return None, coord
+
+	def undo_move(self, undo_token):
+		if undo_token is not None:
+			self.flip(*undo_token)
+
+	'''
+	The centroid changes by one flip per move (or more, when we go back to prevState after a rejected move), so most of the corpus doesn't need to be re-aligned.
+	If every entry where the centroid changed since the last alignment now AGREES with the aligned graph there, the distance with the current alignment dropped by
+	exactly the number of changed entries, and no other alignment can have dropped by more, so the current alignment is still the best one and we can skip that graph
+	Otherwise the graph is marked stale (its alignment may no longer be optimal). Either way, we update its squared dist under its current alignment by +-1 per changed entry
+	This doesn't change any of the annealer's state, it returns the (stale_alignments, sq_dists) we'd have for centroid
+	'''
+	def get_stale_alignments(self, centroid):
+		if self.aligned_centroid is None:
+			return set(range(len(self.listA_G))), list(self.sq_dists)
+		stale_alignments = set(self.stale_alignments)
+		sq_dists = list(self.sq_dists)
+		changed = torch.nonzero(centroid != self.aligned_centroid, as_tuple=True)
+		if len(changed[0]) == 0:
+			return stale_alignments, sq_dists
+		new_values = centroid[changed]
+		old_values = self.aligned_centroid[changed]
+		for k, A_G in enumerate(self.listA_G):
+			values = A_G[changed]
+			agrees = values == new_values
+			if not bool(agrees.all()):
+				stale_alignments.add(k)
+			sq_dists[k] += int((~agrees).sum()) - int((values != old_values).sum())
+		return stale_alignments, sq_dists
+
+	# Alignment annealer params Tmax and steps are dynamic based on the current temperature ratio for the centroid
+	# They get narrower as we get an increasingly more accurate centroid that's easier to align
+	def get_alignment_schedule(self):
 		current_temp_ratio = (self.T - self.Tmin) / (self.Tmax - self.Tmin)
 		initial_Tmax = 1
 		final_Tmax = 0.05
 		initial_steps = 500
 		final_steps = 5
-		
-		# Alignment annealer params Tmax and steps are dynamic based on the current temperature ratio for the centroid
-		# They get narrower as we get an increasingly more accurate centroid that's easier to align
 		alignment_Tmax = initial_Tmax * current_temp_ratio + final_Tmax * (1 - current_temp_ratio)
-		alignment_steps = int(initial_steps * current_temp_ratio + final_steps * (1 - current_temp_ratio)) 
-		
-		# run the nested alignment annealer
-		alignments, _ = get_alignments_to_centroid(self.state, self.listA_G, self.centroid_idx_node_mapping, self.node_metadata_dict, device=self.device, Tmax=alignment_Tmax, Tmin=0.01, steps=alignment_steps)
+		alignment_steps = int(initial_steps * current_temp_ratio + final_steps * (1 - current_temp_ratio))
+		return alignment_Tmax, alignment_steps
 
-		# Align the corpus to the current centroid
-		self.listA_G = list(map(align_torch, alignments, self.listA_G))
-		l = loss_torch(self.state, self.listA_G, self.device) 
+	'''
+	Runs the nested alignment annealer for each of centroids, only for the graphs whose optimal alignment may have changed since the last energy() call,
+	and returns what energy() would get for each one (the new alignments and dists, and the loss), without changing any of the annealer's state
+	The alignment annealer starts from the identity on the already aligned graph, i.e. it's warm started from the previous best alignment
+	In mini-batch mode (alignment_batch_size is set) we only re-align a random sample of alignment_batch_size of the stale graphs at each step, and the rest keep their
+	cached alignments (and dists) until they're sampled, or until the full refresh every full_refresh_period steps, where we re-align all the stale graphs
+	'''
+	def evaluate_centroids(self, centroids):
+		alignment_Tmax, alignment_steps = self.get_alignment_schedule()
+		is_full_refresh = self.aligned_centroid is None or self.alignment_batch_size is None or self.energy_calls % self.full_refresh_period == 0
+
+		evaluations = []
+		for centroid in centroids:
+			stale_alignments, sq_dists = self.get_stale_alignments(centroid)
+			realign_indices = sorted(stale_alignments)
+			if not is_full_refresh and len(realign_indices) > self.alignment_batch_size:
+				realign_indices = sorted(random.sample(realign_indices, self.alignment_batch_size))
+			evaluations.append({'centroid': centroid, 'stale_alignments': stale_alignments, 'sq_dists': sq_dists, 'realign_indices': realign_indices})
+
+		if self.alignment_pool is not None:
+			# the workers have the corpus (see AlignmentPool.set_corpus), so each task is the centroid and the graph's current alignment, i.e. self.listA_G[k]
+			# in speculative mode, the nested alignments of all the candidates go to the pool together, so they all run concurrently
+			triples = [(evaluation['centroid'], k, self.alignments[k]) for evaluation in evaluations for k in evaluation['realign_indices']]
+			results = self.alignment_pool.align_corpus(triples, device=self.device, Tmax=alignment_Tmax, Tmin=0.01, steps=alignment_steps)
+			start = 0
+			for evaluation in evaluations:
+				end = start + len(evaluation['realign_indices'])
+				evaluation['alignments'] = [alignment for alignment, _ in results[start:end]]
+				start = end
+		else:
+			for evaluation in evaluations:
+				evaluation['alignments'] = []
+				if len(evaluation['realign_indices']) > 0:
+					evaluation['alignments'], _ = get_alignments_to_centroid(evaluation['centroid'], [self.listA_G[k] for k in evaluation['realign_indices']], self.centroid_idx_node_mapping, self.node_metadata_dict, device=self.device, Tmax=alignment_Tmax, Tmin=0.01, steps=alignment_steps)
+
+		weights = torch.tensor(self.graph_weights, dtype=torch.float64, device=self.device)
+		for evaluation in evaluations:
+			evaluation['aligned_A_G'] = []
+			for k, alignment in zip(evaluation['realign_indices'], evaluation['alignments']):
+				aligned_A_G = align_torch(alignment, self.listA_G[k])
+				evaluation['aligned_A_G'].append(aligned_A_G)
+				evaluation['sq_dists'][k] = torch.sum((evaluation['centroid'] - aligned_A_G) ** 2).item()
+				evaluation['stale_alignments'].discard(k)
+			# same as loss_torch(centroid, aligned listA_G, self.device) (weighted by graph_weights), from the cached squared dists
+			dists = torch.sqrt(torch.tensor(evaluation['sq_dists'], dtype=torch.float64, device=self.device))
+			evaluation['loss'] = torch.sum(weights * dists) / self.total_weight
+		return evaluations
+
+	# Align the corpus to the evaluated centroid, which has to be the current self.state
+	def install_evaluation(self, evaluation):
+		for k, alignment, aligned_A_G in zip(evaluation['realign_indices'], evaluation['alignments'], evaluation['aligned_A_G']):
+			self.update_count_matrix(self.listA_G[k], aligned_A_G, alignment, self.graph_weights[k])
+			self.listA_G[k] = aligned_A_G
+			self.alignments[k] = self.alignments[k][alignment.to(self.alignments[k].device)]
+		self.sq_dists = evaluation['sq_dists']
+		self.stale_alignments = evaluation['stale_alignments']
+		self.aligned_centroid = self.state.clone()
+
+	'''
+	This is the energy of the Centroid Annealer (Equation 5 in paper)
+	We use the Graph Alignment Annealer to find the optimal alignments between current centroid and each STG in corpus (this is the nested simulated annealing step)
+	Once we have the optimal alignments, we can compute the loss
+	'''
+	def energy(self): # i.e. cost, self.state represents the current centroid g
+		# speculative_move() may have already evaluated this centroid
+		evaluation = self.pending_evaluation
+		self.pending_evaluation = None
+		if evaluation is None or not torch.equal(evaluation['centroid'], self.state):
+			evaluation = self.evaluate_centroids([self.state])[0]
+		self.energy_calls += 1
+		self.install_evaluation(evaluation)
+		l = evaluation['loss']
+		self.last_energy = l
 		print("LOSS", l)
 		return l
 
@@ -406,13 +1210,13 @@ if __name__ == "__main__":
 		alignments, _ = get_alignments_to_centroid(A_g, listA_G, centroid_idx_node_mapping, node_metadata_dict, device=device)
 		for i, alignment in enumerate(alignments):
 			file_name = f'{test_dir}/alignment_{i}.txt'
-			np.savetxt(file_name, alignment.to(torch.int).cpu().numpy(), fmt='%i', delimiter=",")
+			np.savetxt(file_name, alignment.cpu().numpy(), fmt='%i', delimiter=",")
 			print(f'Saved: {file_name}')
 
 		alignments = []
 		for i in range(len(listA_G)):
 			alignments.append(np.loadtxt(f'{test_dir}/alignment_{i}.txt', dtype=int, delimiter=","))
-		alignments = [torch.tensor(alignment, device=device, dtype=torch.float64) for alignment in alignments]
+		alignments = [as_alignment_torch(alignment, device=device) for alignment in alignments]
 		aligned_listA_G = list(map(align_torch, alignments, listA_G))
 
 		centroid_annealer = CentroidAnnealer(A_g, aligned_listA_G, centroid_idx_node_mapping, node_metadata_dict, device=device)
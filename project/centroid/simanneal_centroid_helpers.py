@@ -1,9 +1,36 @@
 import numpy as np
 import networkx as nx 
 import re 
+import scipy.sparse as sp
 import z3_matrix_projection_helpers as z3_helpers
+from bit_adjacency import BitAdjacency
+
+# edge index arrays (sources, sinks) of G in the node space of node_idx_mapping, i.e. the COO form of its padded adjacency matrix
+def graph_edge_index(G, node_idx_mapping):
+  n_edges = G.number_of_edges()
+  sources = np.fromiter((node_idx_mapping[source] for source, _ in G.edges()), dtype=np.int64, count=n_edges)
+  sinks = np.fromiter((node_idx_mapping[sink] for _, sink in G.edges()), dtype=np.int64, count=n_edges)
+  return sources, sinks
+
+# n x n 0/1 adjacency matrix from the edge index arrays, in one scatter
+def edges_to_adj_matrix(sources, sinks, n, matrix_format='dense'):
+  if matrix_format == 'bits':
+    return BitAdjacency.from_edges(sources, sinks, n)
+  if matrix_format == 'csr':
+    A = sp.csr_matrix((np.ones(len(sources)), (sources, sinks)), shape=(n, n))
+    A.sum_duplicates()
+    A.data[:] = 1
+    return A
+  A = np.zeros((n, n))
+  A[sources, sinks] = 1 # Since all STGs are directed this ONLY handles the directed case
+  return A
+
+# matrix_format='bits' returns bit_adjacency.BitAdjacency matrices (1 bit per potential edge) instead of dense float64 numpy matrices,
+# and 'csr' returns scipy.sparse csr matrices
+def pad_adj_matrices(graphs, matrix_format='dense'):
+  if matrix_format not in ['dense', 'bits', 'csr']:
+    raise ValueError("Invalid matrix format", matrix_format)
 
-def pad_adj_matrices(graphs):
   all_nodes = set()
   nodes_features_dict = {}
   for G in graphs:
@@ -19,58 +46,145 @@ def pad_adj_matrices(graphs):
   new_adj_matrices = []
   
   for G in graphs:
-    size = len(sorted_nodes)
-    new_A = np.zeros((size, size))
-    for node in G.nodes():
-      for neighbor in G.neighbors(node):
-        new_A[node_idx_mapping[node], node_idx_mapping[neighbor]] = 1 # Since all STGs are directed this ONLY handles the directed case
-    new_adj_matrices.append(new_A)
+    sources, sinks = graph_edge_index(G, node_idx_mapping)
+    new_adj_matrices.append(edges_to_adj_matrix(sources, sinks, len(sorted_nodes), matrix_format))
   return new_adj_matrices, idx_node_mapping, nodes_features_dict
 
+# Canonical node IDs, so the padded node space doesn't grow with the corpus. Instance node IDs embed piece specific labels and indices (e.g. S3L1N7, C1,5QD7N4, M-6N2),
+# so in pad_adj_matrices the union of the node IDs (and so n) grows with every piece. Instead, we give each instance node a slot by its level and its position in that level
+# in its own piece (by its index, so fillers stay in between the nodes around them), e.g. the 4th node of segmentation sub-level 1 is SL1N4 and the 7th melody node is MN7.
+# Then the union over the corpus is just the max number of nodes per level, i.e. the padded matrices are sized by the largest piece, not the whole corpus.
+# Prototype IDs are already a shared feature:value vocabulary (e.g. PrQuality:M), so we keep them as they are.
+# The canonical IDs keep the layer prefixes (and the L sub-level for segmentation), the filler marker (e.g. PfillerN3) and end in N<position>, which is what the partitioning,
+# the flip constraints, the z3 projection and the assignment seeding read from the node IDs. Fillers are still numbered by their position in the whole level, so their slots
+# stay in between the slots around them. Each slot's metadata has the layer rank of its level and the union of the feature names of the nodes in that slot, with no values:
+# different pieces have different values in the same slot, and those stay in the pieces (through label_maps, see canonical_feature_values)
+def get_canonical_node_ids(G):
+  levels = {}
+  for node_id in G.nodes():
+    if node_id.startswith('Pr'):
+      continue
+    layer_id = node_id[0]
+    sublevel = re.search(r'L(\d+)', node_id).group(1) if layer_id == 'S' else None
+    levels.setdefault((layer_id, sublevel), []).append(node_id)
+
+  # position in the level: the node's index, or the N index in its ID if it doesn't have one (i.e. a centroid from adj_matrix_to_graph, which may already be canonical)
+  def level_position(node_id):
+    if 'index' in G.nodes[node_id]:
+      return float(G.nodes[node_id]['index'])
+    match = re.search(r'N(\d+(\.\d+)?)$', node_id)
+    return float(match.group(1)) if match else 0.0
+
+  canonical_ids = {node_id: node_id for node_id in G.nodes() if node_id.startswith('Pr')}
+  for (layer_id, sublevel), node_ids in levels.items():
+    node_ids = sorted(node_ids, key=lambda node_id: (level_position(node_id), node_id))
+    prefix = layer_id + ('L' + sublevel if sublevel is not None else '')
+    for position, node_id in enumerate(node_ids):
+      filler = 'filler' if 'filler' in node_id else ''
+      canonical_ids[node_id] = f"{prefix}{filler}N{position + 1}"
+  return canonical_ids
+
+# same as pad_adj_matrices but in the canonical node space (see get_canonical_node_ids)
+# also returns label_maps, where label_maps[k] maps the canonical IDs of graphs[k] back to its original node IDs (whose metadata, i.e. labels, are in graphs[k])
+def pad_adj_matrices_canonical(graphs, matrix_format='dense'):
+  canonical_graphs = []
+  label_maps = []
+  canonical_metadata_dict = {}
+  for G in graphs:
+    canonical_ids = get_canonical_node_ids(G)
+    canonical_graphs.append(nx.relabel_nodes(G, canonical_ids, copy=True))
+    label_maps.append({canonical_id: node_id for node_id, canonical_id in canonical_ids.items()})
+    for node_id, canonical_id in canonical_ids.items():
+      data_dict = G.nodes[node_id]
+      if canonical_id.startswith('Pr'):
+        canonical_metadata_dict[canonical_id] = {k: v for k, v in data_dict.items() if k in ['feature_name', 'source_layer_kind', 'layer_rank']}
+        continue
+      metadata = canonical_metadata_dict.setdefault(canonical_id, {'features_dict': {}, 'layer_rank': data_dict['layer_rank']})
+      for feature in data_dict.get('features_dict', {}).keys():
+        metadata['features_dict'][feature] = None
+
+  adj_matrices, idx_node_mapping, _ = pad_adj_matrices(canonical_graphs, matrix_format=matrix_format)
+  return adj_matrices, idx_node_mapping, canonical_metadata_dict, label_maps
+
+# the feature values of each canonical slot over the pieces, i.e. canonical ID -> feature -> set of the values of that feature in the nodes of graphs (via label_maps) in that slot
+# values that are None (the pieces are themselves canonical centroids) are kept as None, which means any value
+def canonical_feature_values(graphs, label_maps):
+  feature_values = {}
+  for G, label_map in zip(graphs, label_maps):
+    for canonical_id, node_id in label_map.items():
+      if canonical_id.startswith('Pr'):
+        continue
+      slot_values = feature_values.setdefault(canonical_id, {})
+      for feature, value in G.nodes[node_id].get('features_dict', {}).items():
+        slot_values.setdefault(feature, set()).add(value)
+  return feature_values
+
+# re-embeds A (indexed by idx_node_mapping) into the node space of node_idx_mapping (by node ID), which has to contain all of A's nodes
+# i.e. to add graphs with new nodes to a padded corpus without re-padding it
+def embed_adj_matrix(A, idx_node_mapping, node_idx_mapping):
+  embedded_idx = np.array([node_idx_mapping[idx_node_mapping[i]] for i in range(A.shape[0])], dtype=np.int64)
+  new_A = np.zeros((len(node_idx_mapping), len(node_idx_mapping)))
+  new_A[np.ix_(embedded_idx, embedded_idx)] = A
+  return new_A
+
+# A can be dense, BitAdjacency or scipy.sparse. we take the edges straight from the nonzero entries (in row major order, like a loop over (i, j) would)
 def adj_matrix_to_graph(A, idx_node_mapping, node_metadata_dict):
   G = nx.DiGraph()
 
-  non_dummy_nodes = set()
-  for i in range(A.shape[0]):
-    for j in range(A.shape[1]):
-      source = idx_node_mapping[i]
-      sink = idx_node_mapping[j] 
-      if A[i, j] > 0:
-        G.add_edge(source, sink)
-        non_dummy_nodes.update([source, sink])
+  if isinstance(A, BitAdjacency):
+    sources, sinks = A.nonzero()
+  elif sp.issparse(A):
+    A = sp.csr_matrix(A)
+    A.sort_indices()
+    sources, sinks = (A > 0).nonzero()
+  else:
+    sources, sinks = np.nonzero(np.asarray(A) > 0)
+  node_ids = [idx_node_mapping[i] for i in range(A.shape[0])]
+  G.add_edges_from(zip([node_ids[i] for i in sources], [node_ids[j] for j in sinks]))
   
-  # Add the remaining dummy nodes
-  all_nodes = set(idx_node_mapping.values())
-  remaining_nodes = all_nodes - non_dummy_nodes
-  for node_id in remaining_nodes:
-      G.add_node(node_id)
-
-  for node_id in G.nodes():
-    G.nodes[node_id].update(node_metadata_dict.get(node_id))
-    G.nodes[node_id]['label'] = node_id # not using pretty labels for testing
+  # Add the remaining dummy nodes, and the metadata of all the nodes
+  def node_attributes(node_id):
+    attributes = dict(node_metadata_dict.get(node_id))
+    attributes['label'] = node_id # not using pretty labels for testing
     match = re.search(r'N(\d+(\.\d+)?)$', node_id) # matches ints and also decimal numbers
     if match:
-      index = float(match.group(1))
-      G.nodes[node_id]['index'] = index
+      attributes['index'] = float(match.group(1))
+    return attributes
+  G.add_nodes_from((node_id, node_attributes(node_id)) for node_id in node_ids)
 
   return G
 
+# these work on both dense matrices and BitAdjacency matrices
+def nonempty_node_mask(A): # at least 1 incoming or outgoing edge
+  if isinstance(A, BitAdjacency):
+    return A.nonempty_node_mask()
+  return np.any(A != 0, axis=0) | np.any(A != 0, axis=1)
+
+def submatrix(A, indices): # A[indices][:, indices]
+  if isinstance(A, BitAdjacency):
+    return A.take(indices)
+  return A[indices][:, indices]
+
 def remove_all_dummy_nodes(A, idx_node_mapping):
-  non_dummy_indices = list(np.where(np.any(A != 0, axis=0) | np.any(A != 0, axis=1))[0]) # NOTE: the sort order here is nondeterministic!!!
-  self_loop_indices = list(np.where(np.diag(A) != 0)[0]) # we consider these dummys (these will only be protos by construction from our constraints, and all non-dummy nodes have constraints preventing self-loops)
+  non_dummy_indices = list(np.where(nonempty_node_mask(A))[0]) # NOTE: the sort order here is nondeterministic!!!
+  diagonal = A.diagonal() if isinstance(A, BitAdjacency) else np.diag(A)
+  self_loop_indices = list(np.where(diagonal != 0)[0]) # we consider these dummys (these will only be protos by construction from our constraints, and all non-dummy nodes have constraints preventing self-loops)
   non_dummy_indices += self_loop_indices
 
   for idx in self_loop_indices: # double check we have no forbidden self-loops
-    if np.count_nonzero(A[idx]) > 1 and np.count_nonzero(A[:, idx]) > 1:
+    row_count, col_count = (A.row_count(idx), A.col_count(idx)) if isinstance(A, BitAdjacency) else (np.count_nonzero(A[idx]), np.count_nonzero(A[:, idx]))
+    if row_count > 1 and col_count > 1:
       raise Exception("Self-loop found in non-dummy node", idx_node_mapping[idx])
 
-  filtered_matrix = A[non_dummy_indices][:, non_dummy_indices]
+  filtered_matrix = submatrix(A, non_dummy_indices)
   updated_mapping = {new_idx: idx_node_mapping[old_idx] for new_idx, old_idx in enumerate(non_dummy_indices)}
   return filtered_matrix, updated_mapping
 
-def remove_unnecessary_dummy_nodes(A, idx_node_mapping, node_metadata_dict):
+# feature_values (optional) is node ID -> feature -> the possible values of that feature, for node spaces where a node doesn't have a single value per feature
+# (i.e. canonical slots, see canonical_feature_values). otherwise the values are the ones in node_metadata_dict. a value of None keeps all the protos of the feature
+def remove_unnecessary_dummy_nodes(A, idx_node_mapping, node_metadata_dict, feature_values=None):
   node_idx_mapping = z3_helpers.invert_dict(idx_node_mapping)
-  non_dummy_indices = np.where(np.any(A != 0, axis=0) | np.any(A != 0, axis=1))[0] # at least 1 incoming or outgoing edges, i.e. node isn't zero-artiy/dummy
+  non_dummy_indices = np.where(nonempty_node_mask(A))[0] # at least 1 incoming or outgoing edges, i.e. node isn't zero-artiy/dummy
   
   # add ONLY the possible prototypes, dummy or not
   # we do not add all prototypes blindly, just those for feature VALUES that appear in the non-dummy instance nodes
@@ -80,19 +194,24 @@ def remove_unnecessary_dummy_nodes(A, idx_node_mapping, node_metadata_dict):
   for non_dummy_index in non_dummy_indices:
     node_id = idx_node_mapping[non_dummy_index]
     if z3_helpers.is_instance(node_id):
-      for feature, value in node_metadata_dict[node_id]['features_dict'].items():
+      if feature_values is not None:
+        node_feature_values = feature_values.get(node_id, {})
+      else:
+        node_feature_values = {feature: [value] for feature, value in node_metadata_dict[node_id]['features_dict'].items()}
+      for feature, values in node_feature_values.items():
         all_proto_ids_for_feature = prototype_features_partition[feature]
-        filtered_proto_ids = list(filter(lambda proto: str(value) in proto, all_proto_ids_for_feature))
+        if None in values:
+          filtered_proto_ids = all_proto_ids_for_feature
+        else:
+          filtered_proto_ids = list(filter(lambda proto: any(str(value) in proto for value in values), all_proto_ids_for_feature))
         proto_node_indices.update([node_idx_mapping[proto_id] for proto_id in filtered_proto_ids])
   # proto_node_indices = [proto_node_idx for proto_node_idx, proto_node_id in idx_node_mapping.items() if z3_helpers.is_proto(proto_node_id)] # ALL the prototypes (dummy or not)
   
   filtered_indices = list(set(non_dummy_indices) | proto_node_indices)
-  filtered_matrix = A[filtered_indices][:, filtered_indices]
+  filtered_matrix = submatrix(A, filtered_indices)
   updated_mapping = {new_idx: idx_node_mapping[old_idx] for new_idx, old_idx in enumerate(filtered_indices)}
   return filtered_matrix, updated_mapping
 
-# Generates random n x n permutation alignment matrix
+# Generates random alignment (i.e. permutation vector) of n nodes
 def random_alignment(n):
-	perm_indices = np.random.permutation(n)
-	identity = np.eye(n)
-	return identity[perm_indices]
\ No newline at end of file
+	return np.random.permutation(n).astype(np.int32)
\ No newline at end of file
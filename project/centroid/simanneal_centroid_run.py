@@ -1,14 +1,27 @@
 import simanneal_centroid
+import simanneal_centroid_helpers
 import multiprocessing
+import math
 import numpy as np
 # import cupy as cp
 import torch
 
-def align_graph_pair(A_G1, A_G2, idx_node_mapping, node_metadata_dict, Tmax = 1.75, Tmin = 0.01, steps = 2000, device=None):
+# n_chains > 1 runs that many independent annealing restarts together in the batched engine, and returns the best one
+# assignment_seed starts the annealing from simanneal_centroid.assignment_seed_alignment instead of the identity
+def align_graph_pair(A_G1, A_G2, idx_node_mapping, node_metadata_dict, Tmax = 1.75, Tmin = 0.01, steps = 2000, device=None, n_chains=1, assignment_seed=False):
 	if A_G1.shape != A_G2.shape:
 		raise ValueError("Graphs must be of the same size to align.")
-	# initial_state = np.eye(np.shape(A_G1)[0]) # or A_G2
-	initial_state = torch.eye(A_G1.shape[0], dtype=torch.float64, device=device)
+	if assignment_seed:
+		initial_state = simanneal_centroid.assignment_seed_alignment(A_G1, A_G2, idx_node_mapping, node_metadata_dict, device=device)
+	else:
+		initial_state = simanneal_centroid.identity_alignment_torch(A_G1.shape[0], device=device)
+	if n_chains > 1:
+		graph_aligner = simanneal_centroid.BatchedGraphAlignmentAnnealer(A_G1, [A_G2], idx_node_mapping, node_metadata_dict, n_chains=n_chains, initial_alignments=[initial_state], device=device)
+		graph_aligner.Tmax = Tmax
+		graph_aligner.Tmin = Tmin 
+		graph_aligner.steps = steps 
+		alignments, costs, _ = graph_aligner.anneal()
+		return alignments[0], costs[0]
 	graph_aligner = simanneal_centroid.GraphAlignmentAnnealer(initial_state, A_G1, A_G2, idx_node_mapping, node_metadata_dict, device=device)#, client, cluster)
 	graph_aligner.Tmax = Tmax
 	graph_aligner.Tmin = Tmin 
@@ -18,18 +31,179 @@ def align_graph_pair(A_G1, A_G2, idx_node_mapping, node_metadata_dict, Tmax = 1.
 
 # find the graph in the corpus that has the overall minimum loss to all the other graphs in the corpus,
 # along with its optimal alignments
-def initial_centroid_and_alignments(listA_G, index_node_mapping, node_metadata_dict, device=None):
-	min_loss = np.inf
-	min_loss_A_G = None
+# pool is an optional simanneal_centroid.AlignmentPool, to align the pairs in parallel
+def initial_centroid_and_alignments(listA_G, index_node_mapping, node_metadata_dict, device=None, pool=None, assignment_seed=False, prune=True):
+	for A_g in listA_G:
+		assert isinstance(A_g, torch.Tensor) # Ensure that A_g is a tensor (comment out if we're not doing multiprocess)
+	return pairwise_medoid(listA_G, index_node_mapping, node_metadata_dict, device=device, pool=pool, assignment_seed=assignment_seed, prune=prune)
+
+'''
+Medoid of the corpus from the pairwise alignments. The dist is symmetric, and if p aligns graph j to graph i then its inverse aligns i to j
+(simanneal_centroid.invert_alignment_torch), so we only anneal each unordered pair once (never the diagonal), and get the other direction by inverting.
+We go through the candidates row by row, aligning the pairs of each row that we don't have yet (a chunk of them at a time in parallel, with pool).
+With prune, we also stop a row early once its partial sum of dists, plus a lower bound on the dists still missing, reaches the best complete row so far:
+for 0/1 matrices the squared dist is at least the difference in the number of edges, whatever the alignment. We start with the candidates with the smallest
+lower bound on their total, since they're the most likely to be the medoid, and a good early medoid prunes the rest more.
+Returns the same as initial_centroid_and_alignments: (medoid, medoid index, medoid loss, alignments of the corpus to the medoid)
+'''
+def pairwise_medoid(listA_G, idx_node_mapping, node_metadata_dict, device=None, pool=None, assignment_seed=False, prune=True, Tmax=2, Tmin=0.01, steps=2000):
+	K = len(listA_G)
+	n_edges = torch.tensor([float(torch.count_nonzero(A_G)) for A_G in listA_G], dtype=torch.float64)
+	lower_bounds = torch.sqrt(torch.abs(n_edges[:, None] - n_edges[None, :])) # lower_bounds[i, j] <= dist(i, j)
+	chunk_size = pool.n_workers if pool is not None else 1
+
+	pair_alignments = {} # (i, j) with i < j -> alignment of graph j to graph i
+	pair_dists = {}
+	def dist(i, j):
+		return pair_dists[(min(i, j), max(i, j))]
+
+	min_dist_sum = np.inf
+	medoid_idx = None
+	for i in torch.argsort(lower_bounds.sum(dim=1)).tolist():
+		missing = [j for j in range(K) if j != i and (min(i, j), max(i, j)) not in pair_dists]
+		dist_sum = sum(dist(i, j) for j in range(K) if j != i and (min(i, j), max(i, j)) in pair_dists)
+		remaining_bound = float(sum(lower_bounds[i, j] for j in missing))
+		pruned = prune and dist_sum + remaining_bound >= min_dist_sum
+		for start in range(0, len(missing), chunk_size):
+			if pruned:
+				break
+			chunk = missing[start:start + chunk_size]
+			alignments, _ = simanneal_centroid.get_alignments_to_centroid(listA_G[i], [listA_G[j] for j in chunk], idx_node_mapping, node_metadata_dict, device, Tmax=Tmax, Tmin=Tmin, steps=steps, pool=pool, assignment_seed=assignment_seed)
+			for j, alignment in zip(chunk, alignments):
+				d = simanneal_centroid.dist_torch(listA_G[i], simanneal_centroid.align_torch(alignment, listA_G[j])).item()
+				if i < j:
+					pair_alignments[(i, j)] = alignment
+				else:
+					pair_alignments[(j, i)] = simanneal_centroid.invert_alignment_torch(alignment)
+				pair_dists[(min(i, j), max(i, j))] = d
+				dist_sum += d
+				remaining_bound -= float(lower_bounds[i, j])
+			pruned = prune and dist_sum + remaining_bound >= min_dist_sum
+		if not pruned and dist_sum < min_dist_sum:
+			min_dist_sum = dist_sum
+			medoid_idx = i
+
 	optimal_alignments = []
+	for j in range(K):
+		if j == medoid_idx:
+			optimal_alignments.append(simanneal_centroid.identity_alignment_torch(listA_G[j].shape[0], device=device))
+		elif medoid_idx < j:
+			optimal_alignments.append(pair_alignments[(medoid_idx, j)])
+		else:
+			optimal_alignments.append(simanneal_centroid.invert_alignment_torch(pair_alignments[(j, medoid_idx)]))
+	return listA_G[medoid_idx], medoid_idx, min_dist_sum / K, optimal_alignments
 
-	for i, A_g in enumerate(listA_G):
-		assert isinstance(A_g, torch.Tensor) # Ensure that A_g is a tensor (comment out if we're not doing multiprocess)
-		alignments, current_loss = simanneal_centroid.get_alignments_to_centroid(A_g, listA_G, index_node_mapping, node_metadata_dict, device, Tmax=2, Tmin=0.01, steps=2000)
-		if current_loss < min_loss:
-			min_loss = current_loss
-			min_loss_A_G = A_g
-			min_loss_A_G_list_index = i
-			optimal_alignments = alignments
-
-	return min_loss_A_G, min_loss_A_G_list_index, min_loss, optimal_alignments
+# approximate centroid of a list of STGs, i.e. the same pipeline as generate_centroid in the experiments (initial centroid and alignments, then centroid annealing)
+# returns the centroid as an STG (with the unnecessary dummy nodes removed) and its loss. weights are optional integer weights for each graph in the loss
+# canonical_node_ids pads in the canonical (level, position) node space (simanneal_centroid_helpers.pad_adj_matrices_canonical), so n is the size of the largest graph
+# instead of the union of all the node IDs. the centroid's instance nodes then have canonical IDs too
+def approx_centroid(graphs, weights=None, device=None, Tmax=2.5, Tmin=0.05, steps=1000, pool=None, canonical_node_ids=False):
+	if len(graphs) == 1:
+		return graphs[0], 0.0
+	feature_values = None
+	if canonical_node_ids:
+		listA_G, idx_node_mapping, node_metadata_dict, label_maps = simanneal_centroid_helpers.pad_adj_matrices_canonical(graphs)
+		feature_values = simanneal_centroid_helpers.canonical_feature_values(graphs, label_maps)
+	else:
+		listA_G, idx_node_mapping, node_metadata_dict = simanneal_centroid_helpers.pad_adj_matrices(graphs)
+	listA_G = [torch.tensor(A_G, device=device, dtype=torch.float64) for A_G in listA_G]
+	initial_centroid, _, _, initial_alignments = initial_centroid_and_alignments(listA_G, idx_node_mapping, node_metadata_dict, device=device, pool=pool)
+	aligned_listA_G = list(map(simanneal_centroid.align_torch, initial_alignments, listA_G))
+
+	centroid_annealer = simanneal_centroid.CentroidAnnealer(initial_centroid.clone(), aligned_listA_G, idx_node_mapping, node_metadata_dict, device=device, alignment_pool=pool, graph_weights=weights)
+	centroid_annealer.Tmax = Tmax
+	centroid_annealer.Tmin = Tmin
+	centroid_annealer.steps = steps
+	centroid, loss = centroid_annealer.anneal()
+	centroid, centroid_idx_node_mapping = simanneal_centroid_helpers.remove_unnecessary_dummy_nodes(centroid.cpu().numpy(), idx_node_mapping, node_metadata_dict, feature_values=feature_values)
+	return simanneal_centroid_helpers.adj_matrix_to_graph(centroid, centroid_idx_node_mapping, node_metadata_dict), loss.item()
+
+def _init_centroid_worker(torch_threads):
+	torch.set_num_threads(torch_threads)
+
+def _approx_centroid_worker(graphs, weights, device, Tmax, Tmin, steps, canonical_node_ids):
+	return approx_centroid(graphs, weights=weights, device=device, Tmax=Tmax, Tmin=Tmin, steps=steps, canonical_node_ids=canonical_node_ids)
+
+'''
+Hierarchical centroid (centroid of centroids) for corpora that are too large for a single union node space.
+We partition the corpus into clusters of at most cluster_size graphs, compute the approximate centroid of each cluster in parallel (one cluster per worker process),
+and then repeat on the cluster centroids until there are at most cluster_size of them left, whose centroid is the result.
+So the padded matrices (and the nested alignments) are only ever over the union of at most cluster_size graphs.
+With weight_by_cluster_size, each cluster centroid counts as many times as the number of corpus graphs it represents in the loss of the level above.
+clusters (optional) is a list of lists of indices into graphs for the first level; otherwise we split the corpus in order, into balanced chunks
+canonical_node_ids is passed on to approx_centroid at every level
+Returns (centroid STG, loss of the top level centroid to the centroids below it)
+'''
+def hierarchical_centroid(graphs, cluster_size=10, clusters=None, weight_by_cluster_size=True, n_workers=None, torch_threads=1, device=None, Tmax=2.5, Tmin=0.05, steps=1000, canonical_node_ids=False):
+	if cluster_size < 2:
+		raise ValueError("cluster_size must be at least 2")
+	weights = [1] * len(graphs)
+	if n_workers is None:
+		n_workers = max(1, multiprocessing.cpu_count() // torch_threads)
+	ctx = torch.multiprocessing.get_context('spawn') # same as simanneal_centroid.AlignmentPool
+
+	while len(graphs) > cluster_size or clusters is not None:
+		if clusters is None:
+			n_clusters = math.ceil(len(graphs) / cluster_size)
+			clusters = [list(cluster) for cluster in np.array_split(np.arange(len(graphs)), n_clusters)]
+		cluster_args = []
+		for cluster in clusters:
+			cluster_weights = [weights[i] for i in cluster] if weight_by_cluster_size else None
+			cluster_args.append(([graphs[i] for i in cluster], cluster_weights, device, Tmax, Tmin, steps, canonical_node_ids))
+		print(f"Computing {len(clusters)} cluster centroids of {len(graphs)} graphs")
+
+		with ctx.Pool(processes=min(n_workers, len(clusters)), initializer=_init_centroid_worker, initargs=(torch_threads,)) as pool:
+			results = pool.starmap(_approx_centroid_worker, cluster_args)
+		graphs = [centroid for centroid, _ in results]
+		weights = [sum(weights[i] for i in cluster) for cluster in clusters]
+		clusters = None
+
+	return approx_centroid(graphs, weights=weights if weight_by_cluster_size else None, device=device, Tmax=Tmax, Tmin=Tmin, steps=steps, canonical_node_ids=canonical_node_ids)
+
+'''
+Online centroid update for when we add pieces to a corpus, instead of recomputing the centroid from scratch (i.e. K^2 initial alignments and a full centroid annealing run)
+Takes the existing approximate centroid (and its node mapping, i.e. the one saved by generate_centroid), the existing padded corpus listA_G (and its idx_node_mapping)
+with the alignments of each graph to the centroid, and the new graphs. We extend the union node space with the new nodes (re-embedding everything by node ID),
+only align the NEW graphs to the centroid, and then run a short centroid annealing refinement where the old graphs start out aligned, so they only get re-aligned
+when a move could change their optimal alignment
+Returns the refined centroid (with the unnecessary dummy nodes removed) and its node mapping, the new padded corpus, its alignments to the centroid and idx_node_mapping
+(i.e. the inputs for the next update), the merged node metadata, and the loss
+'''
+def update_centroid(centroid, centroid_idx_node_mapping, listA_G, alignments, idx_node_mapping, node_metadata_dict, new_graphs, device=None, Tmax=0.5, Tmin=0.05, steps=100, assignment_seed=True, pool=None):
+	# mappings loaded from json have string keys
+	centroid_idx_node_mapping = {int(idx): node_id for idx, node_id in centroid_idx_node_mapping.items()}
+	idx_node_mapping = {int(idx): node_id for idx, node_id in idx_node_mapping.items()}
+
+	new_listA_G, new_idx_node_mapping, new_node_metadata_dict = simanneal_centroid_helpers.pad_adj_matrices(new_graphs)
+	node_metadata_dict = {**node_metadata_dict, **new_node_metadata_dict}
+	all_nodes = set(idx_node_mapping.values()) | set(centroid_idx_node_mapping.values()) | set(new_idx_node_mapping.values())
+	node_idx_mapping = {node_id: i for i, node_id in enumerate(sorted(all_nodes))} # sorted, same as pad_adj_matrices
+	updated_idx_node_mapping = {i: node_id for node_id, i in node_idx_mapping.items()}
+
+	def embed(A, mapping):
+		A = A.cpu().numpy() if isinstance(A, torch.Tensor) else np.asarray(A)
+		return torch.tensor(simanneal_centroid_helpers.embed_adj_matrix(A, mapping, node_idx_mapping), device=device, dtype=torch.float64)
+	centroid = embed(centroid, centroid_idx_node_mapping)
+	listA_G = [embed(A_G, idx_node_mapping) for A_G in listA_G]
+	def embed_alignment(alignment): # alignment vectors (or legacy permutation matrices), as tensors or loaded from the alignment files
+		alignment = alignment.cpu().numpy() if isinstance(alignment, torch.Tensor) else simanneal_centroid.as_alignment_torch(alignment).numpy()
+		return torch.tensor(simanneal_centroid.embed_alignment_numpy(alignment, idx_node_mapping, node_idx_mapping), device=device)
+	alignments = [embed_alignment(alignment) for alignment in alignments]
+	new_listA_G = [embed(A_G, new_idx_node_mapping) for A_G in new_listA_G]
+
+	# only the new graphs get aligned from scratch
+	new_alignments, _ = simanneal_centroid.get_alignments_to_centroid(centroid, new_listA_G, updated_idx_node_mapping, node_metadata_dict, device=device, pool=pool, assignment_seed=assignment_seed)
+	listA_G = listA_G + new_listA_G
+	alignments = alignments + list(new_alignments)
+	aligned_listA_G = list(map(simanneal_centroid.align_torch, alignments, listA_G))
+
+	centroid_annealer = simanneal_centroid.CentroidAnnealer(centroid, aligned_listA_G, updated_idx_node_mapping, node_metadata_dict, device=device, alignment_pool=pool, aligned_to_initial_centroid=True)
+	centroid_annealer.Tmax = Tmax
+	centroid_annealer.Tmin = Tmin
+	centroid_annealer.steps = steps
+	centroid, loss = centroid_annealer.anneal()
+	# the annealer's alignments (the ones for the centroid it returns, i.e. its best state) are on top of the ones we gave it
+	alignments = [alignment[refinement.to(alignment.device)] for alignment, refinement in zip(alignments, centroid_annealer.best_alignments)]
+	
+	centroid, final_idx_node_mapping = simanneal_centroid_helpers.remove_unnecessary_dummy_nodes(centroid.cpu().numpy(), updated_idx_node_mapping, node_metadata_dict)
+	return centroid, final_idx_node_mapping, listA_G, alignments, updated_idx_node_mapping, node_metadata_dict, loss.item()
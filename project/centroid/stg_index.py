@@ -0,0 +1,130 @@
+import os
+import pickle
+import numpy as np
+import structural_distance_bounds
+import structural_distance_matrix
+
+'''
+Metric index over STGs for nearest neighbor queries on the structural distance (a LAESA style pivot table).
+We keep the distance from every indexed piece to a few pivot pieces (picked farthest first, so they're spread out over the dataset). For a query q, the triangle inequality
+gives |d(q, p) - d(x, p)| <= d(q, x) for every pivot p, so after aligning q to the pivots only, we have a lower bound on its distance to every piece x for free.
+We also keep each piece's structural_distance_bounds.signature, and take the max of the 2 lower bounds (on clustered corpora, where every piece is about as far from
+every pivot, the signature bound is often the tighter one). We then only align q to the pieces in order of that lower bound, until the next lower bound can't beat the k-th nearest distance so far.
+The distances are from the alignment annealer, i.e. approximate (a bit too large, sometimes), so they only satisfy the triangle inequality approximately,
+and the signature bound only holds for alignments within partitions (see the NOTE in structural_distance_bounds: the annealer also swaps nodes that are alone in their
+partition across partitions, so it can come in under it). So slack is subtracted from both lower bounds, which makes the pruning tolerant to that, at the cost of aligning a few more pieces.
+The index lives in a directory: the pivot table in index.pkl (replaced atomically on every save), and every distance we compute in a
+structural_distance_matrix.DistanceStore next to it, so nothing is ever aligned twice, across queries or runs.
+Pieces are STG pickle paths (or STGs, which then get pickled into the index)
+'''
+class STGIndex(object):
+	def __init__(self, index_dir, n_pivots=8, slack=0.0, seed=0, device=None, **alignment_params):
+		self.index_dir = index_dir
+		self.n_pivots = n_pivots
+		self.slack = slack
+		self.seed = seed
+		self.device = device
+		self.alignment_params = alignment_params
+		os.makedirs(index_dir, exist_ok=True)
+		self.store = structural_distance_matrix.DistanceStore(os.path.join(index_dir, 'distances'))
+		self.pieces = []
+		self.hashes = []
+		self.signatures = []
+		self.pivots = [] # indices into pieces
+		self.pivot_dists = np.zeros((0, 0)) # pivot_dists[i, p] = d(pieces[i], pieces[pivots[p]])
+		self.n_exact = 0 # number of distances the last query asked for
+
+		index_path = os.path.join(index_dir, 'index.pkl')
+		if os.path.exists(index_path):
+			with open(index_path, 'rb') as f:
+				saved = pickle.load(f)
+			self.pieces, self.hashes, self.signatures, self.pivots, self.pivot_dists = saved['pieces'], saved['hashes'], saved['signatures'], saved['pivots'], saved['pivot_dists']
+
+	def __len__(self):
+		return len(self.pieces)
+
+	def save(self):
+		index_path = os.path.join(self.index_dir, 'index.pkl')
+		with open(index_path + '.tmp', 'wb') as f:
+			pickle.dump({'pieces': self.pieces, 'hashes': self.hashes, 'signatures': self.signatures, 'pivots': self.pivots, 'pivot_dists': self.pivot_dists}, f, protocol=pickle.HIGHEST_PROTOCOL)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(index_path + '.tmp', index_path)
+		self.store.sync()
+
+	def close(self):
+		self.store.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	# distances of (piece1, piece2) pairs, with the content hash of each piece (the ones in self.hashes for indexed pieces), so the store lookups never re-read the indexed files
+	def dists(self, pairs, pair_hashes, n_workers=None):
+		return structural_distance_matrix.pair_distances(pairs, store=self.store, seed=self.seed, n_workers=n_workers, device=self.device, pair_hashes=pair_hashes, **self.alignment_params)
+
+	# incremental insertion: each new piece is aligned to the current pivots, and while we have fewer than n_pivots pivots, the piece farthest from the pivots
+	# becomes the next one (then every piece gets aligned to it). pieces that are already in the index (same content) are skipped
+	def add(self, pieces, n_workers=None):
+		known = set(self.hashes)
+		new_pieces, new_hashes = [], []
+		for piece in pieces:
+			piece_hash = structural_distance_matrix.piece_hash(piece)
+			if piece_hash not in known:
+				known.add(piece_hash)
+				new_pieces.append(piece)
+				new_hashes.append(piece_hash)
+		if len(new_pieces) == 0:
+			return
+
+		new_rows = np.zeros((len(new_pieces), len(self.pivots)))
+		if len(self.pivots) > 0:
+			pairs = [(piece, self.pieces[pivot]) for piece in new_pieces for pivot in self.pivots]
+			pair_hashes = [(piece_hash, self.hashes[pivot]) for piece_hash in new_hashes for pivot in self.pivots]
+			new_rows = self.dists(pairs, pair_hashes, n_workers=n_workers).reshape(len(new_pieces), len(self.pivots))
+		self.pieces.extend(new_pieces)
+		self.hashes.extend(new_hashes)
+		self.signatures.extend(structural_distance_bounds.signature(structural_distance_matrix.load_piece(piece)) for piece in new_pieces)
+		self.pivot_dists = np.vstack([self.pivot_dists, new_rows])
+
+		while len(self.pivots) < min(self.n_pivots, len(self.pieces)):
+			if len(self.pivots) == 0:
+				pivot = 0
+			else:
+				min_pivot_dists = self.pivot_dists.min(axis=1)
+				min_pivot_dists[self.pivots] = -np.inf
+				pivot = int(np.argmax(min_pivot_dists))
+			others = [i for i in range(len(self.pieces)) if i != pivot]
+			column = np.zeros(len(self.pieces))
+			column[others] = self.dists([(self.pieces[i], self.pieces[pivot]) for i in others], [(self.hashes[i], self.hashes[pivot]) for i in others], n_workers=n_workers)
+			self.pivots.append(pivot)
+			self.pivot_dists = np.hstack([self.pivot_dists, column[:, None]])
+		self.save()
+
+	# the k nearest indexed pieces to query, as a list of (piece, dist), nearest first. refines batch_size pieces at a time (in parallel)
+	def query(self, query, k=1, batch_size=1, n_workers=None):
+		if len(self.pieces) == 0:
+			return []
+		query_hash = structural_distance_matrix.piece_hash(query)
+		query_pivot_dists = self.dists([(query, self.pieces[pivot]) for pivot in self.pivots], [(query_hash, self.hashes[pivot]) for pivot in self.pivots], n_workers=n_workers)
+		self.n_exact = len(self.pivots)
+		pivot_bounds = np.max(np.abs(self.pivot_dists - query_pivot_dists[None, :]), axis=1)
+		query_signature = structural_distance_bounds.signature(structural_distance_matrix.load_piece(query))
+		signature_bounds = np.array([structural_distance_bounds.lower_bound(query_signature, piece_signature) for piece_signature in self.signatures])
+		lower_bounds = np.maximum(pivot_bounds, signature_bounds) - self.slack
+
+		# the pivots' distances are already exact
+		results = [(pivot, dist) for pivot, dist in zip(self.pivots, query_pivot_dists.tolist())]
+		results.sort(key=lambda result: result[1])
+		pivots = set(self.pivots)
+		candidates = [i for i in np.argsort(lower_bounds, kind='stable').tolist() if i not in pivots]
+		for start in range(0, len(candidates), batch_size):
+			if len(results) >= k and lower_bounds[candidates[start]] >= results[k - 1][1]:
+				break
+			batch = candidates[start:start + batch_size]
+			dists = self.dists([(query, self.pieces[i]) for i in batch], [(query_hash, self.hashes[i]) for i in batch], n_workers=n_workers)
+			self.n_exact += len(batch)
+			results = sorted(results + list(zip(batch, dists.tolist())), key=lambda result: result[1])
+		return [(self.pieces[i], dist) for i, dist in results[:k]]
@@ -0,0 +1,153 @@
+import numpy as np
+import simanneal_centroid
+import simanneal_centroid_helpers
+import structural_distance_matrix
+
+'''
+Cheap bounds on the structural distance, to skip the alignment annealing when the answer to a query is already decided, i.e. "is d(A, B) < d(A, C)?" or "the k nearest pieces to A".
+Lower bounds: the alignments only permute nodes within the same partition (simanneal_centroid.get_node_partitions), so anything we can say about each partition
+without knowing the node order holds for every alignment. The distance is 0/1, so the squared dist is the number of differing entries, and:
+  - block counts: block (P, Q) of the aligned matrix has the same number of edges as before the alignment, so it differs from the other graph's block in at least |e1(P, Q) - e2(P, Q)| entries
+  - degree sequences: node i in P, matched to node j in P, differs in at least |deg1(i -> Q) - deg2(j -> Q)| entries of its row in block (P, Q), and the best matching of 2 degree sequences
+    is in sorted order, so the sum over all the rows is at least the L1 distance between the sorted degree sequences (same for the in-degrees, over the columns)
+  - prototype fanout: the same thing for the total number of instance nodes each prototype points to, i.e. its fanout histogram
+The padding only adds nodes with degree 0, so we compute all of these per graph (signature), without padding the pair.
+Upper bound: the annealer starts from the identity alignment and returns the best alignment it sees, so the dist under the identity alignment is an upper bound on what it returns.
+NOTE: the lower bounds are for alignments within partitions. the alignment annealer swaps across partitions only for nodes that are alone in their partition
+'''
+
+def partition_key(node_id, node_metadata_dict):
+	return simanneal_centroid.get_node_partition_info(node_id, node_metadata_dict)
+
+# descending sorted nonzero values, i.e. a degree sequence without its (padding dependent) zeros
+def sorted_nonzero(values):
+	values = np.asarray(values, dtype=np.int64)
+	return np.sort(values[values != 0])[::-1]
+
+# per partition statistics of G that don't depend on the node order (within partitions) or on padding
+def signature(G):
+	node_ids = list(G.nodes())
+	node_idx = {node_id: i for i, node_id in enumerate(node_ids)}
+	node_metadata_dict = dict(G.nodes(data=True))
+	keys = sorted({partition_key(node_id, node_metadata_dict) for node_id in node_ids}, key=repr)
+	key_idx = {key: k for k, key in enumerate(keys)}
+	node_partitions = np.array([key_idx[partition_key(node_id, node_metadata_dict)] for node_id in node_ids], dtype=np.int64)
+
+	sources, sinks = simanneal_centroid_helpers.graph_edge_index(G, node_idx)
+	n, n_partitions = len(node_ids), len(keys)
+	# out_degrees[i, Q] is the number of edges from node i to partition Q, in_degrees[i, P] from partition P to node i
+	out_degrees = np.zeros((n, n_partitions), dtype=np.int64)
+	in_degrees = np.zeros((n, n_partitions), dtype=np.int64)
+	np.add.at(out_degrees, (sources, node_partitions[sinks]), 1)
+	np.add.at(in_degrees, (sinks, node_partitions[sources]), 1)
+
+	blocks, out_sequences, in_sequences, fanouts = {}, {}, {}, {}
+	inst_partitions = [Q for Q, (partition_name, _) in enumerate(keys) if not partition_name.startswith('proto_')]
+	for P, key_P in enumerate(keys):
+		members = node_partitions == P
+		for Q, key_Q in enumerate(keys):
+			block_count = int(out_degrees[members, Q].sum())
+			if block_count == 0:
+				continue
+			blocks[(key_P, key_Q)] = block_count
+			out_sequences[(key_P, key_Q)] = sorted_nonzero(out_degrees[members, Q])
+			in_sequences[(key_Q, key_P)] = sorted_nonzero(in_degrees[node_partitions == Q, P])
+		if key_P[0].startswith('proto_'):
+			fanouts[key_P] = sorted_nonzero(out_degrees[members][:, inst_partitions].sum(axis=1))
+	return {'blocks': blocks, 'out': out_sequences, 'in': in_sequences, 'fanout': fanouts}
+
+# L1 distance between 2 descending sorted nonzero sequences, padded with zeros to the same length
+def sorted_l1(a, b):
+	m = max(len(a), len(b))
+	return int(np.abs(np.pad(a, (0, m - len(a))) - np.pad(b, (0, m - len(b)))).sum())
+
+def sequences_bound(sequences1, sequences2):
+	empty = np.zeros(0, dtype=np.int64)
+	return sum(sorted_l1(sequences1.get(key, empty), sequences2.get(key, empty)) for key in set(sequences1) | set(sequences2))
+
+# lower bounds on the SQUARED dist
+def block_count_bound(signature1, signature2):
+	blocks1, blocks2 = signature1['blocks'], signature2['blocks']
+	return sum(abs(blocks1.get(key, 0) - blocks2.get(key, 0)) for key in set(blocks1) | set(blocks2))
+
+def degree_sequence_bound(signature1, signature2):
+	return max(sequences_bound(signature1['out'], signature2['out']), sequences_bound(signature1['in'], signature2['in']))
+
+def proto_fanout_bound(signature1, signature2):
+	return sequences_bound(signature1['fanout'], signature2['fanout'])
+
+# the best of the lower bounds, on the dist itself. the degree sequence bound is always at least the block count bound, but the block counts are cheaper to compare
+def lower_bound(signature1, signature2):
+	return np.sqrt(max(block_count_bound(signature1, signature2), degree_sequence_bound(signature1, signature2), proto_fanout_bound(signature1, signature2)))
+
+def upper_bound(G1, G2):
+	listA_G, _, _ = simanneal_centroid_helpers.pad_adj_matrices([G1, G2], matrix_format='bits')
+	return np.sqrt(listA_G[0].hamming(listA_G[1]))
+
+'''
+Filter and refine. Pieces are STG pickle paths or STGs (like structural_distance_matrix), and the exact distances (i.e. the annealing) go through
+structural_distance_matrix.pair_distances, with its store and alignment params
+'''
+class BoundedDistances(object):
+	def __init__(self, store=None, seed=0, device=None, **alignment_params):
+		self.store = store
+		self.seed = seed
+		self.device = device
+		self.alignment_params = alignment_params
+		self.signatures = {}
+		self.n_exact = 0 # number of exact distances we asked for, i.e. the ones we couldn't prune
+
+	def get_signature(self, piece):
+		piece_id = piece if isinstance(piece, str) else id(piece)
+		if piece_id not in self.signatures:
+			self.signatures[piece_id] = signature(structural_distance_matrix.load_piece(piece))
+		return self.signatures[piece_id]
+
+	def lower_bound(self, piece1, piece2):
+		return lower_bound(self.get_signature(piece1), self.get_signature(piece2))
+
+	def upper_bound(self, piece1, piece2):
+		return upper_bound(structural_distance_matrix.load_piece(piece1), structural_distance_matrix.load_piece(piece2))
+
+	def exact(self, pairs, n_workers=None):
+		self.n_exact += len(pairs)
+		return structural_distance_matrix.pair_distances(pairs, store=self.store, seed=self.seed, n_workers=n_workers, device=self.device, **self.alignment_params)
+
+	# is d(A, B) < d(A, C)? only anneals when the bounds overlap, and then 1 pair at a time (the one with the widest bounds first), since its exact dist may settle it
+	def is_closer(self, A, B, C):
+		lower_B, lower_C = self.lower_bound(A, B), self.lower_bound(A, C)
+		upper_B = self.upper_bound(A, B)
+		if upper_B < lower_C:
+			return True
+		upper_C = self.upper_bound(A, C)
+		if upper_C <= lower_B:
+			return False
+		if upper_B - lower_B >= upper_C - lower_C:
+			d_B = self.exact([(A, B)])[0]
+			if d_B < lower_C:
+				return True
+			if upper_C <= d_B:
+				return False
+			d_C = self.exact([(A, C)])[0]
+		else:
+			d_C = self.exact([(A, C)])[0]
+			if upper_B < d_C:
+				return True
+			if d_C <= lower_B:
+				return False
+			d_B = self.exact([(A, B)])[0]
+		return d_B < d_C
+
+	# the k nearest candidates to query, as a list of (index into candidates, dist), nearest first
+	# we go through the candidates by lower bound, annealing batch_size of them at a time (in parallel), and stop once the next lower bound can't beat the k-th best dist
+	def nearest(self, query, candidates, k=1, batch_size=1, n_workers=None):
+		lower_bounds = np.array([self.lower_bound(query, candidate) for candidate in candidates])
+		order = np.argsort(lower_bounds, kind='stable')
+		results = []
+		for start in range(0, len(order), batch_size):
+			if len(results) >= k and lower_bounds[order[start]] >= results[k - 1][1]:
+				break
+			batch = order[start:start + batch_size]
+			dists = self.exact([(query, candidates[i]) for i in batch], n_workers=n_workers)
+			results = sorted(results + list(zip(batch.tolist(), dists.tolist())), key=lambda result: result[1])
+		return results[:k]
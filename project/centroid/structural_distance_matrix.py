@@ -0,0 +1,194 @@
+import hashlib
+import multiprocessing
+import os
+import pickle
+import random
+import shelve
+import numpy as np
+import torch
+import simanneal_centroid
+import simanneal_centroid_helpers
+import simanneal_centroid_run
+
+'''
+Pairwise structural distance matrix engine, i.e. the basic operation behind the Section 6.1 experiments.
+Takes a list of pieces (STG pickle paths, or the STGs themselves) and returns the condensed distance matrix (the upper triangle, row by row,
+like scipy.spatial.distance.squareform), computing each unordered pair once, across a process pool.
+Each distance is stored on disk under a content hash of the 2 pieces (order independent), the annealer params and the seed, so the same pair is never computed twice,
+even when the pieces move, get renamed or show up in a different corpus, and a partially computed matrix resumes from where it stopped.
+Each pair's annealer is seeded from its key, so a distance doesn't depend on which worker computed it or in what order
+'''
+
+# defaults, same as simanneal_centroid_run.align_graph_pair
+ALIGNMENT_PARAMS = {'Tmax': 1.75, 'Tmin': 0.01, 'steps': 2000, 'n_chains': 1, 'assignment_seed': False}
+
+# hashes of the STG pickles we've already read, by (path, mtime, size), so looking pairs up one at a time (pair_distance) doesn't re-read both files every time
+_piece_hashes = {}
+
+# content hash of the STG itself, re-pickled, so a path and the STG loaded from it hash the same (the file may have been written with another pickle protocol)
+def piece_hash(piece):
+	if isinstance(piece, str): # path to the STG pickle
+		stat = os.stat(piece)
+		file_key = (piece, stat.st_mtime_ns, stat.st_size)
+		if file_key not in _piece_hashes:
+			_piece_hashes[file_key] = piece_hash(load_piece(piece))
+		return _piece_hashes[file_key]
+	return hashlib.sha256(pickle.dumps(piece, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+def pair_key(hash1, hash2, params, seed):
+	hash1, hash2 = sorted([hash1, hash2])
+	return hashlib.sha256(repr((hash1, hash2, sorted(params.items()), seed)).encode()).hexdigest()
+
+def load_piece(piece):
+	if isinstance(piece, str):
+		with open(piece, 'rb') as f:
+			return pickle.load(f)
+	return piece
+
+# the structural distance between 2 STGs (the min over alignments of the Frobenius distance between their padded adjacency matrices)
+def struct_dist(G1, G2, device=None, Tmax=1.75, Tmin=0.01, steps=2000, n_chains=1, assignment_seed=False):
+	listA_G, idx_node_mapping, node_metadata_dict = simanneal_centroid_helpers.pad_adj_matrices([G1, G2])
+	A_G1, A_G2 = torch.from_numpy(listA_G[0]).to(device), torch.from_numpy(listA_G[1]).to(device)
+	_, dist = simanneal_centroid_run.align_graph_pair(A_G1, A_G2, idx_node_mapping, node_metadata_dict, Tmax=Tmax, Tmin=Tmin, steps=steps, device=device, n_chains=n_chains, assignment_seed=assignment_seed)
+	return float(dist)
+
+def _init_distance_worker(torch_threads):
+	torch.set_num_threads(torch_threads)
+
+# piece1 is always the one with the smaller hash, so the distance doesn't depend on the order the pair was asked for in
+# with n_workers=1 (and pair_distance) this runs in the caller's process, so the global RNG states are put back after the pair's seeded run
+def _pair_distance_worker(key, piece1, piece2, device, params):
+	pair_seed = int(key[:8], 16)
+	random_state, np_random_state = random.getstate(), np.random.get_state()
+	try:
+		with torch.random.fork_rng():
+			random.seed(pair_seed)
+			np.random.seed(pair_seed)
+			torch.manual_seed(pair_seed)
+			return key, struct_dist(load_piece(piece1), load_piece(piece2), device=device, **params)
+	finally:
+		random.setstate(random_state)
+		np.random.set_state(np_random_state)
+
+def _pair_distance_star(task):
+	return _pair_distance_worker(*task)
+
+class DistanceStore(object):
+	'''
+	On disk store of pair distances (a shelve keyed by pair_key). Writes are only synced every sync_every writes (and on close),
+	instead of after every one. With path None it's just an in memory dict
+	'''
+	def __init__(self, path=None, sync_every=20):
+		self.path = path
+		self.sync_every = sync_every
+		self.store = shelve.open(path) if path is not None else {}
+		self.unsynced = 0
+
+	def __contains__(self, key):
+		return key in self.store
+
+	def __getitem__(self, key):
+		return self.store[key]
+
+	def __setitem__(self, key, dist):
+		self.store[key] = dist
+		self.unsynced += 1
+		if self.path is not None and self.unsynced >= self.sync_every:
+			self.sync()
+
+	def sync(self):
+		if self.path is not None:
+			self.store.sync()
+		self.unsynced = 0
+
+	def close(self):
+		if self.path is not None:
+			self.store.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+'''
+Structural distances of a list of (piece1, piece2) pairs, each piece an STG pickle path or an STG.
+store is a DistanceStore or the path to one (None keeps the distances in memory only). alignment params default to ALIGNMENT_PARAMS
+pair_hashes optionally has the (piece_hash(piece1), piece_hash(piece2)) of each pair, for callers that already keep them (i.e. STGIndex), so we don't hash the pieces again
+The pairs that aren't in the store yet are scheduled across n_workers processes (spawn, like simanneal_centroid.AlignmentPool), and each result goes into the store as soon as it
+comes back, so an interrupted run only loses the pairs in flight (and the writes since the last sync)
+'''
+def pair_distances(pairs, store=None, seed=0, n_workers=None, torch_threads=1, device=None, pair_hashes=None, **alignment_params):
+	params = dict(ALIGNMENT_PARAMS, **alignment_params)
+	if pair_hashes is None:
+		hashes = {}
+		def get_hash(piece):
+			piece_id = piece if isinstance(piece, str) else id(piece)
+			if piece_id not in hashes:
+				hashes[piece_id] = piece_hash(piece)
+			return hashes[piece_id]
+		pair_hashes = [(get_hash(piece1), get_hash(piece2)) for piece1, piece2 in pairs]
+	keys = [pair_key(hash1, hash2, params, seed) for hash1, hash2 in pair_hashes]
+
+	owns_store = not isinstance(store, DistanceStore)
+	if owns_store:
+		store = DistanceStore(store)
+	try:
+		tasks = {}
+		for (piece1, piece2), (hash1, hash2), key in zip(pairs, pair_hashes, keys):
+			if key not in store and key not in tasks:
+				tasks[key] = (key, piece1, piece2, device, params) if hash1 <= hash2 else (key, piece2, piece1, device, params)
+
+		if len(tasks) > 0:
+			print(f"{len(pairs)} pairs, {len(pairs) - len(tasks)} already computed, {len(tasks)} to compute")
+			if n_workers is None:
+				n_workers = max(1, multiprocessing.cpu_count() // torch_threads)
+			if n_workers == 1 or len(tasks) == 1:
+				for task in tasks.values():
+					key, dist = _pair_distance_worker(*task)
+					store[key] = dist
+			else:
+				ctx = torch.multiprocessing.get_context('spawn')
+				with ctx.Pool(processes=min(n_workers, len(tasks)), initializer=_init_distance_worker, initargs=(torch_threads,)) as pool:
+					for key, dist in pool.imap_unordered(_pair_distance_star, tasks.values()):
+						store[key] = dist
+			store.sync()
+		return np.array([store[key] for key in keys], dtype=np.float64)
+	finally:
+		if owns_store:
+			store.close()
+
+# condensed distance matrix of pieces (see the top of the file), i.e. the distances of all the unordered pairs (i, j), i < j, row by row
+def distance_matrix(pieces, store=None, seed=0, n_workers=None, torch_threads=1, device=None, **alignment_params):
+	pairs = [(pieces[i], pieces[j]) for i in range(len(pieces)) for j in range(i + 1, len(pieces))]
+	return pair_distances(pairs, store=store, seed=seed, n_workers=n_workers, torch_threads=torch_threads, device=device, **alignment_params)
+
+# single pair through the same store, i.e. for experiments that look up distances one at a time
+def pair_distance(piece1, piece2, store=None, seed=0, device=None, **alignment_params):
+	return float(pair_distances([(piece1, piece2)], store=store, seed=seed, n_workers=1, device=device, **alignment_params)[0])
+
+'''
+One to many structural distances, i.e. a query (a centroid, a base STG) against a batch of candidates (a corpus, the noisy STGs of a noise sweep).
+Instead of padding and uploading every pair separately like struct_dist, we pad the query and all the candidates into one node universe once, keep the tensors on device,
+and align every candidate to the query in a single simanneal_centroid.get_alignments_to_centroid call (with n_chains, all of them together in the batched engine,
+with n_workers > 1, across an AlignmentPool made for this universe). Returns the distances, in candidate order.
+The extra padding nodes are isolated in both graphs of each pair, so they don't change the distance, only the size of the alignment search.
+Nothing goes through a DistanceStore here, since the distances depend on the whole batch's universe (see pair_distances for cached pairwise distances)
+'''
+def distances_from(query, candidates, device=None, n_workers=1, torch_threads=1, Tmax=1.75, Tmin=0.01, steps=2000, n_chains=None, assignment_seed=False):
+	if len(candidates) == 0:
+		return np.zeros(0, dtype=np.float64)
+	graphs = [load_piece(piece) for piece in [query] + list(candidates)]
+	listA_G, idx_node_mapping, node_metadata_dict = simanneal_centroid_helpers.pad_adj_matrices(graphs)
+	listA_G = [torch.from_numpy(A_G).to(device) for A_G in listA_G]
+	A_q, listA_G = listA_G[0], listA_G[1:]
+
+	pool = None
+	if n_workers > 1 and len(listA_G) > 1:
+		pool = simanneal_centroid.AlignmentPool(idx_node_mapping, node_metadata_dict, n_workers=min(n_workers, len(listA_G)), torch_threads=torch_threads)
+	try:
+		alignments, _ = simanneal_centroid.get_alignments_to_centroid(A_q, listA_G, idx_node_mapping, node_metadata_dict, device=device, Tmax=Tmax, Tmin=Tmin, steps=steps, n_chains=n_chains, pool=pool, assignment_seed=assignment_seed)
+	finally:
+		if pool is not None:
+			pool.close()
+	return np.array([simanneal_centroid.dist_torch(A_q, simanneal_centroid.align_torch(alignment, A_G)).item() for alignment, A_G in zip(alignments, listA_G)], dtype=np.float64)
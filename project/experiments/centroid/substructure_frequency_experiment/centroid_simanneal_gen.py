@@ -146,7 +146,7 @@ def generate_centroid(composer, initial_centroid, initial_alignments, listA_G, i
 	
 	if ANALYZE_NAIVE_CENTROID:
 		listA_G = [torch.tensor(A_G, device=device, dtype=torch.float64) for A_G in listA_G]
-		initial_alignments = [torch.tensor(alignment, device=device, dtype=torch.float64) for alignment in initial_alignments]
+		initial_alignments = [simanneal_centroid.as_alignment_torch(alignment, device=device) for alignment in initial_alignments]
 		initial_centroid = torch.tensor(initial_centroid, device=device, dtype=torch.float64)
 		aligned_listA_G = list(map(simanneal_centroid.align_torch, initial_alignments, listA_G))
 		print(f"NAIVE CENTROID LOSS FOR COMPOSER CORPUS {composer}: {simanneal_centroid.loss_torch(initial_centroid, aligned_listA_G, device).item()}")
@@ -154,7 +154,7 @@ def generate_centroid(composer, initial_centroid, initial_alignments, listA_G, i
 
 	# bc these are originally numpy and we can't convert to tensor till we get the device
 	listA_G = [torch.tensor(A_G, device=device, dtype=torch.float64) for A_G in listA_G]
-	initial_alignments = [torch.tensor(alignment, device=device, dtype=torch.float64) for alignment in initial_alignments]
+	initial_alignments = [simanneal_centroid.as_alignment_torch(alignment, device=device) for alignment in initial_alignments]
 	initial_centroid = torch.tensor(initial_centroid, device=device, dtype=torch.float64)
 	aligned_listA_G = list(map(simanneal_centroid.align_torch, initial_alignments, listA_G))
 
@@ -162,14 +162,17 @@ def generate_centroid(composer, initial_centroid, initial_alignments, listA_G, i
 	centroid_annealer.Tmax = 2.5
 	centroid_annealer.Tmin = 0.05 
 	centroid_annealer.steps = 1000
+	# checkpoint the run, so if the job gets preempted, rerunning it resumes from the last checkpoint instead of starting over
+	approx_centroid_dir = f"{DIRECTORY}/experiments/centroid/substructure_frequency_experiment/approx_centroids/{composer}"
+	os.makedirs(approx_centroid_dir, exist_ok=True)
+	centroid_annealer.checkpoint_path = os.path.join(approx_centroid_dir, "checkpoint.pt")
 	approx_centroid, loss = centroid_annealer.anneal()
+	if centroid_annealer.stop_reason == 'user_exit': # interrupted, so don't save the partial centroid. the checkpoint is already saved for the rerun
+		return
 	approx_centroid = approx_centroid.cpu().numpy() # convert from tensor -> numpy
 	loss = loss.item() # convert from tensor -> numpy
 	
 	approx_centroid, final_idx_node_mapping = simanneal_centroid_helpers.remove_unnecessary_dummy_nodes(approx_centroid, idx_node_mapping, node_metadata_dict)
-	approx_centroid_dir = f"{DIRECTORY}/experiments/centroid/substructure_frequency_experiment/approx_centroids/{composer}"
-	if not os.path.exists(approx_centroid_dir):
-		os.makedirs(approx_centroid_dir)
 
 	approx_centroid_path = os.path.join(approx_centroid_dir, "centroid.txt")
 	np.savetxt(approx_centroid_path, approx_centroid, fmt='%d', delimiter=' ')
@@ -189,6 +192,8 @@ def generate_centroid(composer, initial_centroid, initial_alignments, listA_G, i
 	np.savetxt(approx_centroid_loss_path, [loss], fmt='%d')
 	print(f'Saved: {approx_centroid_loss_path}')
 
+	os.remove(centroid_annealer.checkpoint_path) # the run is done and saved
+
 if __name__ == "__main__":
 	# def delete_dirs_with_substring(directory, substring):
 	# 	for root, dirs, _ in os.walk(directory, topdown=False):
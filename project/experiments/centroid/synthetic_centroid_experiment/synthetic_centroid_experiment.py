@@ -12,7 +12,8 @@ DIRECTORY = "/Users/ilanashapiro/Documents/constraints_project/project"
 
 sys.path.append(f"{DIRECTORY}/centroid")
 import z3_matrix_projection_incremental as z3_repair
-import simanneal_centroid_helpers, simanneal_centroid_run, simanneal_centroid
+import simanneal_centroid_helpers, simanneal_centroid_run, simanneal_centroid, structural_distance_matrix
+from scipy.spatial.distance import squareform
 # import build_graph
 
 def solve_lower_bound(dist_matrix):
@@ -51,16 +52,10 @@ def solve_lower_bound(dist_matrix):
 		
 		return lower_bound_value
 
-def construct_distance_matrix(corpus_graphs):
-		K = len(corpus_graphs)
-		D = np.zeros((K, K))  # Initialize a KxK zero matrix
-
-		for i in range(K):
-				for j in range(i + 1, K):  # Only compute upper triangle to avoid redundancy
-						d = struct_dist(corpus_graphs[i], corpus_graphs[j])  # Compute distance
-						D[i][j] = D[j][i] = d  # Fill both symmetric entries
-
-		return D
+# KxK distance matrix. each unordered pair is only computed once, in parallel (see structural_distance_matrix.distance_matrix),
+# and with store (a path), the distances are saved on disk so a rerun only computes the ones that are missing
+def construct_distance_matrix(corpus_graphs, store=None):
+		return squareform(structural_distance_matrix.distance_matrix(corpus_graphs, store=store))
 
 def plot_results():
 	k_values = np.array([3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14])
@@ -261,18 +256,6 @@ def load_noisy_corpus(noisy_corpus_dir):
 					noisy_graphs.append(graph)
 	return noisy_graphs
 
-def struct_dist(G1, G2, noisy_corpus_dirname="", gpu_id=0):
-	device = torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')
-	print(f"Process {current_process().name} running on GPU {device} for centroid cluster {noisy_corpus_dirname}")
-
-	STG_augmented_list = [G1, G2]
-	listA_G, idx_node_mapping, node_metadata_dict = simanneal_centroid_helpers.pad_adj_matrices(STG_augmented_list)
-	# A_G1, A_G2 = cp.asarray(listA_G[0]), cp.asarray(listA_G[1]) 
-	# A_G1, A_G2 = np.asarray(listA_G[0]), np.asarray(listA_G[1]) 
-	A_G1, A_G2 = torch.from_numpy(listA_G[0]).to(device), torch.from_numpy(listA_G[1]).to(device)
-	_, struct_dist = simanneal_centroid_run.align_graph_pair(A_G1, A_G2, idx_node_mapping, node_metadata_dict, device=device)
-	return struct_dist.item()
-
 def generate_initial_alignments(noisy_corpus_dirname, STG_augmented_list, gpu_id=0):
 	device = torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')
 	print(f"Process {current_process().name} running on GPU {device} for centroid cluster {noisy_corpus_dirname}")
@@ -332,7 +315,7 @@ def generate_approx_centroid(noisy_corpus_dirname, noisy_corpus_graphs, gpu_id=0
 
 	# bc these are originally numpy and we can't convert to tensor till we get the device
 	listA_G = [torch.tensor(A_G, device=device, dtype=torch.float64) for A_G in listA_G]
-	initial_alignments = [torch.tensor(alignment, device=device, dtype=torch.float64) for alignment in initial_alignments]
+	initial_alignments = [simanneal_centroid.as_alignment_torch(alignment, device=device) for alignment in initial_alignments]
 	initial_centroid = torch.tensor(initial_centroid, device=device, dtype=torch.float64)
 	aligned_listA_G = list(map(simanneal_centroid.align_torch, initial_alignments, listA_G))
 
@@ -346,14 +329,17 @@ def generate_approx_centroid(noisy_corpus_dirname, noisy_corpus_graphs, gpu_id=0
 	centroid_annealer.steps = 1000
 
 
+	# checkpoint the run, so if the job gets preempted, rerunning it resumes from the last checkpoint instead of starting over
+	approx_centroid_dir = f"{DIRECTORY}/experiments/centroid/synthetic_centroid_experiment/{noisy_corpus_dirname}/approx_centroid"
+	os.makedirs(approx_centroid_dir, exist_ok=True)
+	centroid_annealer.checkpoint_path = os.path.join(approx_centroid_dir, "checkpoint.pt")
 	approx_centroid, loss = centroid_annealer.anneal()
+	if centroid_annealer.stop_reason == 'user_exit': # interrupted, so don't save the partial centroid. the checkpoint is already saved for the rerun
+		return
 	approx_centroid = approx_centroid.cpu().numpy() # convert from tensor -> numpy
 	loss = loss.item() # convert from tensor -> numpy
 	
 	approx_centroid, final_idx_node_mapping = simanneal_centroid_helpers.remove_unnecessary_dummy_nodes(approx_centroid, idx_node_mapping, node_metadata_dict)
-	approx_centroid_dir = f"{DIRECTORY}/experiments/centroid/synthetic_centroid_experiment/{noisy_corpus_dirname}/approx_centroid"
-	if not os.path.exists(approx_centroid_dir):
-		os.makedirs(approx_centroid_dir)
 
 	approx_centroid_path = os.path.join(approx_centroid_dir, "centroid.txt")
 	np.savetxt(approx_centroid_path, approx_centroid, fmt='%d', delimiter=' ')
@@ -373,6 +359,8 @@ def generate_approx_centroid(noisy_corpus_dirname, noisy_corpus_graphs, gpu_id=0
 	np.savetxt(approx_centroid_loss_path, [loss], fmt='%d')
 	print(f'Saved: {approx_centroid_loss_path}')
 
+	os.remove(centroid_annealer.checkpoint_path) # the run is done and saved
+
 def repair_centroid(noisy_corpus_dirname):
 	approx_centroid_dir = f"{DIRECTORY}/experiments/centroid/synthetic_centroid_experiment/{noisy_corpus_dirname}/approx_centroid"
 
@@ -403,11 +391,8 @@ def repair_centroid(noisy_corpus_dirname):
 
 def get_distances_from_centroid_to_corpus(noisy_corpus_graphs, centroid, gpu_id):
 	device = torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')
-	listA_G, centroid_idx_node_mapping, node_metadata_dict = simanneal_centroid_helpers.pad_adj_matrices(noisy_corpus_graphs + [centroid])
-	A_g, listA_G = torch.from_numpy(listA_G[-1]).to(device), [torch.from_numpy(A_G).to(device) for A_G in listA_G[:-1]]
-	alignments = simanneal_centroid.get_alignments_to_centroid(A_g, listA_G, centroid_idx_node_mapping, node_metadata_dict, device=device)
-	list_alignedA_G = list(map(simanneal_centroid.align_torch, alignments, listA_G)) # align to centroid A_g
-	return np.array([simanneal_centroid.dist_torch(A_g, A_G).item() for A_G in list_alignedA_G])
+	# one padded universe for the centroid and the whole corpus, same annealer params as the centroid's own alignments
+	return structural_distance_matrix.distances_from(centroid, noisy_corpus_graphs, device=device, Tmax=2)
 
 if __name__ == "__main__":
 	plot_results()
@@ -431,8 +416,7 @@ if __name__ == "__main__":
 
 		noisy_corpus_graphs = load_noisy_corpus(noisy_corpus_save_dir)
 		print("NUM CORPUS GRAPHS", len(noisy_corpus_graphs))
-		# for G in noisy_corpus_graphs:
-		# 	print(struct_dist(base_graph, G, noisy_corpus_dirname, gpu_id=gpu_id))
+		# print(structural_distance_matrix.distances_from(base_graph, noisy_corpus_graphs, device=torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')))
 	
 		# generate_initial_alignments(noisy_corpus_dirname, noisy_corpus_graphs, gpu_id=gpu_id)
 		# generate_approx_centroid(noisy_corpus_dirname, noisy_corpus_graphs, gpu_id=gpu_id)
@@ -468,7 +452,7 @@ if __name__ == "__main__":
 		# layers_derived_centroid = build_graph.get_unsorted_layers_from_graph_by_index(derived_centroid)
 		# build_graph.visualize([base_graph, derived_centroid], [layers_base_graph, layers_derived_centroid])
 
-		# print("SYNTHETIC TO DERIVED CENTROID DIST", struct_dist(base_graph, derived_centroid, noisy_corpus_dirname, gpu_id=device))
+		# print("SYNTHETIC TO DERIVED CENTROID DIST", structural_distance_matrix.struct_dist(base_graph, derived_centroid, device=torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')))
 
 		# lower_bound_value = solve_lower_bound(construct_distance_matrix(noisy_corpus_graphs))
 		# print("LOWER BOUND:", lower_bound_value)
@@ -490,8 +474,7 @@ if __name__ == "__main__":
 		print("RELATIVE ERROR NAIVE VS SYNTHETIC:", np.abs(synthetic_loss - naive_loss) / synthetic_loss)
 		# print("ABSOLUTE ERROR NAIVE VS SYNTHETIC:", np.abs(synthetic_loss - derived_loss))
 		
-		# for G in noisy_corpus_graphs:
-		# 	print(struct_dist(G, base_graph, noisy_corpus_dirname, gpu_id=device))
+		# print(structural_distance_matrix.distances_from(base_graph, noisy_corpus_graphs, device=torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')))
 
 # K 3
 # RELATIVE ERROR DERIVED VS SYNTHETIC: 0.009755985185740532
@@ -3,7 +3,7 @@ import pandas as pd
 import random
 import itertools
 import json 
-import pickle, shelve
+import pickle, shelve, ast
 import numpy as np
 # import cupy as cp
 
@@ -13,7 +13,7 @@ DIRECTORY = '/Users/ilanashapiro/Documents/constraints_project/project'
 sys.path.append(DIRECTORY)
 sys.path.append(f"{DIRECTORY}/centroid")
 
-import simanneal_centroid_run, simanneal_centroid_helpers
+import simanneal_centroid_run, simanneal_centroid_helpers, structural_distance_matrix
 
 '''
 This file searches for valid sets of STGs (i.e. within the desired duration timeframes) for which to conduct
@@ -134,10 +134,6 @@ def log(combination, file):
 		with open(file, "ab") as f:  # Open in append-binary mode
 				pickle.dump(combination, f)
 
-def update_cache(cache, key, value):
-	cache[key] = value
-	cache.sync() # Ensure the data is written to disk
-
 def save_combination(combination, saved_combos, combo_file):
 	if combination not in saved_combos:
 		log(combination, combo_file)
@@ -146,14 +142,6 @@ def get_composer_from_path(path):
 	parts = path.split(os.sep)
 	return parts[parts.index('datasets') + 1]
 
-def dist(G1, G2):
-  STG_augmented_list = [G1, G2]
-  listA_G, idx_node_mapping, node_metadata_dict = simanneal_centroid_helpers.pad_adj_matrices(STG_augmented_list)
-  # A_G1, A_G2 = cp.asarray(listA_G[0]), cp.asarray(listA_G[1]) 
-  A_G1, A_G2 = np.asarray(listA_G[0]), np.asarray(listA_G[1]) 
-  _, struct_dist = simanneal_centroid_run.align_graph_pair(A_G1, A_G2, idx_node_mapping, node_metadata_dict)
-  return struct_dist
-
 # 0 is most similar
 # ordering is from https://people.wku.edu/charles.smith/essays/2014EmpStudsArts.pdf table 7
 composer_similarity_rank_order_from_composer = {
@@ -242,8 +230,6 @@ composer_similarity_rank_order_from_composer = {
 def is_valid_sequence_for_source_composer(sequence, source_composer_graph_fp, successes_file, failures_file, cache):
 	failures = 0
 	tolerance = 1
-	with open(source_composer_graph_fp, 'rb') as f:
-		G_source_composer = pickle.load(f)
 	source_composer = get_composer_from_path(source_composer_graph_fp)
 	composer_rank_order_from_source = composer_similarity_rank_order_from_composer[source_composer]
 
@@ -253,29 +239,9 @@ def is_valid_sequence_for_source_composer(sequence, source_composer_graph_fp, su
 		graph_fp1 = sequence[i]
 		graph_fp2 = sequence[i + 1]
 
-		cache_key1 = repr((source_composer_graph_fp, graph_fp1))
-		cache_key1_rev = repr((graph_fp1, source_composer_graph_fp))
-		if cache_key1 in cache:
-			d1 = cache[cache_key1]
-		elif cache_key1_rev in cache:
-			d1 = cache[cache_key1_rev]
-		else:
-			with open(graph_fp1, 'rb') as f:
-				G1 = pickle.load(f)
-			d1 = float(dist(G_source_composer, G1))
-			update_cache(cache, cache_key1, d1)
-
-		cache_key2 = repr((source_composer_graph_fp, graph_fp2))
-		cache_key2_rev = repr((graph_fp2, source_composer_graph_fp))
-		if cache_key2 in cache:
-			d2 = cache[cache_key2]
-		elif cache_key2_rev in cache:
-			d2 = cache[cache_key2_rev]
-		else:
-			with open(graph_fp2, 'rb') as f:
-				G2 = pickle.load(f)
-			d2 = float(dist(G_source_composer, G2))
-			update_cache(cache, cache_key2, d2)
+		# cache is a structural_distance_matrix.DistanceStore (keyed by the content of the pieces, so the pair order doesn't matter)
+		d1 = structural_distance_matrix.pair_distance(source_composer_graph_fp, graph_fp1, store=cache)
+		d2 = structural_distance_matrix.pair_distance(source_composer_graph_fp, graph_fp2, store=cache)
 
 		composer1 = get_composer_from_path(graph_fp1)
 		rank1 = composer_rank_order_from_source[composer1]
@@ -316,6 +282,32 @@ def is_valid_sequence_for_source_composer(sequence, source_composer_graph_fp, su
 		return (False, failures)
 	return (True, failures)
 
+# one time import of the distances from the old cache (keyed by repr((fp1, fp2)), from before the DistanceStore) into the DistanceStore, so none of them get re-annealed
+# they were computed with align_graph_pair's defaults, i.e. structural_distance_matrix.ALIGNMENT_PARAMS, so they go under those params (and the default seed).
+# the old paths are from whichever machine computed them, so we find each piece under directory by its path from datasets/ (same as get_composer_from_path)
+# (the marker says which piece hashes the import was keyed with, so stores imported before piece_hash hashed the pickled STG re-import)
+def import_old_cache(cache, old_cache_path="cache_files/cache.shelve", directory=DIRECTORY):
+	imported_key = f"imported {old_cache_path} (STG hashes)"
+	if imported_key in cache or not (os.path.exists(old_cache_path) or os.path.exists(old_cache_path + ".dat")): # the file name depends on the dbm backend
+		return
+	def local_path(path):
+		parts = path.split(os.sep)
+		return os.path.join(directory, *parts[parts.index('datasets'):])
+	imported, missing = 0, 0
+	with shelve.open(old_cache_path, 'r') as old_cache:
+		for old_key, d in old_cache.items():
+			graph_fp1, graph_fp2 = (local_path(path) for path in ast.literal_eval(old_key))
+			if not (os.path.exists(graph_fp1) and os.path.exists(graph_fp2)):
+				missing += 1
+				continue
+			key = structural_distance_matrix.pair_key(structural_distance_matrix.piece_hash(graph_fp1), structural_distance_matrix.piece_hash(graph_fp2), structural_distance_matrix.ALIGNMENT_PARAMS, 0)
+			if key not in cache:
+				cache[key] = float(d)
+				imported += 1
+	cache[imported_key] = True
+	cache.sync()
+	print(f"Imported {imported} distances from {old_cache_path} ({missing} with missing pieces)")
+
 def find_valid_combination(clusters):
 	for i, composers_dict in enumerate(clusters):
 		updated_composers_dict = {}
@@ -324,48 +316,52 @@ def find_valid_combination(clusters):
 			# updated_composers_dict['handel'] = ['/home/ubuntu/project/datasets/handel/kunstderfuge/gigue_e_minor_(nc)werths/gigue_e_minor_(nc)werths_augmented_graph_flat.pickle']
 		clusters[i] = updated_composers_dict
 		
-	cache = shelve.open("cache_files/cache.shelve")
+	with structural_distance_matrix.DistanceStore("cache_files/distances.shelve") as cache:
+		import_old_cache(cache)
 	
-	# composers sorted alphabetically in each tuple of pieces
-	all_combinations = set()
-	for composers_dict in clusters:
-		del composers_dict['brahms']
-		del composers_dict['haydn']
-		all_combinations.update([item for item in list(itertools.product(*(composers_dict[k] for k in sorted(composers_dict.keys()))))])
+		# composers sorted alphabetically in each tuple of pieces
+		all_combinations = set()
+		for composers_dict in clusters:
+			del composers_dict['brahms']
+			del composers_dict['haydn']
+			all_combinations.update([item for item in list(itertools.product(*(composers_dict[k] for k in sorted(composers_dict.keys()))))])
 	
-	# these are sets of tuples of strings
-	failures_file = "cache_files/failures.pkl"
-	successes_file = "cache_files/successes.pkl"
-	saved_failures = load_saved_combinations(failures_file)
-	saved_successes = load_saved_combinations(successes_file)
+		# compute all the distances the sequences below will look up at once, in parallel (the ones already in the cache are skipped)
+		pairs = {tuple(sorted((source_fp, fp))) for combination in all_combinations for source_fp in combination for fp in combination if fp != source_fp}
+		structural_distance_matrix.pair_distances(sorted(pairs), store=cache)
+
+		# these are sets of tuples of strings
+		failures_file = "cache_files/failures.pkl"
+		successes_file = "cache_files/successes.pkl"
+		saved_failures = load_saved_combinations(failures_file)
+		saved_successes = load_saved_combinations(successes_file)
 	
-	for combination in all_combinations:
-		if True: # combination not in saved_successes and combination not in saved_failures:
-			entire_combo_valid = True
-			total_failures = 0
-			min_dist_fails_tolerance = 2
-			total_order_fails_tolerance = float('inf')
-			min_dist_fails = 0 
-			for source_piece_fp in combination:
-				result_bool, num_failures = is_valid_sequence_for_source_composer(combination, source_piece_fp, successes_file, failures_file, cache)
-				if total_failures > total_order_fails_tolerance or (not result_bool and min_dist_fails > min_dist_fails_tolerance):
-					entire_combo_valid = False
-					break
+		for combination in all_combinations:
+			if True: # combination not in saved_successes and combination not in saved_failures:
+				entire_combo_valid = True
+				total_failures = 0
+				min_dist_fails_tolerance = 2
+				total_order_fails_tolerance = float('inf')
+				min_dist_fails = 0 
+				for source_piece_fp in combination:
+					result_bool, num_failures = is_valid_sequence_for_source_composer(combination, source_piece_fp, successes_file, failures_file, cache)
+					if total_failures > total_order_fails_tolerance or (not result_bool and min_dist_fails > min_dist_fails_tolerance):
+						entire_combo_valid = False
+						break
+					else:
+						if not result_bool:
+							min_dist_fails += 1
+						total_failures += num_failures
+				if entire_combo_valid and total_failures <= total_order_fails_tolerance:
+					print("TRUE", total_failures)
+					save_combination(combination, saved_successes, successes_file)
+					saved_successes.add(combination)
+					# sys.exit(0)
 				else:
-					if not result_bool:
-						min_dist_fails += 1
-					total_failures += num_failures
-			if entire_combo_valid and total_failures <= total_order_fails_tolerance:
-				print("TRUE", total_failures)
-				save_combination(combination, saved_successes, successes_file)
-				saved_successes.add(combination)
-				# sys.exit(0)
-			else:
-				# print("FALSE")
-				save_combination(combination, saved_failures, failures_file)
-				saved_failures.add(combination)
-			# print()
-	cache.close()
+					# print("FALSE")
+					save_combination(combination, saved_failures, failures_file)
+					saved_failures.add(combination)
+				# print()
 
 if __name__ == "__main__":
 	filtered_composer_graphs_path = f"{DIRECTORY}/experiments/structural_distance/filtered_composer_graphs.txt" # this is a LIST of possible clusters
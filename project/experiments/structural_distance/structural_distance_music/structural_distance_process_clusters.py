@@ -1,13 +1,13 @@
 import os, sys, re
-import pickle, shelve
 import structural_distance_gen_clusters as gen_clusters
 import numpy as np
 from collections import defaultdict
+from scipy.spatial.distance import squareform
 
 from grakel.kernels import WeisfeilerLehman
 from grakel import Graph, NeighborhoodHash
 
-import simanneal_centroid_helpers
+import simanneal_centroid_helpers, structural_distance_matrix
 
 DIRECTORY = '/home/ilshapiro/project'
 # DIRECTORY = "/home/ubuntu/project"
@@ -18,63 +18,50 @@ This file runs the Graph Alignment Annealer on the STG sets generated in structu
 to get results for the structural distance music evaluation experiment in Section 6.1 of the paper
 The Graph Alignment annealer is implemented in project/centroid/simanneal_centroid.py
 Number of annealer steps is 2000, max temp 2, min temp 0.01
+The distances go through structural_distance_matrix (in parallel, in the same DistanceStore as structural_distance_gen_clusters, keyed by the content of the pieces)
 
 Or, if we're doing the WL Kernels basline, the distance metric on the STG sets is the WL Kernel with Neighborhood Hash as base kernel
 '''
+# the kernel distances are in the same store, under these params instead of the annealer's
+WL_KERNEL_PARAMS = {'kernel': 'WeisfeilerLehman', 'n_iter': 5, 'base_graph_kernel': 'NeighborhoodHash'}
+
+def cluster_paths(cluster, ablation_level=None):
+	paths = []
+	for graph_fp in cluster:
+		if ablation_level:
+			if ablation_level < 0 or ablation_level > 4:
+				raise Exception("Ablation levels should be 1-4 (5 levels is not an ablation, it's a complete graph)")
+			new_suffix = f"_ablation_{ablation_level}level_flat.pickle"
+			graph_fp = graph_fp[:-len("_flat.pickle")] + new_suffix
+		paths.append(re.sub(r'^.*?/project', DIRECTORY, graph_fp))
+	return paths
+
+def kernel_distance(graph_fp1, graph_fp2, cache):
+	key = structural_distance_matrix.pair_key(structural_distance_matrix.piece_hash(graph_fp1), structural_distance_matrix.piece_hash(graph_fp2), WL_KERNEL_PARAMS, 0)
+	if key not in cache:
+		G1, G2 = structural_distance_matrix.load_piece(graph_fp1), structural_distance_matrix.load_piece(graph_fp2)
+		listA_G, idx_node_mapping, nodes_features_dict = simanneal_centroid_helpers.pad_adj_matrices([G1, G2])
+		grakel_graphs = []
+		for adjacency_matrix in listA_G:
+			labels = {i: f'node{i}' for i in range(adjacency_matrix.shape[0])}  # Dummy labels
+			edge_labels = {(i, j): 'edge{i},{j}' for i in range(adjacency_matrix.shape[0]) for j in range(adjacency_matrix.shape[1]) if adjacency_matrix[i, j] > 0}  # Dummy edge labels
+			graph = Graph(adjacency_matrix, node_labels=labels, edge_labels=edge_labels)
+			grakel_graphs.append(graph)
+
+		wl_kernel = WeisfeilerLehman(n_iter=5, normalize=True, base_graph_kernel=NeighborhoodHash)
+		kernel_matrix = wl_kernel.fit_transform(grakel_graphs)
+		kernel_value = kernel_matrix[0, 1]  # Kernel similarity between G1 and G2
+		cache[key] = 1 - kernel_value  # Kernel distance
+	return cache[key]
+
+# cache is a structural_distance_matrix.DistanceStore
 def create_distance_matrix(cluster, cache, kernel_experiment=False, ablation_level=None):
-	n = len(cluster)
-	distance_matrix = distance_matrix = np.zeros((n, n))
-	
-	for i in range(n):
-		for j in range(i, n):
-			if i == j:
-				distance_matrix[i][j] = 0
-			else:
-				graph_fp1, graph_fp2 = cluster[i], cluster[j]
-
-				if ablation_level:
-					if ablation_level < 0 or ablation_level > 4:
-						raise Exception("Ablation levels should be 1-4 (5 levels is not an ablation, it's a complete graph)")
-					new_suffix = f"_ablation_{ablation_level}level_flat.pickle"
-					graph_fp1 = graph_fp1[:-len("_flat.pickle")] + new_suffix
-					graph_fp2 = graph_fp2[:-len("_flat.pickle")] + new_suffix
-
-				cache_key = repr((graph_fp1, graph_fp2))
-				cache_key_rev = repr((graph_fp2, graph_fp1))
-				if cache_key in cache:
-					d = cache[cache_key]
-				elif cache_key_rev in cache:
-					d = cache[cache_key_rev]
-				else:
-					graph_fp1 = re.sub(r'^.*?/project', DIRECTORY, graph_fp1)
-					graph_fp2 = re.sub(r'^.*?/project', DIRECTORY, graph_fp2)
-					with open(graph_fp1, 'rb') as f:
-						G1 = pickle.load(f)
-					with open(graph_fp2, 'rb') as f:
-						G2 = pickle.load(f)
-
-					if kernel_experiment:
-						listA_G, idx_node_mapping, nodes_features_dict = simanneal_centroid_helpers.pad_adj_matrices([G1, G2])
-						grakel_graphs = []
-						for adjacency_matrix in listA_G:
-							labels = {i: f'node{i}' for i in range(adjacency_matrix.shape[0])}  # Dummy labels
-							edge_labels = {(i, j): 'edge{i},{j}' for i in range(adjacency_matrix.shape[0]) for j in range(adjacency_matrix.shape[1]) if adjacency_matrix[i, j] > 0}  # Dummy edge labels
-							graph = Graph(adjacency_matrix, node_labels=labels, edge_labels=edge_labels)
-							grakel_graphs.append(graph)
-
-						wl_kernel = WeisfeilerLehman(n_iter=5, normalize=True, base_graph_kernel=NeighborhoodHash)
-						kernel_matrix = wl_kernel.fit_transform(grakel_graphs)
-						kernel_value = kernel_matrix[0, 1]  # Kernel similarity between G1 and G2
-						d = 1 - kernel_value  # Kernel distance
-					else:
-						d = float(gen_clusters.dist(G1, G2))
-					gen_clusters.update_cache(cache, cache_key, d)
-				
-				# print(graph_fp1, graph_fp2, d)
-				distance_matrix[i][j] = d
-				distance_matrix[j][i] = d  # Ensure symmetry
-	
-	return distance_matrix
+	paths = cluster_paths(cluster, ablation_level=ablation_level)
+	if kernel_experiment:
+		condensed = [kernel_distance(paths[i], paths[j], cache) for i in range(len(paths)) for j in range(i + 1, len(paths))]
+	else:
+		condensed = structural_distance_matrix.distance_matrix(paths, store=cache)
+	return squareform(condensed)
 
 def reorder_cluster_to_reference(cluster):
 	ref_order = ['bach', 'mozart', 'beethoven', 'schubert', 'brahms', 'handel', 'haydn', 'chopin']
@@ -123,20 +110,19 @@ def reorder_cluster_to_reference(cluster):
 #    Y(1/2)        N           Y            Y           N (one off) 
 
 def run(clusters_path, kernel_experiment=False):
-	clusters = gen_clusters.load_saved_combinations(clusters_path)
+	clusters = [reorder_cluster_to_reference(cluster) for cluster in gen_clusters.load_saved_combinations(clusters_path)]
 	ablation_level = None # set to None if we don't want to do ablation
-	if ablation_level:
-		if kernel_experiment:
-			cache = shelve.open(f"{DIRECTORY}/experiments/structural_distance/structural_distance_music/cache_files/cache_postprocess_WL_KERNEL_ablation{ablation_level}.shelve")
-		else:
-			cache = shelve.open(f"{DIRECTORY}/experiments/structural_distance/structural_distance_music/cache_files/cache_postprocess_ablation{ablation_level}.shelve")
-	else:
-		if kernel_experiment:
-			cache = shelve.open(f"{DIRECTORY}/experiments/structural_distance/structural_distance_music/cache_files/cache_postprocess_WL_KERNEL.shelve")
-		else:
-			cache = shelve.open(f"{DIRECTORY}/experiments/structural_distance/structural_distance_music/cache_files/cache_postprocess.shelve")
-	dist_matrics = [create_distance_matrix(reorder_cluster_to_reference(cluster), cache, kernel_experiment=kernel_experiment, ablation_level=ablation_level) for cluster in clusters]
-	cache.close()
+	cache_dir = f"{DIRECTORY}/experiments/structural_distance/structural_distance_music/cache_files"
+	with structural_distance_matrix.DistanceStore(f"{cache_dir}/distances.shelve") as cache:
+		if not kernel_experiment: # the old per experiment caches (keyed by repr((fp1, fp2))), the WL kernel ones are cheap to recompute
+			gen_clusters.import_old_cache(cache, f"{cache_dir}/cache_postprocess_ablation{ablation_level}.shelve" if ablation_level else f"{cache_dir}/cache_postprocess.shelve", directory=DIRECTORY)
+			# compute all the distances of all the clusters at once, in parallel (the ones already in the cache are skipped)
+			pairs = set()
+			for cluster in clusters:
+				paths = cluster_paths(cluster, ablation_level=ablation_level)
+				pairs.update(tuple(sorted((paths[i], paths[j]))) for i in range(len(paths)) for j in range(i + 1, len(paths)))
+			structural_distance_matrix.pair_distances(sorted(pairs), store=cache)
+		dist_matrics = [create_distance_matrix(cluster, cache, kernel_experiment=kernel_experiment, ablation_level=ablation_level) for cluster in clusters]
 
 	return np.mean(np.stack(dist_matrics), axis=0)
 
@@ -10,7 +10,7 @@ DIRECTORY = "/Users/ilanashapiro/Documents/constraints_project/project"
 
 sys.path.append(f"{DIRECTORY}/centroid")
 import z3_matrix_projection_incremental as z3_repair
-import simanneal_centroid_helpers, simanneal_centroid_run
+import simanneal_centroid_helpers, structural_distance_matrix
 
 import matplotlib.pyplot as plt
 
@@ -221,18 +221,6 @@ def load_noisy_STGs(noisy_STGs_dir):
 	
 	return noisy_graphs
 
-def structural_distance(G1, G2, noisy_corpus_dirname="", gpu_id=0):
-	device = torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')
-	# print(f"Process {current_process().name} running on GPU {device} for STGs derived from {noisy_corpus_dirname}")
-
-	STG_augmented_list = [G1, G2]
-	listA_G, idx_node_mapping, node_metadata_dict = simanneal_centroid_helpers.pad_adj_matrices(STG_augmented_list)
-	# A_G1, A_G2 = cp.asarray(listA_G[0]), cp.asarray(listA_G[1]) 
-	# A_G1, A_G2 = np.asarray(listA_G[0]), np.asarray(listA_G[1]) 
-	A_G1, A_G2 = torch.from_numpy(listA_G[0]).to(device), torch.from_numpy(listA_G[1]).to(device)
-	_, structural_distance = simanneal_centroid_run.align_graph_pair(A_G1, A_G2, idx_node_mapping, node_metadata_dict, device=device)
-	return structural_distance.item()
-
 def generate_noisy_STGs(base_graph, percent_noise_max, percent_noise_increment, noisy_STGs_save_dir):
 	noisy_graphs = []
 	noise_percent_level = percent_noise_increment
@@ -278,12 +266,15 @@ if __name__ == "__main__":
 			generate_noisy_STGs(base_graph, percent_noise_max, percent_noise_increment, noisy_STGs_save_dir)
 		
 		noisy_STGs = load_noisy_STGs(noisy_STGs_save_dir)
+		# the base graph against every noise level at once, in one padded universe (instead of structural_distance per pair)
+		device = torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')
+		struct_dists = structural_distance_matrix.distances_from(base_graph, noisy_STGs, device=device)
 			
 		for i, G in enumerate(noisy_STGs):
 			noise_percent = percent_noise_increment * (i+1)
 			noise = int(np.ceil(base_graph.size()*noise_percent))
 			ground_truth = np.sqrt(noise)
-			struct_dist = structural_distance(base_graph, G, noisy_STGs_dirname, gpu_id=gpu_id)
+			struct_dist = struct_dists[i]
 			print(f"AT NOISE PERCENT {noise_percent}, STRUCT DIST ERROR:",  np.abs(struct_dist-ground_truth)/ground_truth)
 			print("NOSIE", noise, "STRUCT DIST", struct_dist, "GROUND TRUTH", ground_truth)
 			print()